@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+'''Benchmark the parsing of `helm upgrade` outputs by the `helm_cli` module
+
+Synthetic outputs, listing an increasing number of resources, are parsed in
+`full` and `summary` modes. For each, the parsing time and the size of the
+JSON module result are reported.
+'''
+
+import imp
+import json
+import optparse
+import os.path
+import timeit
+
+
+MODULE_UTILS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir,
+    'roles', 'helm_common', 'module_utils', 'metalk8s_helm.py')
+
+KINDS = [
+    'v1/ConfigMap', 'v1/Service', 'v1/ServiceAccount', 'v1beta1/Deployment',
+    'v1beta1/ClusterRole', 'v1beta1/ClusterRoleBinding', 'v1/Pod(related)',
+]
+
+
+def synthetic_output(resources):
+    lines = [
+        'Release "bench" has been upgraded. Happy Helming!',
+        'LAST DEPLOYED: Tue Oct 16 10:20:30 2018',
+        'NAMESPACE: kube-ops',
+        'STATUS: DEPLOYED',
+        '',
+        'RESOURCES:',
+    ]
+    per_kind = max(1, resources // len(KINDS))
+    for kind in KINDS:
+        lines.append('==> {}'.format(kind))
+        lines.append('NAME{}DATA  AGE'.format(' ' * 40))
+        for n in range(per_kind):
+            lines.append('bench-{}-{:05d}{}1     2d'.format(
+                kind.split('/')[1].lower(), n, ' ' * 20))
+        lines.append('')
+    lines.append('NOTES:')
+    lines.extend('Note line {}'.format(n) for n in range(50))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--number', type='int', default=20,
+                      help='Number of parsings per measure')
+    parser.add_option('-r', '--resources', default='100,1000,10000',
+                      help='Comma-separated numbers of resources')
+    (options, _) = parser.parse_args()
+
+    metalk8s_helm = imp.load_source('metalk8s_helm', MODULE_UTILS)
+
+    print('{:>10} {:>8} {:>12} {:>14}'.format(
+        'resources', 'output', 'parse (ms)', 'result (bytes)'))
+    for resources in [int(n) for n in options.resources.split(',')]:
+        output = synthetic_output(resources)
+        for mode in ['full', 'summary']:
+            full = mode == 'full'
+            elapsed = timeit.timeit(
+                lambda: metalk8s_helm.parse_helm_output(output, full=full),
+                number=options.number)
+            parsed = metalk8s_helm.parse_helm_output(output, full=full)
+            print('{:>10} {:>8} {:>12.2f} {:>14}'.format(
+                resources, mode, elapsed * 1000 / options.number,
+                len(json.dumps(parsed))))
+
+
+if __name__ == '__main__':
+    main()
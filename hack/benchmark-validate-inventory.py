@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+'''Benchmark the `validate_inventory` checks on a large inventory
+
+A synthetic inventory is generated, with 3 masters and `etcd` members, and
+as many nodes as needed to reach the number of hosts. Each host has an
+`ansible_host`, and an `ip` templated from it in `group_vars/all.yml`, as
+often done in real inventories. The inventory is loaded once, then the time
+to read the variables of the hosts and to run all the checks is reported.
+'''
+
+import imp
+import optparse
+import os.path
+import shutil
+import tempfile
+import timeit
+
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.dataloader import DataLoader
+from ansible.vars.hostvars import HostVars
+from ansible.vars.manager import VariableManager
+
+
+ACTION_PLUGIN = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir,
+    'roles', 'preflight_checks', 'action_plugins', 'validate_inventory.py')
+
+MASTERS = 3
+
+
+def host_address(n):
+    return '10.{}.{}.{}'.format(n // 65536, (n // 256) % 256, n % 256)
+
+
+def write_inventory(directory, hosts):
+    '''Write a synthetic inventory of `hosts` hosts, return its path'''
+    names = ['node-{:05d}.example.com'.format(n) for n in range(hosts)]
+    path = os.path.join(directory, 'hosts')
+    with open(path, 'w') as inventory:
+        inventory.write('[all]\n')
+        for n, name in enumerate(names):
+            inventory.write('{} ansible_host={}\n'.format(
+                name, host_address(n)))
+        inventory.write('\n[kube-master]\n')
+        inventory.write(''.join(name + '\n' for name in names[:MASTERS]))
+        inventory.write('\n[etcd]\n')
+        inventory.write(''.join(name + '\n' for name in names[:MASTERS]))
+        inventory.write('\n[kube-node]\n')
+        inventory.write(''.join(name + '\n' for name in names[MASTERS:]))
+        inventory.write('\n[k8s-cluster:children]\nkube-master\nkube-node\n')
+
+    os.mkdir(os.path.join(directory, 'group_vars'))
+    group_vars_path = os.path.join(directory, 'group_vars', 'all.yml')
+    with open(group_vars_path, 'w') as group_vars:
+        group_vars.write("ansible_user: centos\n")
+        group_vars.write("ip: '{{ ansible_host }}'\n")
+    return path
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--number', type='int', default=3,
+                      help='Number of validations per measure')
+    parser.add_option('-H', '--hosts', default='500,5000',
+                      help='Comma-separated numbers of hosts')
+    (options, _) = parser.parse_args()
+
+    validate_inventory = imp.load_source('validate_inventory', ACTION_PLUGIN)
+
+    print('{:>8} {:>10} {:>12} {:>8}'.format(
+        'hosts', 'load (ms)', 'checks (ms)', 'errors'))
+    for hosts in [int(n) for n in options.hosts.split(',')]:
+        directory = tempfile.mkdtemp(prefix='benchmark-validate-inventory.')
+        try:
+            path = write_inventory(directory, hosts)
+            start = timeit.default_timer()
+            loader = DataLoader()
+            inventory = InventoryManager(loader=loader, sources=path)
+            variable_manager = VariableManager(
+                loader=loader, inventory=inventory)
+            hostvars = HostVars(inventory, variable_manager, loader)
+            groups = inventory.get_groups_dict()
+            load_time = timeit.default_timer() - start
+
+            # The synthetic inventory is valid
+            errors = validate_inventory.run_checks(groups, hostvars)
+            check_time = timeit.timeit(
+                lambda: validate_inventory.run_checks(groups, hostvars),
+                number=options.number)
+        finally:
+            shutil.rmtree(directory)
+
+        print('{:>8} {:>10.0f} {:>12.0f} {:>8}'.format(
+            hosts, load_time * 1000, check_time * 1000 / options.number,
+            len(errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+'''Benchmark the `validate_storage` checks on hosts with many disks
+
+Synthetic hosts are generated, with an increasing number of disks (each with
+by-id links, half of them with a partition), an existing VG on a quarter of
+the disks and a configuration adding another quarter of them. For each, the
+time to index the devices of the host and to run the checks is reported.
+'''
+
+import imp
+import optparse
+import os.path
+import timeit
+
+
+ACTION_PLUGIN = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir,
+    'roles', 'setup_lvm_vg', 'action_plugins', 'validate_storage.py')
+
+
+def disk_name(n):
+    '''sda, ..., sdz, sdaa, ... as named by the kernel'''
+    name = ''
+    n += 1
+    while n:
+        n, rest = divmod(n - 1, 26)
+        name = chr(ord('a') + rest) + name
+    return 'sd' + name
+
+
+def synthetic_hostvars(disks):
+    devices = {}
+    for n in range(disks):
+        name = disk_name(n)
+        partitions = {}
+        if n % 2:
+            partitions[name + '1'] = {
+                'links': {'ids': ['wwn-0x5000c500{:08x}-part1'.format(n)],
+                          'uuids': ['{:08x}-0000-4000-8000-000000000000'
+                                    .format(n)]},
+                'uuid': '{:08x}-0000-4000-8000-000000000000'.format(n),
+            }
+        devices[name] = {
+            'holders': [],
+            'links': {'ids': ['wwn-0x5000c500{:08x}'.format(n)],
+                      'uuids': []},
+            'partitions': partitions,
+        }
+
+    # Disks without partition: the first half is in the VG, the second one
+    # is added by the configuration
+    free = ['/dev/' + disk_name(n) for n in range(0, disks, 2)]
+    in_vg = free[:len(free) // 2]
+    return {
+        'ansible_devices': devices,
+        'ansible_lvm': {
+            'pvs': dict((pv, {'vg': 'vg_metalk8s'}) for pv in in_vg),
+            'vgs': {'vg_metalk8s': {}} if in_vg else {},
+        },
+        'metalk8s_lvm_all_vgs': {
+            'vg_metalk8s': {'drives': free},
+        },
+    }
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--number', type='int', default=20,
+                      help='Number of validations per measure')
+    parser.add_option('-d', '--disks', default='50,500,2000',
+                      help='Comma-separated numbers of disks per host')
+    (options, _) = parser.parse_args()
+
+    validate_storage = imp.load_source('validate_storage', ACTION_PLUGIN)
+
+    print('{:>8} {:>11} {:>12}'.format('disks', 'index (ms)', 'checks (ms)'))
+    for disks in [int(n) for n in options.disks.split(',')]:
+        hostvars = synthetic_hostvars(disks)
+        index = validate_storage.DeviceIndex.from_hostvars(hostvars)
+        # The synthetic configuration is valid
+        validate_storage.check_devices_presence_and_usage(hostvars, index)
+
+        index_time = timeit.timeit(
+            lambda: validate_storage.DeviceIndex.from_hostvars(hostvars),
+            number=options.number)
+        check_time = timeit.timeit(
+            lambda: validate_storage.check_devices_presence_and_usage(
+                hostvars, index),
+            number=options.number)
+        print('{:>8} {:>11.2f} {:>12.2f}'.format(
+            disks, index_time * 1000 / options.number,
+            check_time * 1000 / options.number))
+
+
+if __name__ == '__main__':
+    main()
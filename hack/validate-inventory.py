@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+'''Run the preflight checks of inventories, without running a playbook
+
+The inventories are loaded with the Ansible `InventoryManager` and
+`VariableManager`, then go through the `check_*` functions of the
+`validate_inventory` action of the `preflight_checks` role: no play is
+compiled, no worker is forked, and no host is contacted.
+
+For each inventory, a line with a JSON object is printed:
+
+  .. code::
+
+    {"inventory": "inventory/hosts", "failed": true, "duration": 0.021,
+     "errors": ["etcd ensemble size should be odd, currently 2 [...]"]}
+
+The exit status is 1 if any inventory has errors, or cannot be loaded.
+'''
+
+import imp
+import json
+import optparse
+import os.path
+import sys
+import time
+
+from ansible.errors import AnsibleError
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.dataloader import DataLoader
+from ansible.vars.hostvars import HostVars
+from ansible.vars.manager import VariableManager
+
+
+ACTION_PLUGIN = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir,
+    'roles', 'preflight_checks', 'action_plugins', 'validate_inventory.py')
+
+
+def validate(validate_inventory, path):
+    '''Load the inventory at `path` and run the checks on it'''
+    start = time.time()
+    result = {'inventory': path}
+    try:
+        loader = DataLoader()
+        inventory = InventoryManager(loader=loader, sources=path)
+        if not inventory.list_hosts():
+            raise AnsibleError('No host in the inventory')
+        variable_manager = VariableManager(loader=loader, inventory=inventory)
+        hostvars = HostVars(inventory, variable_manager, loader)
+        errors = validate_inventory.run_checks(
+            inventory.get_groups_dict(), hostvars)
+    except AnsibleError as exc:
+        result['load_error'] = str(exc)
+        errors = []
+
+    result['failed'] = bool(errors) or 'load_error' in result
+    result['errors'] = errors
+    result['duration'] = round(time.time() - start, 3)
+    return result
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [options] INVENTORY...',
+        description='Run the MetalK8s preflight checks of the inventories')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+                      help='Only print the inventories which failed')
+    (options, paths) = parser.parse_args()
+    if not paths:
+        parser.error('At least one inventory is required')
+
+    validate_inventory = imp.load_source('validate_inventory', ACTION_PLUGIN)
+
+    failed = False
+    for path in paths:
+        result = validate(validate_inventory, path)
+        failed = failed or result['failed']
+        if result['failed'] or not options.quiet:
+            print(json.dumps(result, sort_keys=True))
+            sys.stdout.flush()
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = '''
+    callback: metalk8s_timings
+    type: aggregate
+    short_description: Report the slowest helm and kubectl commands of a run
+    description:
+      - Collect the `timings` returned by the `helm_cli`, `helm_releases` and
+        `kube` modules (one entry per helm or kubectl command, with its
+        duration, exit code and output size) and write them, at the end of
+        the run, to a JSON report ranking the slowest commands.
+      - Retries of a task (`until`) are reported once per task, whatever
+        the number of commands it ran.
+    requirements:
+      - whitelisting in configuration
+    options:
+      report_path:
+        description: Path of the JSON report
+        default: metalk8s-timings.json
+        env:
+          - name: METALK8S_TIMINGS_REPORT
+        ini:
+          - section: callback_metalk8s_timings
+            key: report_path
+      output_limit:
+        description: Number of commands in the ranking of the report
+        default: 20
+        type: int
+        env:
+          - name: METALK8S_TIMINGS_OUTPUT_LIMIT
+        ini:
+          - section: callback_metalk8s_timings
+            key: output_limit
+'''
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'metalk8s_timings'
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, display=None):
+        super(CallbackModule, self).__init__(display=display)
+        self.commands = []
+        self.retries = []
+
+    def _record(self, result):
+        res = result._result
+        # Results of a loop are only recorded once, with the task
+        for item in res.get('results') or [res]:
+            if not isinstance(item, dict):
+                continue
+            timings = list(item.get('timings') or [])
+            for release in (item.get('releases') or {}).values():
+                if isinstance(release, dict):
+                    timings.extend(release.get('timings') or [])
+                    timings.extend(
+                        (release.get('result') or {}).get('timings') or [])
+            retries = max(0, item.get('attempts', 1) - 1)
+            if retries:
+                self.retries.append({
+                    'task': result._task.get_name(),
+                    'host': result._host.get_name(),
+                    'retries': retries,
+                })
+            for timing in timings:
+                self.commands.append(dict(
+                    timing,
+                    task=result._task.get_name(),
+                    host=result._host.get_name(),
+                ))
+
+    def v2_runner_on_ok(self, result):
+        self._record(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record(result)
+
+    def report(self):
+        by_command = {}
+        for entry in self.commands:
+            stats = by_command.setdefault(entry['command'], {
+                'count': 0,
+                'failed': 0,
+                'duration': 0,
+                'max_duration': 0,
+                'stdout_bytes': 0,
+            })
+            stats['count'] += 1
+            stats['failed'] += int(entry.get('failed', entry['rc'] != 0))
+            stats['duration'] += entry['duration']
+            stats['max_duration'] = max(
+                stats['max_duration'], entry['duration'])
+            stats['stdout_bytes'] += entry['stdout_bytes']
+        for stats in by_command.values():
+            stats['duration'] = round(stats['duration'], 3)
+            stats['mean_duration'] = round(
+                stats['duration'] / stats['count'], 3)
+
+        slowest = sorted(self.commands, key=lambda entry: -entry['duration'])
+        return {
+            'commands': len(self.commands),
+            'duration': round(
+                sum(entry['duration'] for entry in self.commands), 3),
+            'slowest': slowest[:self.get_option('output_limit')],
+            'by_command': by_command,
+            'retries': {
+                'total': sum(task['retries'] for task in self.retries),
+                'tasks': sorted(self.retries,
+                                key=lambda task: -task['retries']),
+            },
+        }
+
+    def v2_playbook_on_stats(self, stats):
+        path = self.get_option('report_path')
+        report = self.report()
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+
+        self._display.banner('HELM AND KUBECTL TIMINGS')
+        for command, command_stats in sorted(
+                report['by_command'].items(),
+                key=lambda item: -item[1]['duration']):
+            self._display.display(
+                '{}: {} run(s), {:.2f}s (max {:.2f}s)'.format(
+                    command, command_stats['count'],
+                    command_stats['duration'],
+                    command_stats['max_duration']))
+        self._display.display('Report written to {}'.format(path))
@@ -0,0 +1,244 @@
+'''Serve Helm charts to the `helm_cli` module from an on-controller cache
+
+When `chart_cache` is set, the chart of the release is looked up in this
+directory of the Ansible controller, keyed by repository, chart name and
+version. On a cache miss, the `index.yaml` of the repository is downloaded
+(once per repository and run), then the chart archive, which is verified
+against the digest published in the index.
+
+Archives are stored by content, as `<sha256>.tgz`, next to an `index.json`
+mapping each `<repo> <name> <version>` key to its digest:
+
+  .. code::
+
+    ~/.cache/metalk8s/charts/
+        index.json
+        0a1b...f9.tgz
+
+The archive is then pushed, if not already there, to the `chart_cache_remote`
+directory of the host running `helm_cli`, and the module installs the chart
+from this local archive instead of downloading it from the repository.
+
+With `chart_cache_offline`, a cache miss is an error: the repositories are
+never contacted, which is required for air-gapped deployments.
+
+Charts without a `repo` or a `version` are not cached.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import yaml
+
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.module_utils.six.moves.urllib.parse import urljoin
+from ansible.module_utils.urls import open_url
+from ansible.plugins.action import ActionBase
+
+
+class ChartCacheError(Exception):
+    '''Error from the chart cache'''
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as chart_file:
+        for block in iter(lambda: chart_file.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ChartCache(object):
+    '''Content-addressed cache of Helm chart archives
+
+    :param str path: Directory of the cache, created if needed
+    :param bool offline: Fail on a cache miss instead of downloading
+    '''
+
+    def __init__(self, path, offline=False):
+        self.path = os.path.expanduser(path)
+        self.offline = offline
+        self._repo_indexes = {}
+
+    @staticmethod
+    def key(repo, name, version):
+        return '{} {} {}'.format(repo.rstrip('/'), name, version)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.path, 'index.json')) as index_file:
+                return json.load(index_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        temp = tempfile.NamedTemporaryFile(
+            mode='w', dir=self.path, prefix='.index.', delete=False)
+        with temp:
+            json.dump(index, temp, indent=2, sort_keys=True)
+        os.rename(temp.name, os.path.join(self.path, 'index.json'))
+
+    def archive_path(self, digest):
+        return os.path.join(self.path, '{}.tgz'.format(digest))
+
+    def lookup(self, repo, name, version):
+        '''Return the digest of a cached chart, None on a cache miss
+
+        The archive is verified against its digest, a corrupted archive
+        is a cache miss.
+        '''
+        digest = self._read_index().get(self.key(repo, name, version))
+        if digest is None:
+            return None
+        path = self.archive_path(digest)
+        if not os.path.isfile(path) or sha256sum(path) != digest:
+            return None
+        return digest
+
+    def _repo_index(self, repo):
+        if repo not in self._repo_indexes:
+            url = urljoin(repo.rstrip('/') + '/', 'index.yaml')
+            try:
+                self._repo_indexes[repo] = yaml.safe_load(
+                    open_url(url).read())
+            except Exception as exc:
+                raise ChartCacheError(
+                    'Cannot download the index of repository {}: {}'.format(
+                        repo, exc))
+        return self._repo_indexes[repo]
+
+    def fetch(self, repo, name, version):
+        '''Download a chart in the cache and return its digest'''
+        entries = self._repo_index(repo).get('entries', {}).get(name, [])
+        for entry in entries:
+            if str(entry.get('version')) == str(version):
+                break
+        else:
+            raise ChartCacheError(
+                'Chart {} version {} not found in repository {}'.format(
+                    name, version, repo))
+
+        url = urljoin(repo.rstrip('/') + '/', entry['urls'][0])
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        temp = tempfile.NamedTemporaryFile(
+            dir=self.path, prefix='.chart.', delete=False)
+        try:
+            with temp:
+                shutil.copyfileobj(open_url(url), temp)
+            digest = sha256sum(temp.name)
+            expected = entry.get('digest')
+            if expected and expected != digest:
+                raise ChartCacheError(
+                    'Digest mismatch for chart {} version {} from {}: '
+                    'expected {}, got {}'.format(
+                        name, version, url, expected, digest))
+            os.rename(temp.name, self.archive_path(digest))
+        except Exception as exc:
+            if os.path.exists(temp.name):
+                os.remove(temp.name)
+            if isinstance(exc, ChartCacheError):
+                raise
+            raise ChartCacheError(
+                'Cannot download chart {} version {} from {}: {}'.format(
+                    name, version, url, exc))
+
+        index = self._read_index()
+        index[self.key(repo, name, version)] = digest
+        self._write_index(index)
+        return digest
+
+    def get(self, repo, name, version):
+        '''Return the digest of a chart, downloading it if needed'''
+        digest = self.lookup(repo, name, version)
+        if digest is not None:
+            return digest
+        if self.offline:
+            raise ChartCacheError(
+                'Chart {} version {} from {} is not in the cache {} '
+                '(offline mode)'.format(name, version, repo, self.path))
+        return self.fetch(repo, name, version)
+
+
+class ActionModule(ActionBase):
+    '''Resolve the chart from the cache, then run the `helm_cli` module'''
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+
+        module_args = dict(self._task.args)
+        cache_dir = module_args.pop('chart_cache', None)
+        offline = boolean(module_args.pop('chart_cache_offline', False),
+                          strict=False)
+        remote_dir = module_args.pop('chart_cache_remote', None)
+        chart = module_args.get('chart') or {}
+
+        try:
+            if cache_dir and remote_dir and 'repo' in chart and \
+                    'version' in chart and \
+                    module_args.get('state', 'present') in \
+                    ['present', 'latest']:
+                cache = ChartCache(cache_dir, offline=offline)
+                digest = cache.get(
+                    chart['repo'], chart['name'], chart['version'])
+                remote_path = os.path.join(
+                    remote_dir, '{}.tgz'.format(digest))
+
+                push = self._push(cache.archive_path(digest), remote_path,
+                                  task_vars)
+                if push.get('failed'):
+                    result.update(push)
+                    return result
+
+                module_args['chart'] = dict(chart, path=remote_path)
+                result['chart_cache'] = {
+                    'digest': digest,
+                    'path': remote_path,
+                    'pushed': bool(push.get('changed')),
+                }
+
+            result.update(self._execute_module(
+                module_name='helm_cli',
+                module_args=module_args,
+                task_vars=task_vars,
+            ))
+        except ChartCacheError as exc:
+            result['failed'] = True
+            result['msg'] = exc.args[0]
+        finally:
+            self._remove_tmp_path(self._connection._shell.tmpdir)
+
+        return result
+
+    def _push(self, src, dest, task_vars):
+        '''Copy a chart archive to the managed host, if not already there'''
+        # The copy module only creates the parent directories of a `dest`
+        # ending with a `/`
+        mkdir = self._execute_module(
+            module_name='file',
+            module_args=dict(path=os.path.dirname(dest), state='directory',
+                             mode='0755'),
+            task_vars=task_vars,
+        )
+        if mkdir.get('failed'):
+            return mkdir
+
+        copy_task = self._task.copy()
+        copy_task.args = dict(src=src, dest=dest, mode='0644')
+        copy_action = self._shared_loader_obj.action_loader.get(
+            'copy',
+            task=copy_task,
+            connection=self._connection,
+            play_context=self._play_context,
+            loader=self._loader,
+            templar=self._templar,
+            shared_loader_obj=self._shared_loader_obj,
+        )
+        return copy_action.run(task_vars=task_vars)
@@ -0,0 +1,213 @@
+'''Install several Helm releases concurrently, following their dependencies
+
+Each item of `releases` accepts the same parameters as the `helm_cli`
+module (`release`, `chart`, `namespace`, `values`, `wait`, `timeout`,
+`state`) plus `depends_on`, the list of the releases which must be
+successfully handled before this one.
+
+Independent releases are handled concurrently, by at most `workers` threads.
+The result contains, for each release, its status (`ok`, `failed` or
+`skipped` when one of its dependencies failed), its `helm_cli` result and
+the time it took:
+
+  .. code::
+
+    - name: 'install monitoring charts'
+      helm_releases:
+        binary: '{{ bin_dir }}/helm'
+        snapshot: '{{ helm_snapshot }}'
+        wait: True
+        releases:
+          - release: prometheus-operator
+            chart:
+              name: prometheus-operator
+              repo: '{{ prometheus_operator_repo }}'
+          - release: kube-prometheus
+            chart:
+              name: kube-prometheus
+              repo: '{{ kube_prometheus_repo }}'
+            depends_on: [prometheus-operator]
+          - release: heapster
+            chart:
+              name: heapster
+'''
+
+import threading
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.metalk8s_helm import Helm
+from ansible.module_utils.metalk8s_helm import helm_engine
+from ansible.module_utils.metalk8s_helm import HelmError
+from ansible.module_utils.metalk8s_helm import ReleaseSnapshot
+from ansible.module_utils.six.moves import queue
+
+
+RELEASE_PARAMS = ['chart', 'namespace', 'values', 'wait', 'timeout', 'state']
+
+
+def index_releases(releases):
+    '''Index the releases by name and check their `depends_on`
+
+    :param list releases: The `releases` module parameter
+    :returns: The releases, indexed by name
+    :rtype: dict
+    :raises: HelmError if a release is duplicated, depends on an unknown
+        release or if there is a dependency cycle
+    '''
+    by_name = {}
+    for item in releases:
+        name = item.get('release') or item.get('name')
+        if not name:
+            raise HelmError("Each item of 'releases' requires a 'release' key")
+        if name in by_name:
+            raise HelmError('Release {} is defined twice'.format(name))
+        by_name[name] = item
+
+    for name, item in by_name.items():
+        for dependency in item.get('depends_on') or []:
+            if dependency not in by_name:
+                raise HelmError(
+                    'Release {} depends on unknown release {}'.format(
+                        name, dependency))
+
+    # Drop the releases without pending dependencies until none is left
+    pending = dict(
+        (name, set(item.get('depends_on') or []))
+        for name, item in by_name.items()
+    )
+    while pending:
+        ready = [name for name, deps in pending.items() if not deps]
+        if not ready:
+            raise HelmError('Dependency cycle between releases: {}'.format(
+                ', '.join(sorted(pending))))
+        for name in ready:
+            del pending[name]
+        for deps in pending.values():
+            deps.difference_update(ready)
+
+    return by_name
+
+
+class ReleaseScheduler(object):
+    '''Handle releases on a bounded pool of threads, dependencies first'''
+
+    def __init__(self, module, releases, workers):
+        self.module = module
+        self.releases = releases
+        self.workers = max(1, workers)
+        defaults = module.params
+        self.snapshot = ReleaseSnapshot(
+            Helm(module, defaults), defaults.get('snapshot'))
+        self._done = queue.Queue()
+
+    def release_params(self, name):
+        item = self.releases[name]
+        params = dict(self.module.params)
+        params.pop('releases')
+        params['release'] = name
+        for key in RELEASE_PARAMS:
+            if item.get(key) is not None:
+                params[key] = item[key]
+        return params
+
+    def _worker(self, name):
+        start = time.time()
+        helm = helm_engine(self.module, self.release_params(name),
+                           snapshot=self.snapshot)
+        try:
+            result = {'status': 'ok', 'result': helm.execute()}
+        except HelmError as exc:
+            result = {'status': 'failed', 'msg': exc.args[0],
+                      'timings': helm.timings}
+        except Exception as exc:
+            result = {'status': 'failed',
+                      'msg': 'Unexpected error: {}'.format(exc),
+                      'timings': helm.timings}
+        result['duration'] = round(time.time() - start, 3)
+        self._done.put((name, result))
+
+    def run(self):
+        results = {}
+        pending = dict(
+            (name, set(item.get('depends_on') or []))
+            for name, item in self.releases.items()
+        )
+        running = 0
+
+        while pending or running:
+            for name in sorted(pending):
+                deps = pending[name]
+                failed = [dep for dep in sorted(deps)
+                          if dep in results and results[dep]['status'] != 'ok']
+                if failed:
+                    del pending[name]
+                    results[name] = {
+                        'status': 'skipped',
+                        'msg': 'Dependencies failed: {}'.format(
+                            ', '.join(failed)),
+                        'duration': 0,
+                    }
+                elif running < self.workers and \
+                        all(dep in results for dep in deps):
+                    del pending[name]
+                    thread = threading.Thread(target=self._worker,
+                                              args=(name,))
+                    thread.daemon = True
+                    thread.start()
+                    running += 1
+
+            if running:
+                name, result = self._done.get()
+                running -= 1
+                results[name] = result
+
+        return results
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            releases=dict(type='list', required=True),
+            binary=dict(type='str'),
+            wait=dict(default=False, type='bool'),
+            state=dict(default='present',
+                       choices=['latest', 'present', 'absent', 'purged']),
+            timeout=dict(type='int'),
+            snapshot=dict(type='path'),
+            workers=dict(default=4, type='int'),
+            engine=dict(default='tiller', choices=['tiller', 'template']),
+            kubectl=dict(type='str'),
+            helm_host=dict(type='str'),
+            output=dict(default='full', choices=['full', 'summary']),
+            # Defaults of the `helm_cli` parameters of each release
+            chart=dict(type='dict'),
+            namespace=dict(type='str'),
+            values=dict(type='list', default=[]),
+        )
+    )
+    try:
+        releases = index_releases(module.params['releases'])
+        scheduler = ReleaseScheduler(
+            module, releases, module.params['workers'])
+        results = scheduler.run()
+    except HelmError as exc:
+        module.fail_json(msg=exc.args[0])
+
+    changed = any(result.get('result', {}).get('changed')
+                  for result in results.values())
+    failed = sorted(name for name, result in results.items()
+                    if result['status'] != 'ok')
+    # `helm list` commands of the shared snapshot
+    timings = scheduler.snapshot.helm.timings
+    if failed:
+        module.fail_json(
+            msg='Failed to handle the releases: {}'.format(', '.join(failed)),
+            changed=changed,
+            releases=results,
+            timings=timings)
+    module.exit_json(changed=changed, releases=results, timings=timings)
+
+
+if __name__ == '__main__':
+    main()
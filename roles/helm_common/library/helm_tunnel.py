@@ -0,0 +1,149 @@
+'''Keep a tunnel to Tiller open, shared by all the helm commands of a play
+
+Without `HELM_HOST`, each helm command sets up its own port-forward to the
+Tiller pod through the API server, which is most of the run time of small
+operations. With `state=started`, a `kubectl port-forward` to Tiller is
+started in the background (or reused, if already running and healthy) and
+its address is returned, to be passed as `helm_host` to `helm_cli` or as
+`HELM_HOST` to helm commands:
+
+  .. code::
+
+    - name: 'open a tunnel to tiller'
+      helm_tunnel:
+        binary: '{{ bin_dir }}/helm'
+        kubectl: '{{ bin_dir }}/kubectl'
+        state: started
+      register: helm_tunnel_result
+
+    - command: '{{ bin_dir }}/helm list'
+      environment:
+        HELM_HOST: '{{ helm_tunnel_result.helm_host }}'
+
+The tunnel is checked with `helm version --server` before being returned.
+`state=stopped` terminates it.
+'''
+
+import errno
+import os
+import signal
+import socket
+import subprocess
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+
+
+TILLER_PORT = 44134
+
+
+def read_pid(pidfile):
+    try:
+        with open(pidfile) as pid_file:
+            return int(pid_file.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def stop_tunnel(pidfile):
+    '''Terminate the tunnel recorded in `pidfile`, return whether it ran'''
+    pid = read_pid(pidfile)
+    stopped = False
+    if pid is not None and is_running(pid):
+        try:
+            os.killpg(pid, signal.SIGTERM)
+            stopped = True
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+    if os.path.exists(pidfile):
+        os.remove(pidfile)
+    return stopped
+
+
+def start_tunnel(module, pidfile):
+    '''Start `kubectl port-forward` to Tiller, detached from the module'''
+    params = module.params
+    kubectl = params['kubectl'] or \
+        module.get_bin_path('kubectl', required=True)
+    cmd = [
+        kubectl, 'port-forward',
+        '--namespace', params['namespace'],
+        'deployment/{}'.format(params['deployment']),
+        '{}:{}'.format(params['port'], TILLER_PORT),
+    ]
+    with open(os.devnull, 'r') as devnull, \
+            open(pidfile + '.log', 'a') as log:
+        process = subprocess.Popen(
+            cmd, stdin=devnull, stdout=log, stderr=log, close_fds=True,
+            # Own session, so that the tunnel outlives the module
+            preexec_fn=os.setsid)
+    with open(pidfile, 'w') as pid_file:
+        pid_file.write('{}\n'.format(process.pid))
+    return process
+
+
+def is_healthy(module, helm_host):
+    '''Check that Tiller answers through the tunnel'''
+    host, port = helm_host.rsplit(':', 1)
+    try:
+        socket.create_connection((host, int(port)), timeout=1).close()
+    except (socket.error, socket.timeout):
+        return False
+    helm = module.params['binary'] or \
+        module.get_bin_path('helm', required=True)
+    rc, out, err = module.run_command(
+        [helm, 'version', '--server', '--tiller-connection-timeout', '5'],
+        environ_update={'HELM_HOST': helm_host})
+    return rc == 0
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            binary=dict(type='str'),
+            kubectl=dict(type='str'),
+            state=dict(default='started', choices=['started', 'stopped']),
+            port=dict(default=TILLER_PORT, type='int'),
+            namespace=dict(default='kube-system', type='str'),
+            deployment=dict(default='tiller-deploy', type='str'),
+            pidfile=dict(default='/var/tmp/metalk8s-helm-tunnel.pid',
+                         type='path'),
+            timeout=dict(default=30, type='int'),
+        )
+    )
+    pidfile = module.params['pidfile']
+    helm_host = '127.0.0.1:{}'.format(module.params['port'])
+
+    if module.params['state'] == 'stopped':
+        module.exit_json(changed=stop_tunnel(pidfile))
+
+    pid = read_pid(pidfile)
+    if pid is not None and is_running(pid) and is_healthy(module, helm_host):
+        module.exit_json(changed=False, helm_host=helm_host, pid=pid)
+
+    # Stale or unhealthy tunnel
+    stop_tunnel(pidfile)
+    process = start_tunnel(module, pidfile)
+    deadline = time.time() + module.params['timeout']
+    while not is_healthy(module, helm_host):
+        if process.poll() is not None or time.time() > deadline:
+            stop_tunnel(pidfile)
+            module.fail_json(
+                msg='Cannot open a tunnel to tiller, see {}.log'.format(
+                    pidfile))
+        time.sleep(0.5)
+
+    module.exit_json(changed=True, helm_host=helm_host, pid=process.pid)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+'''Wait for several Helm releases to be ready, all at once
+
+The releases are given as the `handle` returned by `helm_cli` (or simply by
+name), which makes it possible to install charts without `wait`, then to
+wait for all of them in a single task: image pulls and pod startups of the
+different charts then overlap.
+
+  .. code::
+
+    - name: 'install elasticsearch'
+      helm_cli:
+        release: elasticsearch
+        chart: ...
+        wait: False
+      register: elasticsearch_helm_install
+
+    - name: 'install kibana'
+      helm_cli:
+        release: kibana
+        chart: ...
+        wait: False
+      register: kibana_helm_install
+
+    - name: 'wait for the logging releases'
+      helm_wait:
+        binary: '{{ bin_dir }}/helm'
+        kubectl: '{{ bin_dir }}/kubectl'
+        timeout: 600
+        releases:
+          - '{{ elasticsearch_helm_install.handle }}'
+          - '{{ kibana_helm_install.handle }}'
+
+The Deployments, DaemonSets and StatefulSets of each release are watched
+(`kubectl get --watch`, one watch per kind and namespace), until all of them
+are rolled out or `timeout` seconds are elapsed. The result gives, for each
+release, its time-to-ready, measured from its submission by `helm_cli`.
+'''
+
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.metalk8s_helm import Helm
+from ansible.module_utils.metalk8s_helm import helm_engine
+from ansible.module_utils.metalk8s_helm import HelmError
+from ansible.module_utils.metalk8s_helm import ReleaseSnapshot
+from ansible.module_utils.metalk8s_kube_watch import Watch
+from ansible.module_utils.six.moves import queue
+
+
+def _generation_observed(obj, status):
+    return status.get('observedGeneration', 0) >= \
+        obj['metadata'].get('generation', 0)
+
+
+def deployment_ready(obj):
+    status = obj.get('status') or {}
+    replicas = obj.get('spec', {}).get('replicas', 1)
+    return _generation_observed(obj, status) and \
+        status.get('updatedReplicas', 0) >= replicas and \
+        status.get('availableReplicas', 0) >= replicas
+
+
+def daemonset_ready(obj):
+    status = obj.get('status') or {}
+    desired = status.get('desiredNumberScheduled', 0)
+    return _generation_observed(obj, status) and \
+        status.get('updatedNumberScheduled', 0) >= desired and \
+        status.get('numberAvailable', 0) >= desired
+
+
+def statefulset_ready(obj):
+    status = obj.get('status') or {}
+    spec = obj.get('spec') or {}
+    replicas = spec.get('replicas', 1)
+    rolling = spec.get('updateStrategy', {}).get('type') == 'RollingUpdate'
+    updated = not rolling or \
+        status.get('updateRevision') == status.get('currentRevision')
+    return _generation_observed(obj, status) and updated and \
+        status.get('readyReplicas', 0) >= replicas
+
+
+READY_CHECKS = {
+    'daemonset': daemonset_ready,
+    'deployment': deployment_ready,
+    'statefulset': statefulset_ready,
+}
+
+
+class ReleaseWaiter(object):
+    '''Watch the workloads of releases until they are all ready'''
+
+    def __init__(self, module, handles):
+        self.module = module
+        self.handles = handles
+        self.snapshot = ReleaseSnapshot(Helm(module, module.params))
+        self.kubectl = module.params['kubectl'] or \
+            module.get_bin_path('kubectl', required=True)
+        self.events = queue.Queue()
+        self.objects = {}
+        self.ready = set()
+        self.results = {}
+
+    def release_objects(self, handle):
+        params = dict(self.module.params,
+                      release=handle['release'],
+                      namespace=handle.get('namespace'))
+        params['engine'] = handle.get('engine') or params['engine']
+        helm = helm_engine(self.module, params, snapshot=self.snapshot)
+        return set(helm.release_objects(handle['release']))
+
+    def update_results(self):
+        now = time.time()
+        for handle in self.handles:
+            name = handle['release']
+            if name in self.results or not self.objects[name] <= self.ready:
+                continue
+            self.results[name] = {
+                'ready': True,
+                'time_to_ready': round(
+                    now - handle.get('submitted', self.start), 3),
+                'objects': ['/'.join(obj) for obj in
+                            sorted(self.objects[name])],
+            }
+
+    def run(self, timeout):
+        self.start = time.time()
+        deadline = self.start + timeout
+        for handle in self.handles:
+            self.objects[handle['release']] = self.release_objects(handle)
+
+        watches = dict(
+            ((kind, namespace), None)
+            for objects in self.objects.values()
+            for kind, namespace, _ in objects
+        )
+        for kind, namespace in watches:
+            watches[(kind, namespace)] = self._watch(kind, namespace)
+
+        try:
+            self.update_results()
+            while len(self.results) < len(self.handles):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    watch, _, obj = self.events.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if obj is None:
+                    # Watches are closed by the API server after a while
+                    watches[(watch.kind, watch.namespace)] = self._watch(
+                        watch.kind, watch.namespace)
+                    time.sleep(0.5)
+                    continue
+                key = (watch.kind, watch.namespace, obj['metadata']['name'])
+                if READY_CHECKS[watch.kind](obj):
+                    self.ready.add(key)
+                else:
+                    self.ready.discard(key)
+                self.update_results()
+        finally:
+            for watch in watches.values():
+                watch.stop()
+
+        for handle in self.handles:
+            name = handle['release']
+            if name not in self.results:
+                self.results[name] = {
+                    'ready': False,
+                    'pending': ['/'.join(obj) for obj in
+                                sorted(self.objects[name] - self.ready)],
+                }
+        return self.results
+
+    def _watch(self, kind, namespace):
+        watch = Watch(self.kubectl, kind, namespace, self.events)
+        watch.start()
+        return watch
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            releases=dict(type='list', required=True),
+            binary=dict(type='str'),
+            kubectl=dict(type='str'),
+            helm_host=dict(type='str'),
+            engine=dict(default='tiller', choices=['tiller', 'template']),
+            # Namespace of the releases given by name
+            namespace=dict(type='str'),
+            timeout=dict(default=300, type='int'),
+        )
+    )
+    handles = []
+    for item in module.params['releases']:
+        if not isinstance(item, dict):
+            item = {'release': item,
+                    'namespace': module.params['namespace']}
+        handles.append(item)
+
+    try:
+        results = ReleaseWaiter(module, handles).run(
+            module.params['timeout'])
+    except HelmError as exc:
+        module.fail_json(msg=exc.args[0])
+
+    not_ready = sorted(name for name, result in results.items()
+                       if not result['ready'])
+    if not_ready:
+        module.fail_json(
+            msg='Releases not ready after {}s: {}'.format(
+                module.params['timeout'], ', '.join(not_ready)),
+            releases=results)
+    module.exit_json(changed=False, releases=results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1083 @@
+'''Helm release management shared by the `helm_cli` and `helm_releases`
+modules'''
+
+from contextlib import contextmanager
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+from tempfile import mkdtemp
+from tempfile import NamedTemporaryFile
+import threading
+import time
+
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
+
+# A `KEY: value` header, or the `KEY:` start of a multi-line section
+HELM_OUTPUT_HEADER = re.compile(r'^([A-Z][A-Z0-9 _-]*):(.*)$')
+
+
+def iter_lines(text):
+    '''Iterate over the lines of `text` without splitting it all at once'''
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text)
+        yield text[start:end].rstrip('\r')
+        start = end + 1
+
+
+def parse_helm_output(helm_output, full=True):
+    '''Parse the output of `helm install`, `upgrade` or `status`
+
+    The output is read line by line. `KEY: value` headers (`STATUS`,
+    `NAMESPACE`, `LAST DEPLOYED`...) are returned as is, the first line,
+    if not a header, as `message`.
+
+    The objects listed in the `RESOURCES` section are counted by kind, in
+    `resources`:
+
+      .. code::
+
+        {'v1/Service': 1, 'v1beta1/Deployment': 2, 'v1/Pod(related)': 2}
+
+    Multi-line sections (`RESOURCES`, `NOTES`...) are only returned, as
+    lists of lines, if `full` is set: they can be very large for releases
+    with many objects. Everything after `NOTES:` belongs to the notes.
+    Unexpected lines outside of any section are ignored.
+
+    :param str helm_output: The standard output of helm
+    :param bool full: Whether to return the multi-line sections
+    :rtype: dict
+    '''
+    parsed = {}
+    resources = {}
+    section = None
+    kind = None
+    kind_header_seen = False
+
+    for n, line in enumerate(iter_lines(helm_output)):
+        match = HELM_OUTPUT_HEADER.match(line) \
+            if section != 'NOTES' else None
+        if match is not None:
+            key, value = match.group(1), match.group(2).strip()
+            if value:
+                parsed[key] = value
+                section = None
+            else:
+                section = key
+                if full:
+                    parsed[key] = []
+            continue
+
+        if section is None:
+            if n == 0:
+                parsed['message'] = line
+            continue
+
+        if full:
+            parsed[section].append(line)
+
+        if section == 'RESOURCES':
+            if line.startswith('==> '):
+                kind = line[4:].strip()
+                resources.setdefault(kind, 0)
+                kind_header_seen = False
+            elif not line.strip():
+                kind = None
+            elif kind is not None:
+                # The first line of each kind is the table header
+                if kind_header_seen:
+                    resources[kind] += 1
+                kind_header_seen = True
+
+    if resources:
+        parsed['resources'] = resources
+    return parsed
+
+
+def merge_values(base, override):
+    '''Merge two values documents, with the precedence rules of Helm
+
+    Mappings are merged recursively, any other value of `override` (lists
+    included) replaces the one of `base`. Neither argument is modified.
+    '''
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_values(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_values(document):
+    '''Load a values document, given as a mapping or as YAML text'''
+    if isinstance(document, dict) or document is None:
+        return document or {}
+    try:
+        # Most documents are mappings serialized to JSON by Ansible
+        loaded = json.loads(document)
+    except ValueError:
+        if not HAS_YAML:
+            raise HelmError(
+                'PyYAML is required to load values given as YAML text, '
+                'use the from_yaml filter instead')
+        try:
+            loaded = yaml.safe_load(document)
+        except yaml.YAMLError as exc:
+            raise HelmError('Invalid values document: {}'.format(exc))
+    if loaded is None:
+        return {}
+    if not isinstance(loaded, dict):
+        raise HelmError('Values documents must be mappings, got {}'.format(
+            type(loaded).__name__))
+    return loaded
+
+
+def dump_values(values):
+    '''Serialize values the same way for both sides of a diff'''
+    if HAS_YAML:
+        return yaml.safe_dump(values, default_flow_style=False)
+    return json.dumps(values, indent=2, sort_keys=True) + '\n'
+
+
+def command_timing(tool, cmd, start, rc=None, out=None, err=None):
+    '''Describe a command run, as an entry of the `timings` result key
+
+    :param str tool: `helm` or `kubectl`
+    :param list cmd: The arguments of the command
+    :param float start: When the command was started
+    :param int rc: Exit code of the command, None if it could not be run
+    '''
+    return {
+        'command': '{} {}'.format(tool, cmd[0]),
+        'args': ' '.join(cmd),
+        'duration': round(time.time() - start, 3),
+        'rc': rc,
+        'stdout_bytes': len(out or ''),
+        'stderr_bytes': len(err or ''),
+    }
+
+
+class Helm(object):
+    '''Manage a Helm release, as described by the `helm_cli` parameters
+
+    :param module: The running `AnsibleModule`, used to run helm
+    :param dict params: The `helm_cli` parameters of the release
+    :param snapshot: A `ReleaseSnapshot` shared with other releases, a new
+        one is created from `params['snapshot']` if not provided
+    '''
+
+    ROLLOUT_KINDS = ('daemonset', 'deployment', 'statefulset')
+
+    def __init__(self, module, params, snapshot=None):
+        self.module = module
+        self.params = params
+        self._merged_values = None
+        # Every helm and kubectl command run, see `command_timing`
+        self.timings = []
+        self._helm_bin = None
+        if snapshot is None:
+            snapshot = ReleaseSnapshot(self, params.get('snapshot'))
+        self.snapshot = snapshot
+
+    def get_chart(self):
+        chart = self.params.get('chart')
+        if chart is None:
+            raise HelmError("'chart' is a mandatory argument for "
+                            "state=present|latest")
+        if 'name' not in chart:
+            raise HelmError("'chart' argument required a 'name' key for "
+                            "state=present|latest")
+        return chart
+
+    @property
+    def helm_bin(self):
+        if self._helm_bin is None:
+            binary = self.params.get('binary')
+            if binary:
+                if os.path.isfile(binary) and os.access(binary, os.X_OK):
+                    self._helm_bin = binary
+                else:
+                    raise HelmError(
+                        "No executable at the specified 'binary' location")
+            else:
+                self._helm_bin = self.module.get_bin_path(
+                    'helm', required=True)
+        return self._helm_bin
+
+    def list_releases(self, release=None):
+        '''Return the releases known by Tiller, indexed by name
+
+        A single `helm list` call (paginated if needed) replaces the
+        `helm status` and `helm get` calls done for each release.
+
+        :param str release: Only list this release (exact match)
+        :returns: The `helm list` entries, as a dict indexed by release name
+        :rtype: dict
+        '''
+        cmd = ['list', '--all', '--output', 'json']
+        if release is not None:
+            cmd.append('^{}$'.format(re.escape(release)))
+
+        releases = {}
+        offset = None
+        while True:
+            rc, out, err = self._run_helm(
+                cmd + (['--offset', offset] if offset else []))
+            # helm prints nothing at all when no release matches
+            if not out.strip():
+                break
+            listing = json.loads(out)
+            for entry in listing.get('Releases') or []:
+                releases[entry['Name']] = entry
+            offset = listing.get('Next')
+            if not offset:
+                break
+        return releases
+
+    def install(self):
+        chart = self.get_chart()
+        release = self.params.get('release')
+        # `path` is a local chart archive, as provided by the chart cache
+        chart_ref = chart.get('path') or chart['name']
+        if release is None:
+            cmd = ['install', chart_ref]
+        else:
+            cmd = ['upgrade', '--install', release, chart_ref]
+        if 'path' not in chart:
+            if 'version' in chart:
+                cmd.extend(['--version', chart['version']])
+            if 'repo' in chart:
+                cmd.extend(['--repo', chart['repo']])
+        namespace = self.params.get('namespace')
+        if namespace:
+            cmd.extend(['--namespace', namespace])
+        timeout = self.params.get('timeout')
+        if timeout is not None:
+            cmd.extend(['--timeout', str(timeout)])
+        if self.params.get('wait'):
+            cmd.extend(['--wait'])
+        values_args, values_data = self.values_args()
+        rc, out, err = self._run_helm(cmd + values_args, data=values_data)
+        return parse_helm_output(
+            out, full=self.params.get('output', 'full') != 'summary')
+
+    def _run_helm(self, cmd, failed_when=lambda rc, out, err: rc != 0,
+                  data=None):
+        # Tunnel to Tiller shared by the run, see the `helm_tunnel` module.
+        # It is given as an argument: `run_command` sets the variables of
+        # `environ_update` in the environment of the whole process, which is
+        # not safe with the concurrent releases of `helm_releases`.
+        helm_host = self.params.get('helm_host')
+        args = [self.helm_bin] + cmd
+        if helm_host:
+            args.extend(['--host', helm_host])
+        start = time.time()
+        try:
+            rc, out, err = self.module.run_command(args, data=data)
+        except Exception as exc:
+            self.timings.append(command_timing('helm', cmd, start))
+            raise HelmError('error running helm {} command: {}'.format(
+                ' '.join(cmd), exc))
+        else:
+            self.timings.append(
+                command_timing('helm', cmd, start, rc, out, err))
+            if failed_when(rc, out, err):
+                raise HelmError(
+                    'Error running helm {} command (rc={}) '
+                    "out='{}' err='{}'".format(' '.join(cmd), rc, out, err))
+        return rc, out, err
+
+    def fingerprint(self):
+        '''Compute a stable fingerprint of the chart and values to deploy
+
+        :returns: A SHA-256 of the chart name, version and repo, and of the
+            merged values, or None if the chart version is not pinned (the
+            deployed chart may then change without any parameter change)
+        :rtype: str
+        '''
+        chart = self.get_chart()
+        if 'version' not in chart:
+            return None
+        content = json.dumps({
+            'chart': chart['name'],
+            'version': str(chart['version']),
+            'repo': chart.get('repo'),
+            'values': self.merged_values(),
+        }, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _release_from_install(self, release, install, fingerprint=None):
+        '''Record a release changed by `install` in the snapshot
+
+        The release entry is invalidated in the snapshot (it will be listed
+        again by the next task needing it) and a partial entry, built from
+        the `helm upgrade` output, is returned.
+        '''
+        self.snapshot.invalidate(release)
+        self.snapshot.set_fingerprint(release, fingerprint)
+        return {
+            'Name': release,
+            'Status': install.get('STATUS'),
+            'Namespace': install.get('NAMESPACE'),
+            'Updated': install.get('LAST DEPLOYED'),
+        }
+
+    def ensure_present(self):
+        release = self.params.get('release')
+        if release:
+            release_status = self.snapshot.get(release)
+        else:
+            release_status = None
+
+        if release_status is None or release_status['Status'] != 'DEPLOYED':
+            fingerprint = self.fingerprint()
+            diff = self.values_diff(release, False) if release else None
+            install = self.install()
+            release_info = self._release_from_install(
+                release or install['NAME'], install, fingerprint)
+            result = {'changed': True,
+                      'release': release_info,
+                      'install': install}
+            if diff is not None:
+                result['diff'] = diff
+            return result
+        else:
+            return {'changed': False,
+                    'release': release_status}
+
+    def install_or_upgrade(self):
+        '''Install or upgrade the release, unless already up-to-date
+
+        The upgrade is skipped when the deployed revision of the release
+        was deployed by `helm_cli` with the same chart and values, as
+        recorded in the snapshot.
+        '''
+        release = self.params.get('release')
+        fingerprint = self.fingerprint()
+        if release and fingerprint is not None:
+            release_status = self.snapshot.get(release)
+            if release_status is not None and \
+                    release_status['Status'] == 'DEPLOYED' and \
+                    self.snapshot.get_fingerprint(release) == fingerprint:
+                return {'changed': False,
+                        'release': release_status,
+                        'fingerprint': fingerprint}
+
+        diff = None
+        if release:
+            release_status = self.snapshot.get(release)
+            deployed = release_status is not None and \
+                release_status['Status'] == 'DEPLOYED'
+            diff = self.values_diff(release, deployed)
+        install = self.install()
+        release_info = self._release_from_install(
+            release or install.get('NAME'), install, fingerprint)
+        result = {'changed': True,
+                  'release': release_info,
+                  'fingerprint': fingerprint}
+        if diff is not None:
+            result['diff'] = diff
+        return result
+
+    def remove(self, purge=False):
+        release = self.params.get('release')
+        if not release:
+            raise HelmError(
+                "'release' is a mandatory argument for state=absent")
+        release_info = self.snapshot.get(release)
+        if release_info is None or \
+                (release_info['Status'] == 'DELETED' and not purge):
+            return {'changed': False,
+                    'release': release_info}
+        else:
+            cmd = ['delete', release]
+            if purge:
+                cmd.append('--purge')
+            timeout = self.params.get('timeout')
+            if timeout is not None:
+                cmd.extend(['--timeout', str(timeout)])
+            self._run_helm(cmd)
+            self.snapshot.invalidate(release)
+            self.snapshot.set_fingerprint(release, None)
+            return {'changed': True,
+                    'release': release_info}
+
+    def with_handle(self, result):
+        '''Add the `handle` of the release, to be waited for by `helm_wait`
+
+        The handle identifies the release and records when it was
+        submitted, to measure its time-to-ready.
+        '''
+        release = result['release'] or {}
+        namespace = release.get('Namespace') or self.params.get('namespace')
+        result['handle'] = {
+            'release': release.get('Name') or self.params.get('release'),
+            'namespace': namespace,
+            'engine': self.params.get('engine') or 'tiller',
+            'submitted': time.time(),
+        }
+        return result
+
+    def release_objects(self, release):
+        '''Return the `(kind, namespace, name)` of the workloads of a release
+
+        Only the kinds with a rollout status (`ROLLOUT_KINDS`) are returned.
+        '''
+        if not HAS_YAML:
+            raise HelmError('PyYAML is required to read release manifests')
+        rc, out, err = self._run_helm(['get', 'manifest', release])
+        release_info = self.snapshot.get(release) or {}
+        default_namespace = release_info.get('Namespace') or \
+            self.params.get('namespace') or 'default'
+        objects = []
+        for document in yaml.safe_load_all(out):
+            if not isinstance(document, dict):
+                continue
+            kind = str(document.get('kind', '')).lower()
+            if kind not in self.ROLLOUT_KINDS:
+                continue
+            metadata = document.get('metadata') or {}
+            objects.append((kind,
+                            metadata.get('namespace') or default_namespace,
+                            metadata['name']))
+        return sorted(objects)
+
+    def refresh_snapshot(self):
+        if not self.params.get('snapshot'):
+            raise HelmError(
+                "'snapshot' is a mandatory argument for state=snapshot")
+        releases = self.snapshot.refresh()
+        return {'changed': False,
+                'releases': sorted(releases)}
+
+    def execute(self):
+        '''Handle the release according to `state`
+
+        The commands run are returned in the `timings` key of the result.
+        '''
+        state = self.params.get('state')
+        if state == 'present':
+            result = self.with_handle(self.ensure_present())
+        elif state == 'latest':
+            result = self.with_handle(self.install_or_upgrade())
+        elif state == 'absent':
+            result = self.remove()
+        elif state == 'purged':
+            result = self.remove(purge=True)
+        elif state == 'snapshot':
+            result = self.refresh_snapshot()
+        else:
+            raise HelmError('state not supported')
+        result['timings'] = self.timings
+        return result
+
+    def merged_values(self):
+        '''Merge the `values` documents, later documents taking precedence
+
+        :rtype: dict
+        '''
+        if self._merged_values is None:
+            merged = {}
+            for document in self.params.get('values') or []:
+                merged = merge_values(merged, load_values(document))
+            self._merged_values = merged
+        return self._merged_values
+
+    def values_args(self):
+        '''Return the helm arguments and standard input passing the values
+
+        The merged values are streamed to helm through its standard input,
+        as a single JSON document, instead of one file per document.
+        '''
+        values = self.merged_values()
+        if not values:
+            return [], None
+        return ['--values', '-'], json.dumps(values, sort_keys=True)
+
+    def deployed_values(self, release):
+        '''Return the values of the deployed release, as a mapping or text'''
+        rc, out, err = self._run_helm(['get', 'values', release])
+        if HAS_YAML:
+            return yaml.safe_load(out) or {}
+        return out
+
+    def values_diff(self, release, deployed):
+        '''Return the diff of the values, if Ansible runs in diff mode
+
+        :param deployed: Whether the release is currently deployed, or its
+            values if already known
+        '''
+        if not self.module._diff:
+            return None
+        if isinstance(deployed, dict):
+            before = deployed
+        else:
+            before = self.deployed_values(release) if deployed else {}
+        if not isinstance(before, dict):
+            before = load_values(before)
+        return {
+            'before_header': '{} (deployed)'.format(release),
+            'after_header': release,
+            'before': dump_values(before),
+            'after': dump_values(self.merged_values()),
+        }
+
+
+class HelmTemplate(Helm):
+    '''Manage a Helm release without Tiller (`engine=template`)
+
+    The chart is rendered locally with `helm template`, and the resulting
+    objects are applied with one `kubectl apply` call per namespace (the one
+    of the release for the objects which do not set one). The release
+    metadata (a `helm list`-like entry, plus the fingerprint of the chart
+    and values and the list of applied objects) is stored in the
+    `helm-release-<name>` ConfigMap of the `kube-system` namespace.
+
+    Objects which are not part of the chart anymore are deleted on upgrade.
+
+    Chart hooks (the `helm.sh/hook` annotation) are not applied as regular
+    objects, nor recorded as such:
+
+    - `crd-install` hooks are applied first, and waited for to be
+      established before the other objects are applied
+    - `pre-install`/`post-install`, or `pre-upgrade`/`post-upgrade` if the
+      release is already deployed, are created, re-created if they exist,
+      before/after the other objects, ordered by `helm.sh/hook-weight`.
+      Jobs are waited for to complete, and deleted afterwards if their
+      `helm.sh/hook-delete-policy` says so
+    - `pre-delete`/`post-delete` hooks are recorded, and run the same way
+      when the release is deleted
+    - test hooks, and rollback hooks, are ignored
+    '''
+
+    RECORD_NAMESPACE = 'kube-system'
+
+    HOOK_ANNOTATION = 'helm.sh/hook'
+    HOOK_WEIGHT_ANNOTATION = 'helm.sh/hook-weight'
+    HOOK_DELETE_POLICY_ANNOTATION = 'helm.sh/hook-delete-policy'
+    DELETE_HOOKS = ('pre-delete', 'post-delete')
+
+    # Default of `helm install --timeout`
+    DEFAULT_TIMEOUT = 300
+
+    def __init__(self, module, params, snapshot=None):
+        super(HelmTemplate, self).__init__(module, params, snapshot)
+        self._kubectl_bin = None
+
+    @property
+    def kubectl_bin(self):
+        if self._kubectl_bin is None:
+            self._kubectl_bin = self.params.get('kubectl') or \
+                self.module.get_bin_path('kubectl', required=True)
+        return self._kubectl_bin
+
+    def _run_kubectl(self, cmd, data=None):
+        args = [self.kubectl_bin] + cmd
+        start = time.time()
+        try:
+            rc, out, err = self.module.run_command(args, data=data)
+        except Exception as exc:
+            self.timings.append(command_timing('kubectl', cmd, start))
+            raise HelmError('error running kubectl {} command: {}'.format(
+                ' '.join(cmd), exc))
+        self.timings.append(
+            command_timing('kubectl', cmd, start, rc, out, err))
+        if rc != 0:
+            raise HelmError(
+                'Error running kubectl {} command (rc={}) '
+                "out='{}' err='{}'".format(' '.join(cmd), rc, out, err))
+        return out
+
+    def get_release(self):
+        release = self.params.get('release')
+        if not release:
+            raise HelmError(
+                "'release' is a mandatory argument for engine=template")
+        return release
+
+    def get_namespace(self):
+        return self.params.get('namespace') or 'default'
+
+    def get_timeout(self):
+        timeout = self.params.get('timeout')
+        return self.DEFAULT_TIMEOUT if timeout is None else timeout
+
+    def object_namespace(self, obj):
+        '''The namespace an object is applied in'''
+        return (obj.get('metadata') or {}).get('namespace') or \
+            self.get_namespace()
+
+    def read_record(self, release):
+        out = self._run_kubectl([
+            'get', 'configmap', 'helm-release-{}'.format(release),
+            '--namespace', self.RECORD_NAMESPACE,
+            '--ignore-not-found', '--output', 'json',
+        ])
+        if not out.strip():
+            return None
+        return json.loads(json.loads(out)['data']['release'])
+
+    def write_record(self, release, record):
+        configmap = {
+            'apiVersion': 'v1',
+            'kind': 'ConfigMap',
+            'metadata': {
+                'name': 'helm-release-{}'.format(release),
+                'namespace': self.RECORD_NAMESPACE,
+                'labels': {
+                    'app.kubernetes.io/managed-by': 'metalk8s-helm-cli',
+                    'release': release,
+                },
+            },
+            'data': {'release': json.dumps(record, sort_keys=True)},
+        }
+        self._run_kubectl(['apply', '--filename', '-'],
+                          data=json.dumps(configmap))
+
+    def delete_record(self, release):
+        self._run_kubectl([
+            'delete', 'configmap', 'helm-release-{}'.format(release),
+            '--namespace', self.RECORD_NAMESPACE, '--ignore-not-found',
+        ])
+
+    @staticmethod
+    def record_objects(record):
+        '''The `(namespace, kind/name)` of the objects of a record
+
+        Objects recorded as a bare `kind/name` belong to the namespace of
+        the release.
+        '''
+        if not record:
+            return []
+        return sorted(
+            tuple(obj) if isinstance(obj, list)
+            else (record['Namespace'], obj)
+            for obj in record.get('Objects', []))
+
+    @contextmanager
+    def chart_archive(self):
+        '''Provide a local archive of the chart, fetching it if needed'''
+        chart = self.get_chart()
+        if 'path' in chart:
+            yield chart['path']
+            return
+
+        cmd = ['fetch', chart['name']]
+        if 'version' in chart:
+            cmd.extend(['--version', chart['version']])
+        if 'repo' in chart:
+            cmd.extend(['--repo', chart['repo']])
+        tempdir = mkdtemp(prefix='ansible.helm.chart.')
+        try:
+            self._run_helm(cmd + ['--destination', tempdir])
+            archives = glob.glob(os.path.join(tempdir, '*.tgz'))
+            if len(archives) != 1:
+                raise HelmError('Cannot fetch chart {}'.format(chart['name']))
+            yield archives[0]
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    def render(self, release):
+        '''Render the chart, return its objects'''
+        if not HAS_YAML:
+            raise HelmError('PyYAML is required by engine=template')
+        cmd = ['template', '--name', release,
+               '--namespace', self.get_namespace()]
+        values_args, values_data = self.values_args()
+        with self.chart_archive() as archive:
+            rc, out, err = self._run_helm(cmd + values_args + [archive],
+                                          data=values_data)
+        objects = []
+        try:
+            # Templates may all be disabled by the values
+            for document in yaml.safe_load_all(out):
+                if not document:
+                    continue
+                if not isinstance(document, dict):
+                    raise HelmError(
+                        'The chart renders a {} instead of an object'.format(
+                            type(document).__name__))
+                if str(document.get('kind', '')).endswith('List'):
+                    objects.extend(document.get('items') or [])
+                else:
+                    objects.append(document)
+        except yaml.YAMLError as exc:
+            raise HelmError('Invalid manifest rendered: {}'.format(exc))
+        return objects
+
+    def split_hooks(self, objects):
+        '''Split the rendered objects from the hooks
+
+        :returns: The regular objects, and the hooks indexed by event, each
+            list sorted by weight
+        '''
+        regular = []
+        hooks = {}
+        for obj in objects:
+            annotations = (obj.get('metadata') or {}).get('annotations') or {}
+            events = annotations.get(self.HOOK_ANNOTATION)
+            if not events:
+                regular.append(obj)
+                continue
+            for event in events.split(','):
+                hooks.setdefault(event.strip(), []).append(obj)
+
+        def weight(obj):
+            annotations = obj['metadata'].get('annotations') or {}
+            try:
+                weight = int(annotations.get(self.HOOK_WEIGHT_ANNOTATION, 0))
+            except ValueError:
+                weight = 0
+            return (weight, obj.get('kind'), obj['metadata'].get('name'))
+
+        for event_hooks in hooks.values():
+            event_hooks.sort(key=weight)
+        return regular, hooks
+
+    def ensure_namespace(self):
+        self._run_kubectl(['apply', '--filename', '-'], data=json.dumps({
+            'apiVersion': 'v1',
+            'kind': 'Namespace',
+            'metadata': {'name': self.get_namespace()},
+        }))
+
+    def apply(self, objects):
+        '''Apply objects, return their `(namespace, kind/name)` list'''
+        by_namespace = {}
+        for obj in objects:
+            by_namespace.setdefault(
+                self.object_namespace(obj), []).append(obj)
+        applied = set()
+        for namespace, namespace_objects in sorted(by_namespace.items()):
+            out = self._run_kubectl(
+                ['apply', '--namespace', namespace, '--filename', '-',
+                 '--output', 'name'],
+                data=json.dumps({'apiVersion': 'v1', 'kind': 'List',
+                                 'items': namespace_objects}))
+            applied.update((namespace, name) for name in out.split())
+        return sorted(applied)
+
+    def wait_established(self, definitions):
+        '''Wait for CustomResourceDefinitions to be established'''
+        if not definitions:
+            return
+        cmd = ['wait', '--for=condition=established',
+               '--timeout={}s'.format(self.get_timeout())]
+        cmd.extend('customresourcedefinition/{}'.format(
+            obj['metadata']['name']) for obj in definitions)
+        self._run_kubectl(cmd)
+
+    def run_hooks(self, hooks):
+        '''Create hooks one after the other, waiting for their Jobs
+
+        Hooks which already exist, e.g. Jobs of a previous run, are deleted
+        first.
+        '''
+        for hook in hooks:
+            namespace = self.object_namespace(hook)
+            data = json.dumps(hook)
+            annotations = hook['metadata'].get('annotations') or {}
+            policies = [policy.strip() for policy in annotations.get(
+                self.HOOK_DELETE_POLICY_ANNOTATION, '').split(',')]
+
+            self._run_kubectl(['delete', '--namespace', namespace,
+                               '--filename', '-', '--ignore-not-found'],
+                              data=data)
+            name = self._run_kubectl(['create', '--namespace', namespace,
+                                      '--filename', '-', '--output', 'name'],
+                                     data=data).strip()
+            if hook.get('kind') != 'Job':
+                continue
+            try:
+                self._run_kubectl(
+                    ['wait', '--namespace', namespace,
+                     '--for=condition=complete',
+                     '--timeout={}s'.format(self.get_timeout()), name])
+            except HelmError as exc:
+                if 'hook-failed' in policies:
+                    self.delete_objects([(namespace, name)])
+                raise HelmError('Hook {} failed: {}'.format(
+                    name, exc.args[0]))
+            if 'hook-succeeded' in policies:
+                self.delete_objects([(namespace, name)])
+
+    def delete_objects(self, objects):
+        '''Delete objects, given as `(namespace, kind/name)`'''
+        by_namespace = {}
+        for namespace, name in objects:
+            by_namespace.setdefault(namespace, []).append(name)
+        for namespace, names in sorted(by_namespace.items()):
+            self._run_kubectl(
+                ['delete', '--namespace', namespace,
+                 '--ignore-not-found'] + sorted(names))
+
+    def wait_rollout(self, objects):
+        cmd = ['rollout', 'status']
+        timeout = self.params.get('timeout')
+        if timeout is not None:
+            cmd.append('--timeout={}s'.format(timeout))
+        for namespace, name in objects:
+            if name.split('/', 1)[0].split('.', 1)[0] in self.ROLLOUT_KINDS:
+                self._run_kubectl(cmd + ['--namespace', namespace, name])
+
+    def deploy(self, release, record, fingerprint):
+        deployed = record is not None and record['Status'] == 'DEPLOYED'
+        diff = self.values_diff(
+            release, record.get('Values', {}) if deployed else False)
+        objects, hooks = self.split_hooks(self.render(release))
+        event = 'upgrade' if deployed else 'install'
+
+        self.ensure_namespace()
+        definitions = hooks.get('crd-install', [])
+        if definitions:
+            self.apply(definitions)
+            self.wait_established(definitions)
+        self.run_hooks(hooks.get('pre-' + event, []))
+        applied = self.apply(objects) if objects else []
+        pruned = sorted(set(self.record_objects(record)) - set(applied))
+        self.delete_objects(pruned)
+        if self.params.get('wait'):
+            self.wait_rollout(applied)
+        self.run_hooks(hooks.get('post-' + event, []))
+
+        chart = self.get_chart()
+        new_record = {
+            'Name': release,
+            'Revision': (record['Revision'] + 1) if record else 1,
+            'Updated': time.strftime('%a %b %d %H:%M:%S %Y'),
+            'Status': 'DEPLOYED',
+            'Chart': '{}-{}'.format(chart['name'], chart['version'])
+            if 'version' in chart else chart['name'],
+            'Namespace': self.get_namespace(),
+            'Fingerprint': fingerprint,
+            'Objects': [list(obj) for obj in applied],
+            'Hooks': dict((event, event_hooks)
+                          for event, event_hooks in hooks.items()
+                          if event in self.DELETE_HOOKS),
+            'Values': self.merged_values(),
+        }
+        self.write_record(release, new_record)
+        result = {'changed': True,
+                  'release': new_record,
+                  'pruned': ['/'.join(obj) for obj in pruned],
+                  'fingerprint': fingerprint}
+        if diff is not None:
+            result['diff'] = diff
+        return result
+
+    def ensure_present(self):
+        release = self.get_release()
+        record = self.read_record(release)
+        if record is not None and record['Status'] == 'DEPLOYED':
+            return {'changed': False, 'release': record}
+        return self.deploy(release, record, self.fingerprint())
+
+    def install_or_upgrade(self):
+        release = self.get_release()
+        record = self.read_record(release)
+        fingerprint = self.fingerprint()
+        if record is not None and record['Status'] == 'DEPLOYED' and \
+                fingerprint is not None and \
+                record.get('Fingerprint') == fingerprint:
+            return {'changed': False,
+                    'release': record,
+                    'fingerprint': fingerprint}
+        return self.deploy(release, record, fingerprint)
+
+    def remove(self, purge=False):
+        release = self.get_release()
+        record = self.read_record(release)
+        if record is None or (record['Status'] == 'DELETED' and not purge):
+            return {'changed': False, 'release': record}
+
+        hooks = record.get('Hooks') or {}
+        if record['Status'] == 'DEPLOYED':
+            self.run_hooks(hooks.get('pre-delete', []))
+        self.delete_objects(self.record_objects(record))
+        if record['Status'] == 'DEPLOYED':
+            self.run_hooks(hooks.get('post-delete', []))
+        if purge:
+            self.delete_record(release)
+        else:
+            record = dict(record, Status='DELETED', Objects=[])
+            self.write_record(release, record)
+        return {'changed': True, 'release': record}
+
+    def release_objects(self, release):
+        objects = []
+        for namespace, obj in self.record_objects(self.read_record(release)):
+            kind, name = obj.split('/', 1)
+            kind = kind.split('.', 1)[0]
+            if kind in self.ROLLOUT_KINDS:
+                objects.append((kind, namespace, name))
+        return sorted(objects)
+
+    def refresh_snapshot(self):
+        raise HelmError('state=snapshot is not supported by engine=template')
+
+
+def helm_engine(module, params, snapshot=None):
+    '''Return the `Helm` implementation matching `params['engine']`'''
+    engine = params.get('engine') or 'tiller'
+    if engine == 'tiller':
+        return Helm(module, params, snapshot=snapshot)
+    elif engine == 'template':
+        return HelmTemplate(module, params, snapshot=snapshot)
+    raise HelmError('engine {} not supported'.format(engine))
+
+
+class ReleaseSnapshot(object):
+    '''Release-state snapshot shared by every `helm_cli` task of a run
+
+    Without a `path`, the snapshot only lives for the current module
+    invocation and each release is listed on demand.
+
+    With a `path`, the whole `helm list` output is fetched once, stored in
+    this file and reused by the following `helm_cli` tasks. A release
+    changed by a task is invalidated: it will be listed again the next time
+    it is needed. `state=snapshot` forces a full refresh, which should be
+    done once at the beginning of each run.
+
+    The snapshot file also keeps, across refreshes, the fingerprint of the
+    chart and values last deployed by `helm_cli` for each release, along
+    with the release revision it was deployed as.
+    '''
+
+    def __init__(self, helm, path=None):
+        self.helm = helm
+        self.path = path
+        self._releases = None
+        # Without a complete listing, only the releases in `_listed` are
+        # known (either found in `_releases` or absent)
+        self._complete = False
+        self._listed = set()
+        self._stale = set()
+        self._fingerprints = None
+        self._lock = threading.RLock()
+
+    def _read(self):
+        if not self.path:
+            return None
+        try:
+            with open(self.path) as snapshot_file:
+                return json.load(snapshot_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _load(self):
+        if self._releases is not None:
+            return
+        snapshot = self._read()
+        if snapshot is None:
+            self._releases = {}
+            self._fingerprints = {}
+            if self.path:
+                self.refresh()
+        else:
+            self._releases = snapshot.get('releases', {})
+            self._stale = set(snapshot.get('stale', []))
+            self._fingerprints = snapshot.get('fingerprints', {})
+            self._complete = True
+
+    def _save(self):
+        if not self.path:
+            return
+        temp = NamedTemporaryFile(
+            mode='w',
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.helm.snapshot.',
+            delete=False,
+        )
+        try:
+            json.dump({'releases': self._releases,
+                       'stale': sorted(self._stale),
+                       'fingerprints': self._fingerprints}, temp)
+            temp.close()
+            os.rename(temp.name, self.path)
+        except Exception:
+            os.remove(temp.name)
+            raise
+
+    def refresh(self):
+        '''List all the releases and store them as the new snapshot'''
+        with self._lock:
+            if self._fingerprints is None:
+                snapshot = self._read() or {}
+                self._fingerprints = snapshot.get('fingerprints', {})
+            self._releases = self.helm.list_releases()
+            self._stale = set()
+            self._complete = True
+            self._save()
+            return self._releases
+
+    def get(self, release):
+        '''Return the `helm list` entry of `release`, None if not found'''
+        with self._lock:
+            self._load()
+            if release in self._stale or \
+                    not (self._complete or release in self._listed):
+                entry = self.helm.list_releases(release).get(release)
+                self._releases.pop(release, None)
+                if entry is not None:
+                    self._releases[release] = entry
+                self._listed.add(release)
+                self._stale.discard(release)
+                self._save()
+            return self._releases.get(release)
+
+    def invalidate(self, release):
+        '''Mark `release` as changed since it was last listed'''
+        with self._lock:
+            self._load()
+            self._releases.pop(release, None)
+            self._stale.add(release)
+            self._save()
+
+    def get_fingerprint(self, release):
+        '''Return the fingerprint of the deployed revision of `release`
+
+        :returns: The fingerprint, or None if unknown or if the release was
+            changed (e.g. upgraded manually) since it was recorded
+        :rtype: str
+        '''
+        with self._lock:
+            entry = self.get(release)
+            recorded = self._fingerprints.get(release)
+            if entry is None or recorded is None:
+                return None
+            if recorded['revision'] is None:
+                # First listing since `helm_cli` deployed it
+                recorded['revision'] = entry['Revision']
+                self._save()
+            if recorded['revision'] != entry['Revision']:
+                return None
+            return recorded['fingerprint']
+
+    def set_fingerprint(self, release, fingerprint):
+        '''Record the fingerprint of a release just deployed (or deleted)'''
+        with self._lock:
+            self._load()
+            if fingerprint is None:
+                self._fingerprints.pop(release, None)
+            else:
+                # The revision is unknown until the release is listed again
+                self._fingerprints[release] = {
+                    'fingerprint': fingerprint,
+                    'revision': None,
+                }
+            self._save()
+
+
+class HelmError(Exception):
+    """Error from Helm modules"""
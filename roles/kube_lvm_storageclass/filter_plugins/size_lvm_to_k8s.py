@@ -1,9 +1,45 @@
+import imp
+import os
+
+from ansible.errors import AnsibleFilterError
+
+
+# The LVM sizes are shared with the `plan_lvm_lvs` action, see the
+# `metalk8s_lvm_size` module_utils of the `setup_lvm_lv` role
+metalk8s_lvm_size = imp.load_source('metalk8s_lvm_size', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+    'setup_lvm_lv', 'module_utils', 'metalk8s_lvm_size.py'))
+
+K8S_SUFFIXES = [
+    ('Ei', 1024 ** 6),
+    ('Pi', 1024 ** 5),
+    ('Ti', 1024 ** 4),
+    ('Gi', 1024 ** 3),
+    ('Mi', 1024 ** 2),
+    ('Ki', 1024),
+]
+
+
 def size_lvm_to_k8s(lvm_size):
+    '''Exact Kubernetes quantity of an LVM size, e.g. `1.5g` is `1536Mi`
+
+    Sizes are in MiB by default, as for lvcreate(8). Sizes relative to a VG
+    (e.g. `50%FREE`) are not supported: use the `exact_size` of the LVs
+    planned by the `setup_lvm_lv` role.
+    '''
     try:
-        return int(lvm_size)
-    except ValueError:
-        if not lvm_size.lower().endswith('b'):
-            return lvm_size + 'i'
+        size = metalk8s_lvm_size.size_in_bytes(lvm_size)
+    except metalk8s_lvm_size.SizeError:
+        size = None
+    if size is None:
+        raise AnsibleFilterError(
+            'Cannot convert the LVM size {!r} to a Kubernetes quantity'
+            .format(lvm_size))
+
+    for suffix, factor in K8S_SUFFIXES:
+        if size and size % factor == 0:
+            return '{}{}'.format(size // factor, suffix)
+    return str(size)
 
 
 class FilterModule(object):
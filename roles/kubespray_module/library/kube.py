@@ -1 +0,0 @@
-../../../vendor/kubespray/library/kube.py
\ No newline at end of file
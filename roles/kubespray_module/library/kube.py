@@ -0,0 +1,1252 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import base64
+import json
+import os
+import socket
+import ssl
+import tempfile
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.six import string_types
+from ansible.module_utils.six.moves import http_client
+from ansible.module_utils.six.moves.urllib.parse import urlencode
+from ansible.module_utils.six.moves.urllib.parse import urlparse
+
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
+
+DOCUMENTATION = """
+---
+module: kube
+short_description: Manage Kubernetes Cluster
+description:
+  - Create, replace, remove, and stop resources within a Kubernetes Cluster
+version_added: "2.0"
+options:
+  name:
+    required: false
+    default: null
+    description:
+      - The name associated with resource
+  filename:
+    required: false
+    default: null
+    description:
+      - The path and filename of the resource(s) definition file(s).
+      - To operate on several files this can accept a comma separated list
+        of files or a list of files.
+      - Directories are accepted too, all the files of a list or directory
+        being applied in a single kubectl call.
+    aliases: [ 'files', 'file', 'filenames' ]
+  recursive:
+    required: false
+    default: false
+    description:
+      - Process the directories given in I(filename) recursively.
+  engine:
+    required: false
+    choices: ['kubectl', 'native']
+    default: kubectl
+    description:
+      - C(kubectl) runs a kubectl command per operation.
+      - C(native) sends the requests to the API server directly, on a single
+        keep-alive connection, with the credentials of I(kubeconfig). The
+        operations keep the semantics of the matching kubectl commands;
+        anything not supported natively (unknown resource types, C(stopped),
+        authentication plugins...) falls back to kubectl.
+  kubeconfig:
+    required: false
+    default: null
+    description:
+      - The kubeconfig file used by the C(native) engine, defaults to
+        C($KUBECONFIG) or C(~/.kube/config), like kubectl. I(server), if set,
+        overrides its server.
+  kubectl:
+    required: false
+    default: null
+    description:
+      - The path to the kubectl bin
+  namespace:
+    required: false
+    default: null
+    description:
+      - The namespace associated with the resource(s)
+  resource:
+    required: false
+    default: null
+    description:
+      - The resource to perform an action on. pods (po),
+        replicationControllers (rc), services (svc)
+  label:
+    required: false
+    default: null
+    description:
+      - The labels used to filter specific resources.
+  server:
+    required: false
+    default: null
+    description:
+      - The url for the API server that commands are executed against.
+  force:
+    required: false
+    default: false
+    description:
+      - A flag to indicate to force delete, replace, or stop.
+  all:
+    required: false
+    default: false
+    description:
+      - A flag to indicate delete all, stop all, or all namespaces when
+        checking exists.
+  log_level:
+    required: false
+    default: 0
+    description:
+      - Indicates the level of verbosity of logging by kubectl.
+  state:
+    required: false
+    choices: ['present', 'absent', 'latest', 'reloaded', 'stopped']
+    default: present
+    description:
+      - present handles checking existence or creating if definition file
+        provided,
+        absent handles deleting resource(s) based on other options,
+        latest handles creating or updating based on existence,
+        reloaded handles updating resource(s) definition using definition file,
+        stopped handles stopping resource(s) based on other options.
+requirements:
+  - kubectl
+author: "Kenny Jones (@kenjones-cisco)"
+"""
+
+EXAMPLES = """
+- name: test nginx is present
+  kube: name=nginx resource=rc state=present
+
+- name: test nginx is stopped
+  kube: name=nginx resource=rc state=stopped
+
+- name: test nginx is absent
+  kube: name=nginx resource=rc state=absent
+
+- name: test nginx is present
+  kube: filename=/tmp/nginx.yml
+
+- name: test nginx and postgresql are present
+  kube: files=/tmp/nginx.yml,/tmp/postgresql.yml
+
+- name: test nginx and postgresql are present
+  kube:
+    files:
+      - /tmp/nginx.yml
+      - /tmp/postgresql.yml
+
+- name: test all the manifests of a directory are up-to-date
+  kube:
+    filename: /tmp/manifests
+    recursive: true
+    state: latest
+"""
+
+RETURN = """
+objects:
+  description:
+    - Objects applied, by outcome, for the states applying definition files
+      (C(present), C(latest) and C(reloaded)).
+  returned: success
+  type: dict
+  sample:
+    created: ['persistentvolume/node1-pv-4c4f']
+    configured: []
+    unchanged: ['storageclass.storage.k8s.io/local-lvm']
+differences:
+  description:
+    - Objects of the definition files which differed from the live ones, and
+      were thus applied, with the paths of the differing fields (C(absent)
+      for objects which did not exist). Objects which do not differ are not
+      written at all.
+  returned: success
+  type: list
+  sample:
+    - object: 'persistentvolume/node1-pv-4c4f'
+      fields: ['spec.capacity.storage']
+    - object: 'storageclass.storage.k8s.io/local-lvm'
+      absent: true
+"""
+
+
+class KubeManager(object):
+
+    def __init__(self, module):
+
+        self.module = module
+
+        self.kubectl = module.params.get('kubectl')
+        if self.kubectl is None:
+            self.kubectl = module.get_bin_path('kubectl', True)
+        self.base_cmd = [self.kubectl]
+
+        if module.params.get('server'):
+            self.base_cmd.append('--server=' + module.params.get('server'))
+
+        if module.params.get('kubeconfig'):
+            self.base_cmd.append(
+                '--kubeconfig=' + module.params.get('kubeconfig'))
+
+        if module.params.get('log_level'):
+            self.base_cmd.append('--v=' + str(module.params.get('log_level')))
+
+        if module.params.get('namespace'):
+            self.base_cmd.append(
+                '--namespace=' + module.params.get('namespace'))
+
+        self.all = module.params.get('all')
+        self.force = module.params.get('force')
+        self.name = module.params.get('name')
+        self.filename = [
+            f.strip() for f in module.params.get('filename') or []]
+        self.resource = module.params.get('resource')
+        self.label = module.params.get('label')
+        self.recursive = module.params.get('recursive')
+        # Objects which differed from the live ones, see `_apply_changed`
+        self.differences = []
+        # Every kubectl command run, returned as the `timings` result key
+        self.timings = []
+
+    def _run(self, cmd):
+        args = self.base_cmd + cmd
+        start = time.time()
+        rc, out, err = None, None, None
+        try:
+            rc, out, err = self.module.run_command(args)
+        finally:
+            self.timings.append({
+                'command': 'kubectl %s' % cmd[0],
+                'args': ' '.join(cmd),
+                'duration': round(time.time() - start, 3),
+                'rc': rc,
+                'stdout_bytes': len(out or ''),
+                'stderr_bytes': len(err or ''),
+            })
+        return rc, out, err
+
+    def _execute(self, cmd):
+        args = self.base_cmd + cmd
+        try:
+            rc, out, err = self._run(cmd)
+        except Exception as exc:
+            self.module.fail_json(
+                msg='error running kubectl (%s) command: %s' % (
+                    ' '.join(args), str(exc)),
+                timings=self.timings)
+        if rc != 0:
+            self.module.fail_json(
+                msg='error running kubectl (%s) command (rc=%d), '
+                    'out=\'%s\', err=\'%s\'' % (' '.join(args), rc, out, err),
+                timings=self.timings)
+        return out.splitlines()
+
+    def _filename_args(self):
+        args = ['--filename=' + ','.join(self.filename)]
+        if self.recursive:
+            args.append('--recursive')
+        return args
+
+    def _execute_nofail(self, cmd):
+        rc, out, err = self._run(cmd)
+        if rc != 0:
+            return None
+        return out.splitlines()
+
+    def _files(self):
+        files = []
+        for path in self.filename:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    files.extend(
+                        os.path.join(dirpath, filename)
+                        for filename in sorted(filenames)
+                        if filename.endswith(('.yml', '.yaml', '.json')))
+                    if not self.recursive:
+                        break
+            else:
+                files.append(path)
+        return files
+
+    def _manifests(self):
+        """The objects of the definition files, None if they cannot be read
+
+        The module fails if a document is not a Kubernetes object.
+        """
+        if not HAS_YAML:
+            return None
+        objects = []
+        try:
+            for path in self._files():
+                with open(path) as manifest:
+                    documents = list(yaml.safe_load_all(manifest))
+                for index, document in enumerate(documents):
+                    if document is None:
+                        continue
+                    items = [document]
+                    if isinstance(document, dict) and \
+                            str(document.get('kind', '')).endswith('List'):
+                        items = document.get('items') or []
+                    if not isinstance(items, list):
+                        items = [items]
+                    for obj in items:
+                        error = object_error(obj)
+                        if error:
+                            self.module.fail_json(
+                                msg='invalid document %d of %s: %s' % (
+                                    index + 1, path, error),
+                                timings=self.timings)
+                        objects.append(obj)
+        except (IOError, OSError, yaml.YAMLError):
+            return None
+        return objects
+
+    def _live_objects(self):
+        """Read the live objects of the definition files in one request
+
+        None is returned if they cannot be read, e.g. when the files define
+        custom resources along with their definition.
+        """
+        args = ['get'] + self._filename_args()
+        args.extend(['--ignore-not-found', '--output=json'])
+        lines = self._execute_nofail(args)
+        if lines is None:
+            return None
+        if not lines:
+            return []
+        live = json.loads('\n'.join(lines))
+        return live.get('items', []) if live.get('kind') == 'List' \
+            else [live]
+
+    def _apply_changed(self, force):
+        """Apply only the objects which differ from the live ones
+
+        The live objects are read in one request, and compared with the
+        definitions (see `object_diff`). The differences are recorded in
+        `self.differences`.
+        """
+        desired = self._manifests()
+        live_objects = self._live_objects() if desired is not None else None
+        if live_objects is None:
+            return self._apply_files(self._filename_args(), force)
+
+        live_by_name = {}
+        for obj in live_objects:
+            key = (obj['kind'], obj['metadata']['name'])
+            live_by_name.setdefault(key, []).append(obj)
+
+        result = []
+        changed = []
+        for obj in desired:
+            metadata = obj['metadata']
+            namespace = metadata.get('namespace') or \
+                self.module.params.get('namespace') or 'default'
+            live = None
+            for candidate in live_by_name.get(
+                    (obj['kind'], metadata['name']), []):
+                if candidate['metadata'].get('namespace') in (None, namespace):
+                    live = candidate
+            name = display_name(obj)
+            if live is None:
+                self.differences.append({'object': name, 'absent': True})
+                changed.append(obj)
+                continue
+            fields = object_diff(obj, live, last_applied(live))
+            if fields:
+                self.differences.append({'object': name, 'fields': fields})
+                changed.append(obj)
+            else:
+                result.append('%s unchanged' % name)
+
+        if changed:
+            fd, path = tempfile.mkstemp(prefix='ansible.kube.', suffix='.json')
+            with os.fdopen(fd, 'w') as manifest:
+                json.dump({'apiVersion': 'v1', 'kind': 'List',
+                           'items': changed}, manifest)
+            self.module.add_cleanup_file(path)
+            result.extend(self._apply_files(['--filename=' + path], force))
+        return result
+
+    def _apply_files(self, filename_args, force):
+        cmd = ['apply']
+
+        if force:
+            cmd.append('--force')
+
+        cmd.extend(filename_args)
+
+        return self._execute(cmd)
+
+    def create(self, check=True, force=True):
+        if check and self.exists():
+            return []
+
+        if not self.filename:
+            self.module.fail_json(msg='filename required to create')
+
+        return self._apply_changed(force)
+
+    def replace(self, force=True):
+
+        if not self.filename:
+            self.module.fail_json(msg='filename required to reload')
+
+        return self._apply_changed(force)
+
+    def inplace_replace(self, force=True):
+        cmd = ['replace']
+
+        if force:
+            cmd.append('--force')
+
+        if not self.filename:
+            self.module.fail_json(msg='filename required to inplace-replace')
+
+        cmd.extend(self._filename_args())
+
+        return self._execute(cmd)
+
+    def delete(self):
+
+        if not self.force and not self.exists():
+            return []
+
+        cmd = ['delete']
+
+        if self.filename:
+            cmd.extend(self._filename_args())
+        else:
+            if not self.resource:
+                self.module.fail_json(
+                    msg='resource required to delete without filename')
+
+            cmd.append(self.resource)
+
+            if self.name:
+                cmd.append(self.name)
+
+            if self.label:
+                cmd.append('--selector=' + self.label)
+
+            if self.all:
+                cmd.append('--all')
+
+            if self.force:
+                cmd.append('--ignore-not-found')
+
+        return self._execute(cmd)
+
+    def exists(self):
+        cmd = ['get']
+
+        if self.filename:
+            cmd.extend(self._filename_args())
+        else:
+            if not self.resource:
+                self.module.fail_json(msg='resource required without filename')
+
+            cmd.append(self.resource)
+
+            if self.name:
+                cmd.append(self.name)
+
+            if self.label:
+                cmd.append('--selector=' + self.label)
+
+            if self.all:
+                cmd.append('--all-namespaces')
+
+        cmd.append('--no-headers')
+
+        result = self._execute_nofail(cmd)
+        if not result:
+            return False
+        return True
+
+    # TODO: This is currently unused, perhaps convert to 'scale' with a
+    # replicas param?
+    def stop(self):
+
+        if not self.force and not self.exists():
+            return []
+
+        cmd = ['stop']
+
+        if self.filename:
+            cmd.extend(self._filename_args())
+        else:
+            if not self.resource:
+                self.module.fail_json(
+                    msg='resource required to stop without filename')
+
+            cmd.append(self.resource)
+
+            if self.name:
+                cmd.append(self.name)
+
+            if self.label:
+                cmd.append('--selector=' + self.label)
+
+            if self.all:
+                cmd.append('--all')
+
+            if self.force:
+                cmd.append('--ignore-not-found')
+
+        return self._execute(cmd)
+
+
+class NativeUnsupported(Exception):
+    """Operation the native engine cannot handle, kubectl is used instead"""
+
+
+class KubeApiError(Exception):
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        try:
+            message = json.loads(body).get('message', body)
+        except ValueError:
+            message = body
+        super(KubeApiError, self).__init__(
+            'API server error (%d): %s' % (status, message))
+
+
+class KubeApiClient(object):
+    """Minimal Kubernetes API client, on one keep-alive connection
+
+    The connection is opened on the first request and reused for all the
+    following ones, saving a TLS handshake per request. Credentials are read
+    from a kubeconfig file, as kubectl would.
+    """
+
+    def __init__(self, module, server=None, kubeconfig=None):
+        self.module = module
+        self.timings = []
+        self.headers = {'Accept': 'application/json'}
+        self.ssl_context = None
+        self._connection = None
+        self._discovery = {}
+
+        config = self._load_kubeconfig(kubeconfig)
+        if config is not None:
+            self._configure(config)
+        elif not server:
+            raise NativeUnsupported('no kubeconfig found')
+        if server:
+            self.server = server
+
+        url = urlparse(self.server)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.prefix = url.path.rstrip('/')
+
+    def _load_kubeconfig(self, path):
+        path = path or os.environ.get('KUBECONFIG', '').split(':')[0] or \
+            os.path.expanduser('~/.kube/config')
+        if not os.path.isfile(path):
+            return None
+        if not HAS_YAML:
+            raise NativeUnsupported('PyYAML is required to read %s' % path)
+        with open(path) as config_file:
+            config = yaml.safe_load(config_file)
+        config['_dir'] = os.path.dirname(os.path.abspath(path))
+        return config
+
+    def _file(self, config, item, key):
+        """Path of a file of the kubeconfig, given as path or inline data"""
+        if item.get(key + '-data'):
+            fd, path = tempfile.mkstemp(prefix='ansible.kube.')
+            with os.fdopen(fd, 'wb') as data_file:
+                data_file.write(base64.b64decode(item[key + '-data']))
+            self.module.add_cleanup_file(path)
+            return path
+        if item.get(key):
+            return os.path.join(config['_dir'], item[key])
+        return None
+
+    def _configure(self, config):
+        def named(section, name):
+            for item in config.get(section) or []:
+                if item['name'] == name:
+                    return item[section[:-1]]
+            return {}
+
+        context = named('contexts', config.get('current-context'))
+        cluster = named('clusters', context.get('cluster'))
+        user = named('users', context.get('user'))
+        if 'exec' in user or 'auth-provider' in user:
+            raise NativeUnsupported('unsupported kubeconfig authentication')
+
+        self.server = cluster.get('server', 'http://localhost:8080')
+        if self.server.startswith('https'):
+            self.ssl_context = ssl.create_default_context(
+                cafile=self._file(config, cluster, 'certificate-authority'))
+            if cluster.get('insecure-skip-tls-verify'):
+                self.ssl_context.check_hostname = False
+                self.ssl_context.verify_mode = ssl.CERT_NONE
+            certfile = self._file(config, user, 'client-certificate')
+            if certfile:
+                self.ssl_context.load_cert_chain(
+                    certfile, self._file(config, user, 'client-key'))
+
+        if user.get('token'):
+            self.headers['Authorization'] = 'Bearer %s' % user['token']
+        elif user.get('username'):
+            credentials = '%s:%s' % (user['username'], user.get('password'))
+            self.headers['Authorization'] = 'Basic %s' % base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return http_client.HTTPSConnection(
+                self.host, self.port, context=self.ssl_context, timeout=60)
+        return http_client.HTTPConnection(self.host, self.port, timeout=60)
+
+    def request(self, method, path, body=None, content_type=None,
+                query=None):
+        """Send a request, return the decoded JSON response
+
+        :raises: KubeApiError for non-2xx responses
+        """
+        url = self.prefix + path
+        if query:
+            url += '?' + urlencode(query)
+        headers = dict(self.headers)
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = content_type or 'application/json'
+
+        start = time.time()
+        status, data = None, b''
+        try:
+            # A kept-alive connection may have been closed by the server in
+            # between, retry once on a new connection
+            for attempt in (1, 2):
+                if self._connection is None:
+                    self._connection = self._connect()
+                try:
+                    self._connection.request(method, url, body, headers)
+                    response = self._connection.getresponse()
+                    data = response.read()
+                    status = response.status
+                    break
+                except (http_client.HTTPException, socket.error):
+                    self._connection.close()
+                    self._connection = None
+                    if attempt == 2:
+                        raise
+        finally:
+            self.timings.append({
+                'command': 'kube-api %s' % method,
+                'args': url,
+                'duration': round(time.time() - start, 3),
+                'rc': status,
+                # `rc` is the HTTP status of the request, None on a
+                # connection error
+                'failed': status is None or not 200 <= status < 300,
+                'stdout_bytes': len(data),
+                'stderr_bytes': 0,
+            })
+
+        data = data.decode('utf-8')
+        if not 200 <= status < 300:
+            raise KubeApiError(status, data)
+        return json.loads(data) if data else {}
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def api_resources(self, group_version):
+        """Resources of an API group version, from the discovery API"""
+        if group_version not in self._discovery:
+            path = '/api/v1' if group_version == 'v1' else \
+                '/apis/%s' % group_version
+            try:
+                resources = self.request('GET', path)['resources']
+            except KubeApiError as exc:
+                if exc.status == 404:
+                    raise NativeUnsupported(
+                        'unknown API version %s' % group_version)
+                raise
+            self._discovery[group_version] = [
+                resource for resource in resources
+                if '/' not in resource['name']
+            ]
+        return self._discovery[group_version]
+
+    def group_versions(self):
+        """All the served group versions, preferred versions only"""
+        versions = ['v1']
+        for group in self.request('GET', '/apis')['groups']:
+            versions.append(group['preferredVersion']['groupVersion'])
+        return versions
+
+    def resource_for_kind(self, api_version, kind):
+        for resource in self.api_resources(api_version):
+            if resource['kind'] == kind:
+                return ApiResource(api_version, resource)
+        raise NativeUnsupported('unknown kind %s/%s' % (api_version, kind))
+
+    def resource_for_name(self, name):
+        """Find a resource as named on the kubectl command line"""
+        if ',' in name:
+            raise NativeUnsupported('several resource types')
+        name, _, group = name.lower().partition('.')
+        for group_version in self.group_versions():
+            if group and group_version.split('/')[0] != group:
+                continue
+            for resource in self.api_resources(group_version):
+                names = [resource['name'], resource.get('singularName'),
+                         resource['kind'].lower()] + \
+                    (resource.get('shortNames') or [])
+                if name in names:
+                    return ApiResource(group_version, resource)
+        raise NativeUnsupported('unknown resource type %s' % name)
+
+
+class ApiResource(object):
+    """A resource type of the API, as returned by the discovery API"""
+
+    def __init__(self, group_version, resource):
+        self.group_version = group_version
+        self.name = resource['name']
+        self.kind = resource['kind']
+        self.namespaced = resource['namespaced']
+
+    def path(self, namespace=None, name=None):
+        if self.group_version == 'v1':
+            path = '/api/v1'
+        else:
+            path = '/apis/%s' % self.group_version
+        if self.namespaced and namespace:
+            path += '/namespaces/%s' % namespace
+        path += '/' + self.name
+        if name:
+            path += '/' + name
+        return path
+
+    def display_name(self, name):
+        """Name of an object, as displayed by kubectl"""
+        group = self.group_version.rpartition('/')[0]
+        return '%s%s/%s' % (self.kind.lower(), '.' + group if group else '',
+                            name)
+
+
+LAST_APPLIED = 'kubectl.kubernetes.io/last-applied-configuration'
+
+
+def last_applied(live):
+    """The configuration last applied to a live object, if any"""
+    applied = live['metadata'].get('annotations', {}).get(LAST_APPLIED)
+    return json.loads(applied) if applied else None
+
+
+def object_diff(desired, live, previous=None, path=''):
+    """Paths of the fields of the `desired` object which differ in `live`
+
+    Only the fields set in `desired` are compared, so that the fields filled
+    in by the API server (status, defaults, UIDs...) are ignored. Fields of
+    the `previous` applied configuration missing from `desired` differ too,
+    as applying `desired` removes them.
+    """
+    if isinstance(desired, dict) and isinstance(live, dict):
+        fields = []
+        for key, value in desired.items():
+            if path == 'metadata' and key == 'annotations':
+                value = dict(value or {})
+                value.pop(LAST_APPLIED, None)
+            field = '%s.%s' % (path, key) if path else key
+            if key not in live:
+                if value not in (None, {}, []):
+                    fields.append(field)
+                continue
+            fields.extend(object_diff(
+                value, live[key],
+                (previous or {}).get(key) if isinstance(previous, dict)
+                else None,
+                field))
+        if isinstance(previous, dict):
+            fields.extend(
+                '%s.%s' % (path, key) if path else key
+                for key in previous
+                if key not in desired and key in live)
+        return fields
+    if isinstance(desired, list) and isinstance(live, list):
+        if len(desired) != len(live):
+            return [path]
+        fields = []
+        for index, (desired_item, live_item) in enumerate(zip(desired, live)):
+            fields.extend(object_diff(
+                desired_item, live_item,
+                matching_item(previous, desired_item, index),
+                '%s[%d]' % (path, index)))
+        return fields
+    return [] if desired == live else [path]
+
+
+def matching_item(items, item, index):
+    """The item of the list `items` with the `name` of `item`, if any
+
+    Items without a name are matched by their `index`.
+    """
+    if not isinstance(items, list):
+        return None
+    if isinstance(item, dict) and 'name' in item:
+        for candidate in items:
+            if isinstance(candidate, dict) and \
+                    candidate.get('name') == item['name']:
+                return candidate
+        return None
+    return items[index] if index < len(items) else None
+
+
+def object_error(obj):
+    """Why `obj` is not a Kubernetes object, None if it is one"""
+    if not isinstance(obj, dict):
+        return 'expected a mapping, got %s' % type(obj).__name__
+    for key in ('apiVersion', 'kind'):
+        if not obj.get(key) or not isinstance(obj[key], string_types):
+            return '%s is missing or not a string' % key
+    metadata = obj.get('metadata')
+    if not isinstance(metadata, dict) or not metadata.get('name'):
+        return 'metadata.name is missing'
+    return None
+
+
+def display_name(obj):
+    """Name of an object, as displayed by kubectl"""
+    group = obj['apiVersion'].rpartition('/')[0]
+    return '%s%s/%s' % (obj['kind'].lower(), '.' + group if group else '',
+                        obj['metadata']['name'])
+
+
+def removed_items(previous, desired, path=''):
+    """Paths of the lists of `desired` missing items of the `previous` ones
+
+    A strategic merge patch only adds or updates the items of the lists
+    merged by key (containers, env, ports...), it never removes them: only
+    kubectl knows the merge keys of each list. Items are matched by `name`,
+    or else by value, so that a changed item without a name is reported
+    too.
+    """
+    if isinstance(previous, dict) and isinstance(desired, dict):
+        paths = []
+        for key, value in desired.items():
+            if key in previous:
+                paths.extend(removed_items(
+                    previous[key], value,
+                    '%s.%s' % (path, key) if path else key))
+        return paths
+    if isinstance(previous, list) and isinstance(desired, list):
+        def item_key(item):
+            if isinstance(item, dict) and 'name' in item:
+                return 'name', item['name']
+            return 'value', json.dumps(item, sort_keys=True)
+
+        desired_by_key = dict((item_key(item), item) for item in desired)
+        paths = []
+        for index, item in enumerate(previous):
+            key = item_key(item)
+            if key not in desired_by_key:
+                return [path]
+            paths.extend(removed_items(item, desired_by_key[key],
+                                       '%s[%d]' % (path, index)))
+        return paths
+    return []
+
+
+def merge_patch(previous, current):
+    """JSON merge patch from the `previous` to the `current` object
+
+    Keys of `previous` missing from `current` are removed (set to None).
+    """
+    patch = dict(current)
+    for key, value in previous.items():
+        if key not in current:
+            patch[key] = None
+        elif isinstance(value, dict) and isinstance(current[key], dict):
+            patch[key] = merge_patch(value, current[key])
+    return patch
+
+
+class NativeKubeManager(KubeManager):
+    """`KubeManager` talking directly to the API server (`engine=native`)
+
+    Each operation keeps the semantics of the matching kubectl command, and
+    falls back to kubectl for anything not supported natively (resource
+    types unknown to the discovery API, `stop`, ...).
+    """
+
+    def __init__(self, module):
+        super(NativeKubeManager, self).__init__(module)
+        self.namespace = module.params.get('namespace')
+        self.client = KubeApiClient(
+            module, server=module.params.get('server'),
+            kubeconfig=module.params.get('kubeconfig'))
+        # kubectl and API requests are both recorded
+        self.timings = self.client.timings
+        # Operations which were run with kubectl instead, and why
+        self.fallbacks = []
+
+    def _kubectl_apply(self, display, obj, force, reason):
+        """Apply one object with kubectl, return its outcome"""
+        self.fallbacks.append('apply %s: %s' % (display, reason))
+        fd, path = tempfile.mkstemp(prefix='ansible.kube.', suffix='.json')
+        with os.fdopen(fd, 'w') as manifest:
+            json.dump(obj, manifest)
+        self.module.add_cleanup_file(path)
+        outcomes = summarize_apply(
+            self._apply_files(['--filename=' + path], force))
+        for outcome in ('created', 'configured', 'unchanged'):
+            if outcomes[outcome]:
+                return outcome
+        return 'configured'
+
+    def _fallback(self, operation, *args, **kwargs):
+        try:
+            return getattr(self, '_native_' + operation)(*args, **kwargs)
+        except NativeUnsupported as exc:
+            self.fallbacks.append('%s: %s' % (operation, exc))
+            return getattr(super(NativeKubeManager, self), operation)(
+                *args, **kwargs)
+        except KubeApiError as exc:
+            self.module.fail_json(msg='error running %s: %s' % (
+                operation, exc), timings=self.timings)
+
+    def _objects(self):
+        """The objects of the definition files, with their resource type"""
+        manifests = self._manifests()
+        if manifests is None:
+            raise NativeUnsupported('cannot read the definition files')
+        return [
+            (self.client.resource_for_kind(obj['apiVersion'], obj['kind']),
+             obj)
+            for obj in manifests
+        ]
+
+    def _namespace(self, resource, obj):
+        if not resource.namespaced:
+            return None
+        return obj['metadata'].get('namespace') or self.namespace or \
+            'default'
+
+    def _get(self, resource, namespace, name):
+        try:
+            return self.client.request(
+                'GET', resource.path(namespace, name))
+        except KubeApiError as exc:
+            if exc.status == 404:
+                return None
+            raise
+
+    def _wait_deleted(self, resource, namespace, name, timeout=60):
+        deadline = time.time() + timeout
+        while self._get(resource, namespace, name) is not None:
+            if time.time() > deadline:
+                raise KubeApiError(408, 'timed out waiting for the deletion '
+                                   'of %s' % resource.display_name(name))
+            time.sleep(0.5)
+
+    def _apply(self, resource, obj, force):
+        namespace = self._namespace(resource, obj)
+        name = obj['metadata']['name']
+        obj = json.loads(json.dumps(obj))
+        annotations = obj['metadata'].setdefault('annotations', {})
+        annotations.pop(LAST_APPLIED, None)
+        if not annotations:
+            del obj['metadata']['annotations']
+        applied = json.dumps(obj, sort_keys=True)
+        obj['metadata'].setdefault('annotations', {})[LAST_APPLIED] = applied
+        if resource.namespaced:
+            obj['metadata']['namespace'] = namespace
+
+        display = resource.display_name(name)
+        live = self._get(resource, namespace, name)
+        if live is None:
+            self.differences.append({'object': display, 'absent': True})
+            self.client.request('POST', resource.path(namespace), obj)
+            return 'created'
+
+        desired = json.loads(applied)
+        if resource.namespaced:
+            desired['metadata']['namespace'] = namespace
+        previous = last_applied(live)
+        fields = object_diff(desired, live, previous)
+        if not fields:
+            return 'unchanged'
+        self.differences.append({'object': display, 'fields': fields})
+
+        removed = removed_items(previous, desired)
+        if removed:
+            return self._kubectl_apply(
+                display, desired, force,
+                'items removed from %s' % ', '.join(removed))
+
+        patch = merge_patch(previous or {}, obj)
+        path = resource.path(namespace, name)
+        try:
+            try:
+                patched = self.client.request(
+                    'PATCH', path, patch,
+                    'application/strategic-merge-patch+json')
+            except KubeApiError as exc:
+                # Custom resources do not support strategic merge patches
+                if exc.status != 415:
+                    raise
+                patched = self.client.request(
+                    'PATCH', path, patch, 'application/merge-patch+json')
+        except KubeApiError as exc:
+            # Like `kubectl apply --force`, recreate the object when it
+            # cannot be patched (immutable fields)
+            if not force or exc.status not in (409, 422):
+                raise
+            self.client.request('DELETE', path)
+            self._wait_deleted(resource, namespace, name)
+            self.client.request('POST', resource.path(namespace), obj)
+            return 'configured'
+
+        # The patch may not converge, e.g. for lists merged by a key other
+        # than `name`: kubectl knows better
+        remaining = object_diff(desired, patched, previous)
+        if remaining:
+            return self._kubectl_apply(
+                display, desired, force,
+                'fields not patched: %s' % ', '.join(remaining))
+        if patched['metadata'].get('resourceVersion') == \
+                live['metadata'].get('resourceVersion'):
+            return 'unchanged'
+        return 'configured'
+
+    def _native_create(self, check=True, force=True):
+        if check and self._native_exists():
+            return []
+        if not self.filename:
+            self.module.fail_json(msg='filename required to create')
+        return ['%s %s' % (resource.display_name(obj['metadata']['name']),
+                           self._apply(resource, obj, force))
+                for resource, obj in self._objects()]
+
+    def _native_replace(self, force=True):
+        if not self.filename:
+            self.module.fail_json(msg='filename required to reload')
+        return self._native_create(check=False, force=force)
+
+    def _native_inplace_replace(self, force=True):
+        if not self.filename:
+            self.module.fail_json(msg='filename required to inplace-replace')
+        result = []
+        for resource, obj in self._objects():
+            namespace = self._namespace(resource, obj)
+            name = obj['metadata']['name']
+            path = resource.path(namespace, name)
+            if force:
+                if self._get(resource, namespace, name) is not None:
+                    self.client.request('DELETE', path)
+                    self._wait_deleted(resource, namespace, name)
+                self.client.request('POST', resource.path(namespace), obj)
+            else:
+                live = self._get(resource, namespace, name)
+                if live is None:
+                    raise KubeApiError(
+                        404, '%s not found' % resource.display_name(name))
+                obj = json.loads(json.dumps(obj))
+                obj['metadata']['resourceVersion'] = \
+                    live['metadata']['resourceVersion']
+                self.client.request('PUT', path, obj)
+            result.append('%s replaced' % resource.display_name(name))
+        return result
+
+    def _selected(self):
+        """Resource type and objects selected by name, label or `all`"""
+        if not self.resource:
+            self.module.fail_json(msg='resource required without filename')
+        resource = self.client.resource_for_name(self.resource)
+        namespace = self.namespace or 'default'
+        if self.name:
+            obj = self._get(resource, namespace, self.name)
+            return resource, [obj] if obj is not None else []
+        query = {}
+        if self.label:
+            query['labelSelector'] = self.label
+        items = self.client.request(
+            'GET', resource.path(namespace), query=query)['items']
+        return resource, items
+
+    def _native_delete(self):
+        if not self.force and not self._native_exists():
+            return []
+        result = []
+        if self.filename:
+            for resource, obj in self._objects():
+                namespace = self._namespace(resource, obj)
+                name = obj['metadata']['name']
+                try:
+                    self.client.request(
+                        'DELETE', resource.path(namespace, name))
+                except KubeApiError as exc:
+                    if exc.status != 404 or not self.force:
+                        raise
+                    continue
+                result.append('%s deleted' % resource.display_name(name))
+            return result
+
+        if not self.resource:
+            self.module.fail_json(
+                msg='resource required to delete without filename')
+        if not (self.name or self.label or self.all):
+            raise NativeUnsupported('no object selected')
+        resource, items = self._selected()
+        for obj in items:
+            name = obj['metadata']['name']
+            try:
+                self.client.request('DELETE', resource.path(
+                    obj['metadata'].get('namespace'), name))
+            except KubeApiError as exc:
+                if exc.status != 404:
+                    raise
+                continue
+            result.append('%s deleted' % resource.display_name(name))
+        return result
+
+    def _native_exists(self):
+        if self.filename:
+            for resource, obj in self._objects():
+                if self._get(resource, self._namespace(resource, obj),
+                             obj['metadata']['name']) is None:
+                    return False
+            return True
+        if self.all:
+            raise NativeUnsupported('all namespaces')
+        resource, items = self._selected()
+        return bool(items)
+
+    def create(self, check=True, force=True):
+        return self._fallback('create', check=check, force=force)
+
+    def replace(self, force=True):
+        return self._fallback('replace', force=force)
+
+    def inplace_replace(self, force=True):
+        return self._fallback('inplace_replace', force=force)
+
+    def delete(self):
+        return self._fallback('delete')
+
+    def exists(self):
+        return self._fallback('exists')
+
+
+def summarize_apply(lines):
+    """Sort the objects of a `kubectl apply` output by outcome
+
+    Lines look like `persistentvolume/pv-1 created`, or
+    `persistentvolume "pv-1" created` with older kubectl versions.
+    """
+    objects = {'created': [], 'configured': [], 'unchanged': []}
+    for line in lines:
+        parts = line.rsplit(None, 1)
+        if len(parts) != 2:
+            continue
+        name, outcome = parts
+        if outcome not in objects:
+            continue
+        if ' ' in name:
+            kind, obj_name = name.split(None, 1)
+            name = '%s/%s' % (kind, obj_name.strip('"'))
+        objects[outcome].append(name)
+    return objects
+
+
+def main():
+
+    module = AnsibleModule(
+        argument_spec=dict(
+            name=dict(),
+            filename=dict(type='list', aliases=['files', 'file', 'filenames']),
+            namespace=dict(),
+            resource=dict(),
+            label=dict(),
+            server=dict(),
+            kubectl=dict(),
+            force=dict(default=False, type='bool'),
+            all=dict(default=False, type='bool'),
+            log_level=dict(default=0, type='int'),
+            recursive=dict(default=False, type='bool'),
+            engine=dict(default='kubectl', choices=['kubectl', 'native']),
+            kubeconfig=dict(type='path'),
+            state=dict(default='present',
+                       choices=['present', 'absent', 'latest', 'reloaded',
+                                'stopped', 'inplace-replaced']),
+        ),
+        mutually_exclusive=[['filename', 'list']]
+    )
+
+    changed = False
+
+    manager = None
+    fallbacks = []
+    if module.params.get('engine') == 'native':
+        try:
+            manager = NativeKubeManager(module)
+        except NativeUnsupported as exc:
+            fallbacks.append('init: %s' % exc)
+    if manager is None:
+        manager = KubeManager(module)
+    state = module.params.get('state')
+    if state == 'present':
+        result = manager.create(check=False)
+
+    elif state == 'absent':
+        result = manager.delete()
+
+    elif state == 'reloaded':
+        result = manager.replace()
+
+    elif state == 'stopped':
+        result = manager.stop()
+
+    elif state == 'latest':
+        result = manager.replace()
+
+    elif state == 'inplace-replaced':
+        result = manager.inplace_replace()
+
+    else:
+        module.fail_json(msg='Unrecognized state %s.' % state)
+
+    extra = {'differences': manager.differences}
+    if isinstance(manager, NativeKubeManager):
+        manager.client.close()
+        fallbacks.extend(manager.fallbacks)
+    if module.params.get('engine') == 'native':
+        extra['fallbacks'] = fallbacks
+    if state in ('present', 'latest', 'reloaded'):
+        extra['objects'] = summarize_apply(result)
+        objects = extra['objects']
+        changed = bool(objects['created'] or objects['configured'])
+
+    module.exit_json(changed=changed,
+                     msg='success: %s' % (' '.join(result)),
+                     timings=manager.timings,
+                     **extra
+                     )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+'''Apply a set of manifests concurrently, ordered by kind
+
+The objects of the `manifests` are sorted in tiers, applied one after the
+other:
+
+- `definitions`: CustomResourceDefinitions and Namespaces
+- `rbac`: ServiceAccounts, (Cluster)Roles, (Cluster)RoleBindings and
+  PodSecurityPolicies
+- `config`: ConfigMaps, Secrets, Services, StorageClasses, volumes...
+- `workloads`: Deployments, DaemonSets, StatefulSets, Jobs and the other
+  built-in kinds
+- `custom`: the custom resources (any other kind), applied once the
+  CustomResourceDefinitions of the `definitions` tier are established
+
+The objects of a tier are split in about `workers` batches of a single
+namespace, applied concurrently by `workers` threads (one `kubectl apply`
+per batch), so that the time to deploy a
+set of addons approaches the one of its slowest objects:
+
+  .. code::
+
+    - name: 'Deploy Calico monitoring'
+      kube_apply:
+        kubectl: '{{ bin_dir }}/kubectl'
+        manifests:
+          - filename: '{{ addon_dir }}/calico-node-service.yml'
+            namespace: kube-system
+          - filename: '{{ addon_dir }}/calico-node-servicemonitor.yml'
+            namespace: kube-ops
+
+Each item of `manifests` is either the path of a manifest, or a dict with
+its `filename` and the `namespace` of its objects which do not set one
+(`namespace` parameter by default). The result contains the outcome of each
+object (`created`, `configured` or `unchanged`) and the duration of each
+tier.
+'''
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.six.moves import queue
+
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
+
+TIERS = [
+    ('definitions', ['CustomResourceDefinition', 'Namespace']),
+    ('rbac', ['ServiceAccount', 'ClusterRole', 'ClusterRoleBinding', 'Role',
+              'RoleBinding', 'PodSecurityPolicy']),
+    ('config', ['ConfigMap', 'Secret', 'Service', 'Endpoints',
+                'StorageClass', 'PersistentVolume', 'PersistentVolumeClaim',
+                'LimitRange', 'ResourceQuota', 'PriorityClass']),
+    ('workloads', ['Deployment', 'DaemonSet', 'StatefulSet', 'ReplicaSet',
+                   'ReplicationController', 'Job', 'CronJob', 'Pod',
+                   'Ingress', 'NetworkPolicy', 'PodDisruptionBudget',
+                   'HorizontalPodAutoscaler', 'APIService',
+                   'MutatingWebhookConfiguration',
+                   'ValidatingWebhookConfiguration']),
+]
+
+CUSTOM_TIER = 'custom'
+
+TIER_OF_KIND = dict(
+    (kind, tier) for tier, kinds in TIERS for kind in kinds
+)
+
+
+def read_manifests(manifests, default_namespace):
+    '''The objects of the `manifests`, with their namespace
+
+    :returns: (namespace, object) tuples, in the order of the manifests
+    '''
+    objects = []
+    for item in manifests:
+        if not isinstance(item, dict):
+            item = {'filename': item}
+        namespace = item.get('namespace') or default_namespace
+        with open(item['filename']) as manifest:
+            documents = list(yaml.safe_load_all(manifest))
+        for document in documents:
+            if not document:
+                continue
+            if document.get('kind', '').endswith('List'):
+                items = document.get('items', [])
+            else:
+                items = [document]
+            for obj in items:
+                objects.append(
+                    (obj['metadata'].get('namespace') or namespace, obj))
+    return objects
+
+
+def sort_in_tiers(objects):
+    '''Group the objects by tier, in the order they must be applied'''
+    tiers = dict((tier, []) for tier, _ in TIERS)
+    tiers[CUSTOM_TIER] = []
+    for namespace, obj in objects:
+        tier = TIER_OF_KIND.get(obj['kind'], CUSTOM_TIER)
+        tiers[tier].append((namespace, obj))
+    return [(tier, tiers[tier])
+            for tier in [name for name, _ in TIERS] + [CUSTOM_TIER]
+            if tiers[tier]]
+
+
+def split_in_batches(objects, count):
+    '''Split the objects in about `count` batches of a single namespace
+
+    Batches hold at most `len(objects) / count` objects: objects of many
+    namespaces make more, smaller batches.
+    '''
+    by_namespace = {}
+    for namespace, obj in objects:
+        by_namespace.setdefault(namespace, []).append(obj)
+    size = -(-len(objects) // max(1, count))
+    batches = []
+    for namespace in sorted(by_namespace, key=lambda ns: ns or ''):
+        namespace_objects = by_namespace[namespace]
+        batches.extend(
+            (namespace, namespace_objects[start:start + size])
+            for start in range(0, len(namespace_objects), size))
+    return batches
+
+
+def parse_apply_output(out):
+    '''Outcome of each object applied, from the output of kubectl apply'''
+    outcomes = {}
+    for line in out.splitlines():
+        name, _, outcome = line.strip().rpartition(' ')
+        if name:
+            outcomes[name.replace('"', '')] = outcome
+    return outcomes
+
+
+def error_message(rc, out, err):
+    return err.strip() or out.strip() or \
+        'kubectl exited with {}'.format(rc)
+
+
+class TieredApplier(object):
+    '''Apply objects tier by tier, each tier on a bounded pool of threads'''
+
+    def __init__(self, module):
+        self.module = module
+        self.kubectl = module.params['kubectl'] or \
+            module.get_bin_path('kubectl', required=True)
+        self.workers = max(1, module.params['workers'])
+        self.timings = []
+        self._lock = threading.Lock()
+
+    def _run(self, cmd):
+        start = time.time()
+        rc, out, err = self.module.run_command([self.kubectl] + cmd)
+        with self._lock:
+            self.timings.append({
+                'command': 'kubectl {}'.format(cmd[0]),
+                'args': ' '.join(cmd),
+                'duration': round(time.time() - start, 3),
+                'rc': rc,
+                'stdout_bytes': len(out),
+                'stderr_bytes': len(err),
+            })
+        return rc, out, err
+
+    def _apply_batch(self, namespace, objects):
+        fd, path = tempfile.mkstemp(prefix='ansible.kube_apply.',
+                                    suffix='.json')
+        with os.fdopen(fd, 'w') as manifest:
+            json.dump({'apiVersion': 'v1', 'kind': 'List', 'items': objects},
+                      manifest)
+        self.module.add_cleanup_file(path)
+
+        cmd = ['apply', '--filename={}'.format(path)]
+        if namespace:
+            cmd.append('--namespace={}'.format(namespace))
+        if self.module.params['force']:
+            cmd.append('--force')
+        try:
+            return self._run(cmd)
+        except Exception as exc:
+            return 1, '', 'Unexpected error: {}'.format(exc)
+
+    def _worker(self, batches, done):
+        while True:
+            try:
+                namespace, objects = batches.get_nowait()
+            except queue.Empty:
+                return
+            done.put(self._apply_batch(namespace, objects))
+
+    def apply_tier(self, objects):
+        '''Apply the objects of a tier
+
+        :returns: the outcome of each object, and the errors of the batches
+        '''
+        batches = split_in_batches(objects, self.workers)
+        pending = queue.Queue()
+        for batch in batches:
+            pending.put(batch)
+        done = queue.Queue()
+        for _ in range(min(self.workers, len(batches))):
+            thread = threading.Thread(target=self._worker,
+                                      args=(pending, done))
+            thread.daemon = True
+            thread.start()
+
+        outcomes = {}
+        errors = []
+        for _ in batches:
+            rc, out, err = done.get()
+            outcomes.update(parse_apply_output(out))
+            if rc != 0:
+                errors.append(error_message(rc, out, err))
+        return outcomes, errors
+
+    def wait_established(self, definitions, timeout):
+        '''Wait for the CustomResourceDefinitions to be established'''
+        cmd = ['wait', '--for=condition=established',
+               '--timeout={}s'.format(timeout)]
+        cmd.extend('customresourcedefinition/{}'.format(
+            obj['metadata']['name']) for obj in definitions)
+        rc, out, err = self._run(cmd)
+        if rc != 0:
+            return [error_message(rc, out, err)]
+        return []
+
+    def run(self, tiers):
+        results = []
+        definitions = [obj for tier, objects in tiers for _, obj in objects
+                       if obj['kind'] == 'CustomResourceDefinition']
+        for tier, objects in tiers:
+            start = time.time()
+            errors = []
+            if tier == CUSTOM_TIER and definitions:
+                errors = self.wait_established(
+                    definitions, self.module.params['timeout'])
+            outcomes = {}
+            if not errors:
+                outcomes, errors = self.apply_tier(objects)
+            results.append({
+                'tier': tier,
+                'objects': len(objects),
+                'outcomes': outcomes,
+                'duration': round(time.time() - start, 3),
+            })
+            if errors:
+                return results, errors
+        return results, []
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            manifests=dict(type='list', required=True),
+            kubectl=dict(type='str'),
+            namespace=dict(type='str'),
+            force=dict(default=False, type='bool'),
+            workers=dict(default=4, type='int'),
+            # Time to wait for the CustomResourceDefinitions
+            timeout=dict(default=60, type='int'),
+        )
+    )
+    if not HAS_YAML:
+        module.fail_json(msg='PyYAML is required by this module')
+
+    try:
+        objects = read_manifests(module.params['manifests'],
+                                 module.params['namespace'])
+    except (IOError, OSError, KeyError, yaml.YAMLError) as exc:
+        module.fail_json(msg='Cannot read the manifests: {}'.format(exc))
+
+    applier = TieredApplier(module)
+    tiers, errors = applier.run(sort_in_tiers(objects))
+    outcomes = {}
+    for tier in tiers:
+        for outcome in tier['outcomes'].values():
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    changed = bool(outcomes.get('created') or outcomes.get('configured'))
+
+    if errors:
+        module.fail_json(
+            msg='Failed to apply the manifests: {}'.format('; '.join(errors)),
+            changed=changed, tiers=tiers, outcomes=outcomes,
+            timings=applier.timings)
+    module.exit_json(changed=changed, tiers=tiers, outcomes=outcomes,
+                     timings=applier.timings)
+
+
+if __name__ == '__main__':
+    main()
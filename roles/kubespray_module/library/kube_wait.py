@@ -0,0 +1,260 @@
+'''Wait for a set of Kubernetes objects to reach a condition, all at once
+
+Each item of `objects` names an object (`kind`, `name` and `namespace`, for
+namespaced kinds) and what to wait for:
+
+- `condition`: the type of one of its `status.conditions`, which must be
+  `True` (e.g. `Established` for a CustomResourceDefinition, `Available`
+  for a Deployment)
+- `phase`: its `status.phase` (e.g. `Available` for a PersistentVolume)
+- `state: absent`: its deletion
+
+Without `condition`, `phase` nor `state`, the object only has to exist.
+
+  .. code::
+
+    - name: 'wait for the prometheus CRDs'
+      kube_wait:
+        kubectl: '{{ bin_dir }}/kubectl'
+        timeout: 60
+        objects:
+          - kind: customresourcedefinition
+            name: prometheuses.monitoring.coreos.com
+            condition: Established
+          - kind: deployment
+            namespace: kube-ops
+            name: prometheus-operator
+            condition: Available
+
+The objects are read once, then watched (`kubectl get --watch`, one watch
+per kind and namespace) instead of polled, until all of them are in the
+expected state or `timeout` seconds are elapsed. The result gives, for each
+object, the time it took to reach its state.
+
+Deletions are told by the `DELETED` events of the watch, with a `kubectl`
+supporting `--output-watch-events`. Older ones print deleted objects as any
+other update: the objects are then read again each time a watch ends, and
+every `relist_interval` seconds while an object is expected to be absent.
+'''
+
+import json
+import re
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.metalk8s_kube_watch import Watch
+from ansible.module_utils.six.moves import queue
+
+
+def is_deleted(obj):
+    '''Whether `obj` is the last state of a deleted object
+
+    Without `--output-watch-events`, the watch of `kubectl get` does not tell
+    deletion events apart: objects deleted after their finalizers ran are
+    printed with their deletion timestamp and no finalizer left. Objects
+    deleted at once have no deletion timestamp, and are only found absent
+    when read again.
+    '''
+    metadata = obj['metadata']
+    return bool(metadata.get('deletionTimestamp')) and \
+        not metadata.get('finalizers')
+
+
+def has_condition(obj, condition):
+    for item in (obj.get('status') or {}).get('conditions') or []:
+        if item.get('type') == condition:
+            return item.get('status') == 'True'
+    return False
+
+
+class Expectation(object):
+    '''An object to wait for, and the state it must reach'''
+
+    def __init__(self, item):
+        self.kind = item['kind'].lower()
+        self.name = item['name']
+        self.namespace = item.get('namespace')
+        self.condition = item.get('condition')
+        self.phase = item.get('phase')
+        self.absent = item.get('state') == 'absent'
+
+    @property
+    def group(self):
+        return (self.kind, self.namespace)
+
+    def __str__(self):
+        return '/'.join(
+            part for part in (self.kind, self.namespace, self.name) if part)
+
+    def is_met(self, obj):
+        '''Whether the expectation is met, given the state of the object
+
+        :param obj: The object, None if it does not exist
+        '''
+        if obj is None or is_deleted(obj):
+            return self.absent
+        if self.absent:
+            return False
+        if self.condition and not has_condition(obj, self.condition):
+            return False
+        if self.phase and \
+                (obj.get('status') or {}).get('phase') != self.phase:
+            return False
+        return True
+
+
+class ObjectWaiter(object):
+    '''Watch objects until they all meet their expectations'''
+
+    def __init__(self, module, expectations):
+        self.module = module
+        self.expectations = expectations
+        self.kubectl = module.params['kubectl'] or \
+            module.get_bin_path('kubectl', required=True)
+        self.events = queue.Queue()
+        self.latencies = {}
+        self.timings = []
+        self.watch_events = self.supports_watch_events()
+
+    def supports_watch_events(self):
+        '''Whether `kubectl get` supports `--output-watch-events`'''
+        rc, out, _ = self.module.run_command(
+            [self.kubectl, 'get', '--help'])
+        return rc == 0 and \
+            re.search(r'--output-watch-events\b', out) is not None
+
+    def current_objects(self, kind, namespace):
+        '''The objects of a kind and namespace, indexed by name'''
+        cmd = [self.kubectl, 'get', kind, '--output', 'json']
+        if namespace:
+            cmd.extend(['--namespace', namespace])
+        start = time.time()
+        rc, out, err = self.module.run_command(cmd)
+        self.timings.append({
+            'command': 'kubectl get',
+            'args': ' '.join(cmd[1:]),
+            'duration': round(time.time() - start, 3),
+            'rc': rc,
+            'stdout_bytes': len(out),
+            'stderr_bytes': len(err),
+        })
+        if rc != 0:
+            # e.g. the kind is defined by a CRD which is not created yet
+            return {}
+        return dict((obj['metadata']['name'], obj)
+                    for obj in json.loads(out).get('items', []))
+
+    def relist(self, kind, namespace, expectations):
+        '''Read the objects again, the missing ones being absent'''
+        objects = self.current_objects(kind, namespace)
+        for expectation in expectations:
+            objects.setdefault(expectation.name, None)
+        self.update(expectations, objects)
+
+    def update(self, expectations, objects):
+        now = time.time()
+        for expectation in expectations:
+            if expectation.name not in objects:
+                continue
+            key = str(expectation)
+            if expectation.is_met(objects[expectation.name]):
+                self.latencies.setdefault(key, round(now - self.start, 3))
+            else:
+                self.latencies.pop(key, None)
+
+    def pending_deletions(self, groups):
+        '''The groups with objects expected to be absent, and not yet'''
+        return [group for group, expectations in groups.items()
+                if any(str(expectation) not in self.latencies
+                       for expectation in expectations
+                       if expectation.absent)]
+
+    def run(self, timeout, relist_interval=10):
+        self.start = time.time()
+        deadline = self.start + timeout
+        groups = {}
+        for expectation in self.expectations:
+            groups.setdefault(expectation.group, []).append(expectation)
+
+        watches = {}
+        try:
+            for (kind, namespace), expectations in groups.items():
+                self.relist(kind, namespace, expectations)
+                watches[(kind, namespace)] = self._watch(kind, namespace)
+
+            while len(self.latencies) < len(self.expectations):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                relist_groups = [] if self.watch_events else \
+                    self.pending_deletions(groups)
+                try:
+                    watch, event, obj = self.events.get(
+                        timeout=min(remaining, relist_interval)
+                        if relist_groups else remaining)
+                except queue.Empty:
+                    # Objects deleted at once are not seen by the watches
+                    for kind, namespace in relist_groups:
+                        self.relist(kind, namespace,
+                                    groups[(kind, namespace)])
+                    continue
+                group = (watch.kind, watch.namespace)
+                if obj is None:
+                    # Watches are closed by the API server after a while, the
+                    # objects deleted meanwhile are only seen by a new list
+                    time.sleep(0.5)
+                    self.relist(watch.kind, watch.namespace, groups[group])
+                    watches[group] = self._watch(watch.kind, watch.namespace)
+                    continue
+                name = obj['metadata']['name']
+                self.update(groups[group],
+                            {name: None if event == 'DELETED' else obj})
+        finally:
+            for watch in watches.values():
+                watch.stop()
+
+        return dict(
+            (str(expectation), {
+                'ready': str(expectation) in self.latencies,
+                'latency': self.latencies.get(str(expectation)),
+            })
+            for expectation in self.expectations
+        )
+
+    def _watch(self, kind, namespace):
+        watch = Watch(self.kubectl, kind, namespace, self.events,
+                      watch_events=self.watch_events)
+        watch.start()
+        return watch
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            objects=dict(type='list', required=True),
+            kubectl=dict(type='str'),
+            timeout=dict(default=300, type='int'),
+        )
+    )
+    try:
+        expectations = [Expectation(item)
+                        for item in module.params['objects']]
+    except (KeyError, TypeError, AttributeError):
+        module.fail_json(
+            msg="Each item of 'objects' requires a 'kind' and a 'name'")
+
+    waiter = ObjectWaiter(module, expectations)
+    results = waiter.run(module.params['timeout'])
+    pending = sorted(name for name, result in results.items()
+                     if not result['ready'])
+    if pending:
+        module.fail_json(
+            msg='Objects not ready after {}s: {}'.format(
+                module.params['timeout'], ', '.join(pending)),
+            objects=results, timings=waiter.timings)
+    module.exit_json(changed=False, objects=results, timings=waiter.timings,
+                     duration=round(time.time() - waiter.start, 3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''Watch of Kubernetes objects shared by the `kube_wait` and `helm_wait`
+modules'''
+
+import json
+import os
+import subprocess
+import threading
+
+
+class Watch(threading.Thread):
+    '''Stream the events of a kind and namespace to the `events` queue
+
+    Events are `(watch, type, object)` tuples, the type being None when
+    `watch_events` is not set. `(watch, None, None)` is sent when the watch
+    ends.
+
+    :param str kubectl: Path of `kubectl`
+    :param str kind: Kind of the objects
+    :param str namespace: Namespace of the objects, None for all of them or
+                          for kinds which are not namespaced
+    :param events: Queue receiving the events
+    :param bool watch_events: Whether to use `--output-watch-events`, which
+                              tells the `DELETED` events apart
+    '''
+
+    def __init__(self, kubectl, kind, namespace, events, watch_events=False):
+        super(Watch, self).__init__()
+        self.daemon = True
+        self.kind = kind
+        self.namespace = namespace
+        self.events = events
+        self.watch_events = watch_events
+        self.cmd = [kubectl, 'get', kind, '--watch', '--output', 'json']
+        if watch_events:
+            self.cmd.append('--output-watch-events')
+        if namespace:
+            self.cmd.extend(['--namespace', namespace])
+        self.process = None
+
+    def run(self):
+        decoder = json.JSONDecoder()
+        buffer = ''
+        try:
+            with open(os.devnull, 'w') as devnull:
+                self.process = subprocess.Popen(
+                    self.cmd, stdout=subprocess.PIPE, stderr=devnull,
+                    close_fds=True)
+            # Objects are written as indented JSON documents, one after the
+            # other
+            for line in iter(self.process.stdout.readline, b''):
+                buffer += line.decode('utf-8')
+                while True:
+                    buffer = buffer.lstrip()
+                    try:
+                        obj, end = decoder.raw_decode(buffer)
+                    except ValueError:
+                        break
+                    buffer = buffer[end:]
+                    if self.watch_events:
+                        self.events.put((self, obj['type'], obj['object']))
+                    else:
+                        self.events.put((self, None, obj))
+        finally:
+            self.events.put((self, None, None))
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
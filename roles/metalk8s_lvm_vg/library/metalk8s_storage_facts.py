@@ -0,0 +1,256 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Gather the storage facts of a host, without a full `setup`
+
+Only the block devices (`/sys/block`), their partitions, their links
+(`/dev/disk/by-id`, `by-uuid` and `by-label`) and the LVM report are read.
+The `ansible_devices` and `ansible_lvm` facts have the shape of the ones of
+the `setup` module, as used by `validate_storage` and `setup_lvm_lv`.
+
+The `metalk8s_storage_fingerprint` fact identifies the state of the storage
+of the host, from its devices, their links and the LVM metadata backups
+(`/etc/lvm/backup`, written by LVM on each metadata change). When it matches
+`since`, the facts are not read again, and only the fingerprint is returned:
+
+  .. code::
+
+    - name: 'gather the storage facts'
+      metalk8s_storage_facts:
+        since: '{{ metalk8s_storage_fingerprint|default(omit) }}'
+'''
+
+import hashlib
+import json
+import os
+import re
+
+from ansible.module_utils.basic import AnsibleModule
+
+
+SYS_BLOCK = '/sys/block'
+LINK_DIRS = {
+    'ids': '/dev/disk/by-id',
+    'uuids': '/dev/disk/by-uuid',
+    'labels': '/dev/disk/by-label',
+}
+LVM_BACKUP_DIR = '/etc/lvm/backup'
+
+
+def read_file(path, default=None):
+    try:
+        with open(path) as sys_file:
+            return sys_file.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+def list_dir(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+
+def human_size(size):
+    '''Size in bytes, formatted as by the `setup` module (e.g. `10.00 GB`)'''
+    for suffix in ['B', 'KB', 'MB', 'GB', 'TB', 'PB']:
+        if size < 1024 or suffix == 'PB':
+            return '%.2f %s' % (size, suffix)
+        size /= 1024.0
+
+
+def device_links():
+    '''The links of each device, e.g. {'ids': {'sdb': ['wwn-...']}, ...}'''
+    links = {}
+    for link_type, link_dir in LINK_DIRS.items():
+        by_device = links[link_type] = {}
+        for entry in list_dir(link_dir):
+            try:
+                target = os.path.basename(
+                    os.readlink(os.path.join(link_dir, entry)))
+            except OSError:
+                continue
+            by_device.setdefault(target, []).append(entry)
+    masters = links['masters'] = {}
+    for block in list_dir(SYS_BLOCK):
+        for slave in list_dir(os.path.join(SYS_BLOCK, block, 'slaves')):
+            masters.setdefault(slave, []).append(block)
+    return links
+
+
+def holders(sysdir):
+    names = []
+    for holder in list_dir(os.path.join(sysdir, 'holders')):
+        if holder.startswith('dm-'):
+            name = read_file(
+                os.path.join(sysdir, 'holders', holder, 'dm', 'name'))
+            names.append(name or holder)
+    return names
+
+
+def sector_size(sysdir, default=512):
+    return read_file(os.path.join(sysdir, 'queue', 'logical_block_size')) \
+        or read_file(os.path.join(sysdir, 'queue', 'hw_sector_size')) \
+        or default
+
+
+def block_device_facts(name, links):
+    sysdir = os.path.realpath(os.path.join(SYS_BLOCK, name))
+    sectorsize = sector_size(sysdir)
+    # As in the `setup` facts, `sectors` is always in 512-bytes units, whatever
+    # the logical sector size
+    sectors = int(read_file(os.path.join(sysdir, 'size'), 0))
+    device = {
+        'holders': holders(sysdir),
+        'host': '',
+        'links': dict((link_type, by_device.get(name, []))
+                      for link_type, by_device in links.items()),
+        'model': read_file(os.path.join(sysdir, 'device', 'model')),
+        'vendor': read_file(os.path.join(sysdir, 'device', 'vendor')),
+        'removable': read_file(os.path.join(sysdir, 'removable')),
+        'rotational': read_file(os.path.join(sysdir, 'queue', 'rotational')),
+        'sectors': str(sectors),
+        'sectorsize': sectorsize,
+        'size': human_size(sectors * 512.0),
+        'virtual': 1,
+        'partitions': {},
+    }
+
+    partition_re = re.compile('^{}p?[0-9]+$'.format(re.escape(name)))
+    for entry in list_dir(sysdir):
+        if not partition_re.match(entry):
+            continue
+        part_sysdir = os.path.join(sysdir, entry)
+        part_sectorsize = sector_size(part_sysdir, sectorsize)
+        part_sectors = int(read_file(os.path.join(part_sysdir, 'size'), 0))
+        part_links = dict((link_type, by_device.get(entry, []))
+                          for link_type, by_device in links.items())
+        device['partitions'][entry] = {
+            'holders': holders(part_sysdir),
+            'links': part_links,
+            'start': read_file(os.path.join(part_sysdir, 'start'), '0'),
+            'sectors': str(part_sectors),
+            'sectorsize': part_sectorsize,
+            'size': human_size(part_sectors * 512.0),
+            # Filesystem UUID, as known by udev
+            'uuid': (part_links['uuids'] or [None])[0],
+        }
+    return device
+
+
+def storage_fingerprint():
+    '''Fingerprint of the storage of the host, cheap to compute
+
+    Only directory listings and small sysfs files are read: the devices and
+    their sizes, partitions and holders, the device links, and the LVM
+    metadata backups.
+    '''
+    state = []
+    for block in list_dir(SYS_BLOCK):
+        sysdir = os.path.join(SYS_BLOCK, block)
+        state.append(('block', block, read_file(os.path.join(sysdir, 'size')),
+                      list_dir(sysdir + '/holders'),
+                      [entry for entry in list_dir(sysdir)
+                       if entry.startswith(block)]))
+    for link_type, link_dir in sorted(LINK_DIRS.items()):
+        for entry in list_dir(link_dir):
+            try:
+                target = os.readlink(os.path.join(link_dir, entry))
+            except OSError:
+                target = None
+            state.append((link_type, entry, target))
+    for entry in list_dir(LVM_BACKUP_DIR):
+        try:
+            stat = os.stat(os.path.join(LVM_BACKUP_DIR, entry))
+        except OSError:
+            continue
+        state.append(('lvm', entry, stat.st_mtime, stat.st_size))
+    return hashlib.sha256(
+        json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def lvm_report(module, command, fields):
+    '''Rows of the JSON report of an LVM command (`vgs`, `lvs` or `pvs`)
+
+    Sizes are reported in bytes.
+    '''
+    path = module.get_bin_path(command)
+    if path is None:
+        return None
+    rc, out, err = module.run_command([
+        path, '--reportformat', 'json', '--units', 'b', '--nosuffix',
+        '--options', ','.join(fields)])
+    if rc != 0:
+        module.fail_json(msg='{} failed: {}'.format(command, err.strip()))
+    report = json.loads(out)['report']
+    return report[0][command[:-1]] if report else []
+
+
+def size_g(size_b):
+    '''Size in GiB, formatted as by the `setup` module (e.g. `10.00`)'''
+    return '%.2f' % (int(size_b) / float(1024 ** 3))
+
+
+def lvm_facts(module):
+    '''LVM facts, as `ansible_lvm`, None if LVM is not installed
+
+    On top of the sizes in GiB of the `setup` module, the exact sizes in
+    bytes (`size_b`) and the extents of the VGs are given.
+    '''
+    vgs = lvm_report(module, 'vgs',
+                     ['vg_name', 'vg_size', 'vg_free', 'lv_count', 'pv_count',
+                      'vg_extent_size', 'vg_extent_count', 'vg_free_count'])
+    if vgs is None:
+        return None
+    lvs = lvm_report(module, 'lvs', ['lv_name', 'vg_name', 'lv_size']) or []
+    pvs = lvm_report(module, 'pvs',
+                     ['pv_name', 'vg_name', 'pv_size', 'pv_free']) or []
+    return {
+        'vgs': dict((vg['vg_name'], {
+            'size_g': size_g(vg['vg_size']),
+            'free_g': size_g(vg['vg_free']),
+            'num_lvs': vg['lv_count'],
+            'num_pvs': vg['pv_count'],
+            'size_b': int(vg['vg_size']),
+            'extent_size_b': int(vg['vg_extent_size']),
+            'extent_count': int(vg['vg_extent_count']),
+            'free_count': int(vg['vg_free_count']),
+        }) for vg in vgs),
+        'lvs': dict((lv['lv_name'], {
+            'size_g': size_g(lv['lv_size']),
+            'size_b': int(lv['lv_size']),
+            'vg': lv['vg_name'],
+        }) for lv in lvs),
+        'pvs': dict((pv['pv_name'], {
+            'size_g': size_g(pv['pv_size']),
+            'free_g': size_g(pv['pv_free']),
+            'vg': pv['vg_name'],
+        }) for pv in pvs),
+    }
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            since=dict(type='str'),
+        ),
+        supports_check_mode=True,
+    )
+    fingerprint = storage_fingerprint()
+    facts = {'metalk8s_storage_fingerprint': fingerprint}
+    if module.params['since'] == fingerprint:
+        module.exit_json(changed=False, unchanged=True, ansible_facts=facts)
+
+    links = device_links()
+    facts['ansible_devices'] = dict(
+        (block, block_device_facts(block, links))
+        for block in list_dir(SYS_BLOCK))
+    lvm = lvm_facts(module)
+    if lvm is not None:
+        facts['ansible_lvm'] = lvm
+    module.exit_json(changed=False, unchanged=False, ansible_facts=facts)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,17 +7,118 @@ import sys
 from ansible.plugins.action import ActionBase
 
 # Note: to add mode checks/validations, simply add a top-level function whose
-# name starts with `check_`. The function will receive a `task_vars` dictionary
-# as defined by Ansible.
-# Within a `check_*` function, use `assert` to validate values found in
-# `task_vars`, or raise `AssertionError` explicitly. A single check can, of
-# course, contain multiple assertions.
+# name starts with `check_`. The function will receive an `Inventory`, with
+# the groups and the variables of the hosts.
+# Checks of a single host are decorated by `host_check`: they receive the name
+# of each host, and its variables, in turn.
+# The variables of the hosts used by a check must be declared, with
+# `host_check` or `uses_variables`: each variable of each host is then
+# templated once, for all the checks.
+# Within a `check_*` function, use `assert` to validate values, or raise
+# `AssertionError` explicitly. A single check can, of course, contain multiple
+# assertions.
 # Alternatively, for checks which can result in multiple errors, a check can
 # return a list of (or yield) error messages.
 
 
-def check_etcd_ensemble_size(task_vars):
-    ensemble_size = len(task_vars['groups'].get('etcd', []))
+def uses_variables(*variables):
+    '''Declare the variables of the hosts used by a check'''
+    def decorate(check):
+        check.variables = variables
+        return check
+    return decorate
+
+
+def host_check(*variables):
+    '''Declare a check of each host, and the variables of the host it uses'''
+    def decorate(check):
+        check.per_host = True
+        check.variables = variables
+        return check
+    return decorate
+
+
+class Inventory(object):
+    '''The groups of an inventory, and the variables of its hosts
+
+    Only the variables used by the checks are read from `hostvars`, once per
+    host (reading a variable of a host templates it).
+
+    :param dict groups: The hosts of each group
+    :param hostvars: The `hostvars` of the inventory
+    :param variables: The names of the variables to read
+    '''
+
+    def __init__(self, groups, hostvars, variables):
+        self.groups = groups
+        self.hosts = list(groups.get('all', []))
+        self.hostvars = {}
+        for host in self.hosts:
+            host_vars = hostvars[host]
+            self.hostvars[host] = dict(
+                (name, host_vars[name])
+                for name in variables if name in host_vars)
+
+
+def collect_checks():
+    for (name, obj) in inspect.getmembers(sys.modules[__name__]):
+        if name.startswith('check_') and inspect.isfunction(obj):
+            yield (name, obj)
+
+
+def _run_check(name, check, args, errors):
+    try:
+        results = check(*args)
+        if not results:
+            # Simple `assert`-check, passed and returned `None`
+            results = []
+
+        for message in results:
+            errors.append('{} [{}]'.format(message, name))
+
+    except AssertionError as exc:
+        errors.append(
+            '{} [{}]'.format(
+                exc.args[0] if len(exc.args) >= 1
+                else 'Unknown failure',
+                name)
+        )
+
+
+def run_checks(groups, hostvars):
+    '''Run all the checks on an inventory
+
+    The variables of each host are read once, then go through all the checks
+    of a single host. The other checks then run once, on the whole inventory.
+
+    :param dict groups: The hosts of each group
+    :param hostvars: The `hostvars` of the inventory
+    :returns: The error messages, sorted by check
+    :rtype: list
+    '''
+    checks = list(collect_checks())
+    variables = sorted(set(
+        variable for _, check in checks
+        for variable in getattr(check, 'variables', ())))
+    inventory = Inventory(groups, hostvars, variables)
+
+    errors = dict((name, []) for name, _ in checks)
+    host_checks = [(name, check) for name, check in checks
+                   if getattr(check, 'per_host', False)]
+    for host in sorted(inventory.hosts):
+        for name, check in host_checks:
+            _run_check(name, check, (host, inventory.hostvars[host]),
+                       errors[name])
+
+    for name, check in checks:
+        if not getattr(check, 'per_host', False):
+            _run_check(name, check, (inventory,), errors[name])
+
+    return [error for name, _ in checks for error in errors[name]]
+
+
+def check_etcd_ensemble_size(inventory):
+    ensemble_size = len(inventory.groups.get('etcd', []))
 
     assert ensemble_size % 2 == 1, \
         'etcd ensemble size should be odd, currently {}'.format(ensemble_size)
@@ -25,70 +126,70 @@ def check_etcd_ensemble_size(task_vars):
     assert ensemble_size >= 1, 'No `etcd` node(s) defined'
 
 
-def check_at_least_one_master(task_vars):
-    masters = task_vars['groups'].get('kube-master', [])
+def check_at_least_one_master(inventory):
+    masters = inventory.groups.get('kube-master', [])
 
     assert len(masters) >= 1, 'No `kube-master` node(s) defined'
 
 
-def check_at_least_one_node(task_vars):
-    nodes = task_vars['groups'].get('kube-node', [])
+def check_at_least_one_node(inventory):
+    nodes = inventory.groups.get('kube-node', [])
 
     assert len(nodes) >= 1, 'No `kube-node` node(s) definend'
 
 
-def check_k8s_cluster_is_kube_master_union_kube_node(task_vars):
-    kube_master = set(task_vars['groups']['kube-master'])
-    kube_node = set(task_vars['groups']['kube-node'])
-    k8s_cluster = set(task_vars['groups']['k8s-cluster'])
+def check_k8s_cluster_is_kube_master_union_kube_node(inventory):
+    kube_master = set(inventory.groups['kube-master'])
+    kube_node = set(inventory.groups['kube-node'])
+    k8s_cluster = set(inventory.groups['k8s-cluster'])
 
     assert kube_master.union(kube_node) == k8s_cluster, \
         'The `k8s-cluster` group must be the union of `kube-master` and ' \
         '`kube-node`'
 
 
-def check_no_duplicate_addresses(task_vars):
-    seen_addresses = set()
+@uses_variables('access_ip', 'ip', 'ansible_host')
+def check_no_duplicate_addresses(inventory):
+    # The first host using each address
+    owners = {}
 
-    for host in task_vars['groups']['all']:
-        this_host_addresses = set()
+    for host in inventory.hosts:
+        hostvars = inventory.hostvars[host]
 
         for name in ['access_ip', 'ip', 'ansible_host']:
-            address = task_vars['hostvars'][host].get(name)
+            address = hostvars.get(name)
 
+            # A host can have e.g. `access_ip` and `ansible_host` set to the
+            # same value, which would be legal.
             if address:
-                # A host can have e.g. `access_ip` and `ansible_host` set to
-                # the same value, which would be legal.
-                # The code below relies on the assumption that any address in
-                # `this_host_addresses` was already checked against
-                # `seen_addresses` before.
-                if address not in this_host_addresses \
-                        and address in seen_addresses:
+                owner = owners.setdefault(address, host)
+                if owner != host:
                     yield 'Duplicate address in `{}` of {}: {}'.format(
                         name, host, address)
 
-                this_host_addresses.add(address)
-                seen_addresses.add(address)
+                    # Only report the first variable of the host using it
+                    owners[address] = host
 
 
-def check_no_old_storage_configuration(task_vars):
+@host_check('metal_k8s_lvm', 'metalk8s_lvm_default_vg')
+def check_no_old_storage_configuration(host, hostvars):
     '''Ensure MetalK8s 0.1 storage configuration is not present'''
 
-    for host in task_vars['hostvars'].keys():
-        assert 'metal_k8s_lvm' not in task_vars['hostvars'][host], (
-            "You are still having the old storage configuration for {host}. "
-            "A breaking change was introduced in MetalK8s 0.2.0 "
-            "and the default LVM Volume Group has been changed "
-            "from 'kubevg' to '{metalk8s_lvm_default_vg}'. "
-            "Please follow the 'Upgrading from MetalK8s < 0.2.0' "
-            "chapter of the documentation").format(
-                host=host,
-                metalk8s_lvm_default_vg=task_vars['hostvars'][host].get(
-                    'metalk8s_lvm_default_vg', 'vg_metalk8s')
-        )
+    assert 'metal_k8s_lvm' not in hostvars, (
+        "You are still having the old storage configuration for {host}. "
+        "A breaking change was introduced in MetalK8s 0.2.0 "
+        "and the default LVM Volume Group has been changed "
+        "from 'kubevg' to '{metalk8s_lvm_default_vg}'. "
+        "Please follow the 'Upgrading from MetalK8s < 0.2.0' "
+        "chapter of the documentation").format(
+            host=host,
+            metalk8s_lvm_default_vg=hostvars.get(
+                'metalk8s_lvm_default_vg', 'vg_metalk8s')
+    )
 
 
-def check_ansible_user_is_not_root(task_vars):
+@host_check('ansible_user', 'security_sshd_permit_root_login')
+def check_ansible_user_is_not_root(host, hostvars):
     '''Ensure `ansible_user` is not `root`
 
     As part of the deployment, SSH login using the `root` user is disabled
@@ -100,17 +201,23 @@ def check_ansible_user_is_not_root(task_vars):
     See: https://github.com/scality/metalk8s/issues/329
     '''
 
-    for (host, hostvars) in sorted(task_vars['hostvars'].items()):
-        if hostvars.get('ansible_user', None) == 'root' and \
-                not hostvars.get('security_sshd_permit_root_login', False):
-            yield (
-                "Using 'root' as 'ansible_user' for host '{host}'. "
-                "This is not permitted.").format(
-                    host=host,
-            )
+    if hostvars.get('ansible_user', None) == 'root' and \
+            not hostvars.get('security_sshd_permit_root_login', False):
+        yield (
+            "Using 'root' as 'ansible_user' for host '{host}'. "
+            "This is not permitted.").format(
+                host=host,
+        )
 
 
-def check_valid_fqdn_and_no_capital_letter_in_hostnames(task_vars):
+FQDN_REGEX = re.compile(
+    r'^((?!-)[-a-z\d]{1,62}(?<!-)\.)*(?!-)[-a-z\d]{1,62}(?<!-)$',
+    re.IGNORECASE
+)
+
+
+@host_check('inventory_file')
+def check_valid_fqdn_and_no_capital_letter_in_hostnames(host, hostvars):
     '''Ensure there is only lower case hostnames in the inventory
 
     Kubespray set the hostname with lower case based on the inventory content
@@ -121,27 +228,22 @@ def check_valid_fqdn_and_no_capital_letter_in_hostnames(task_vars):
     https://tools.ietf.org/html/rfc1035
     '''
 
-    fqdn_regex = re.compile(
-        r'^((?!-)[-a-z\d]{1,62}(?<!-)\.)*(?!-)[-a-z\d]{1,62}(?<!-)$',
-        re.IGNORECASE
-    )
-    for host, hostvars in sorted(task_vars['hostvars'].items()):
-        if fqdn_regex.match(host) is None:
-            yield (
-                "The hostname {host} does not match a valid FQDN. "
-                "See https://tools.ietf.org/html/rfc1035#section-2.3.1 "
-                "for more details.".format(host=host)
-            )
-        if any([letter.isupper() for letter in host]):
-            yield (
-                "The hostname {host} contains capital letter. "
-                "Please rename it to {host_lower} in your "
-                "inventory {inventory}.".format(
-                    host=host,
-                    host_lower=host.lower(),
-                    inventory=hostvars.get('inventory_file', '')
-                )
+    if FQDN_REGEX.match(host) is None:
+        yield (
+            "The hostname {host} does not match a valid FQDN. "
+            "See https://tools.ietf.org/html/rfc1035#section-2.3.1 "
+            "for more details.".format(host=host)
+        )
+    if any([letter.isupper() for letter in host]):
+        yield (
+            "The hostname {host} contains capital letter. "
+            "Please rename it to {host_lower} in your "
+            "inventory {inventory}.".format(
+                host=host,
+                host_lower=host.lower(),
+                inventory=hostvars.get('inventory_file', '')
             )
+        )
 
 
 class ActionModule(ActionBase):
@@ -151,35 +253,9 @@ class ActionModule(ActionBase):
 
         result = super(ActionModule, self).run(tmp, task_vars)
 
-        def collect_checks():
-            for (name, obj) in inspect.getmembers(sys.modules[__name__]):
-                if name.startswith('check_') and inspect.isfunction(obj):
-                    yield (name, obj)
-
-        errors = []
-        failed = False
-
-        for (name, check) in collect_checks():
-            try:
-                results = check(task_vars)
-                if not results:
-                    # Simple `assert`-check, passed and returned `None`
-                    results = []
-
-                for message in results:
-                    failed = True
-                    errors.append('{} [{}]'.format(message, name))
-
-            except AssertionError as exc:
-                failed = True
-                errors.append(
-                    '{} [{}]'.format(
-                        exc.args[0] if len(exc.args) >= 1
-                        else 'Unknown failure',
-                        name)
-                )
-
-        result['failed'] = failed
+        errors = run_checks(task_vars['groups'], task_vars['hostvars'])
+
+        result['failed'] = bool(errors)
         result['errors'] = errors
 
         return result
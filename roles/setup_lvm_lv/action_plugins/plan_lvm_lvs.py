@@ -0,0 +1,192 @@
+'''Compute the exact size of the LVM LVs of a host, and check they fit
+
+The `size` of each LV is given as to the `lvol` module:
+
+- a size, by default in MiB, or with one of the units of lvcreate(8)
+  (`b`, `s` for 512-bytes sectors, `k`, `m`, `g`, `t`, `p` or `e`, all of them
+  powers of 1024, whatever their case), e.g. `10G` or `1.5t`
+- a percentage of the extents of the VG (`%VG` or `%PVS`), or of its free
+  extents (`%FREE`), e.g. `50%FREE`
+
+Sizes are converted in extents of the VG (from the `ansible_lvm` facts, see
+the `metalk8s_storage_facts` module), as lvcreate(8) does: sizes are rounded
+up to a whole extent, percentages are rounded down. The LVs are planned in the
+order of their path, the `%FREE` of an LV being relative to the extents left
+by the previous ones. LVs which already exist are never shrunk.
+
+Before any LV is created, the extents to allocate on each VG are checked
+against its free extents, and all the VGs which are too small are reported
+at once. The result gives the `lvs`, with their exact size in bytes
+(`exact_size`, e.g. `10737418240b`), to create the LVs and to declare the
+capacity of their PersistentVolumes:
+
+  .. code::
+
+    - name: 'LVM Setup: Plan the LVM LVs of each VG'
+      action: plan_lvm_lvs
+      args:
+        lvs: '{{ metalk8s_lvm_all_lvs }}'
+      register: metalk8s_lvm_plan
+
+    - name: 'LVM Setup: Update fact metalk8s_lvm_all_lvs with exact sizes'
+      set_fact:
+        metalk8s_lvm_all_lvs: '{{ metalk8s_lvm_plan.lvs }}'
+'''
+
+import imp
+import os
+
+from ansible.plugins.action import ActionBase
+
+
+# The LVM sizes are shared with the `size_lvm_to_k8s` filter, see the
+# `metalk8s_lvm_size` module_utils of the `setup_lvm_lv` role
+metalk8s_lvm_size = imp.load_source('metalk8s_lvm_size', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+    'setup_lvm_lv', 'module_utils', 'metalk8s_lvm_size.py'))
+
+# Default extent size of vgcreate(8), for facts without the extents of the VGs
+DEFAULT_EXTENT_SIZE = 4 * 1024 ** 2
+
+
+class VolumeGroup(object):
+    '''The extents of a VG, and the ones planned to be allocated
+
+    :param str name: Name of the VG
+    :param dict facts: The VG, as in `ansible_lvm.vgs`
+    '''
+
+    def __init__(self, name, facts):
+        self.name = name
+        self.extent_size = int(facts.get('extent_size_b', DEFAULT_EXTENT_SIZE))
+        if 'extent_count' in facts:
+            self.extent_count = int(facts['extent_count'])
+            self.free_count = int(facts['free_count'])
+        else:
+            # Facts of the `setup` module, in GiB rounded to 2 decimals
+            self.extent_count = self.to_extents(facts['size_g'], 'g', round)
+            self.free_count = self.to_extents(facts['free_g'], 'g', round)
+        self.planned = 0
+        self.growths = []
+
+    def to_extents(self, value, unit, rounding):
+        size = float(value) * metalk8s_lvm_size.UNITS[unit]
+        return int(rounding(size / float(self.extent_size)))
+
+    @property
+    def available(self):
+        return self.free_count - self.planned
+
+    def extents(self, size):
+        '''Number of extents allocated by lvcreate(8) for an LV of `size`'''
+        size_bytes = metalk8s_lvm_size.size_in_bytes(size)
+        if size_bytes is not None:
+            return -(-size_bytes // self.extent_size)
+
+        match = metalk8s_lvm_size.PERCENT_RE.match(str(size).strip())
+        if match.group('whole').upper() == 'FREE':
+            whole = self.available
+        else:
+            whole = self.extent_count
+        return int(match.group('value')) * whole // 100
+
+    def plan(self, lv_name, size, existing=0):
+        '''Plan an LV of `size`, given its current number of extents
+
+        :returns: the number of extents of the LV, once created or extended
+        '''
+        extents = max(self.extents(size), existing)
+        if extents > existing:
+            self.planned += extents - existing
+            self.growths.append((lv_name, extents - existing))
+        return extents
+
+
+def existing_extents(lvm, vg, lv_name):
+    '''Number of extents of an existing LV of a VG, 0 if it does not exist'''
+    lv = (lvm.get('lvs') or {}).get(lv_name)
+    if not lv or lv.get('vg') != vg.name:
+        return 0
+    if 'size_b' in lv:
+        return -(-int(lv['size_b']) // vg.extent_size)
+    return vg.to_extents(lv['size_g'], 'g', round)
+
+
+def plan_lvs(lvs, lvm):
+    '''Plan the LVs on their VG
+
+    :param dict lvs: The LVs, as `metalk8s_lvm_all_lvs`
+    :param dict lvm: The LVM facts, as `ansible_lvm`
+    :returns: The exact size in bytes of each LV (by path), the VGs and the
+        errors
+    '''
+    vgs = {}
+    sizes = {}
+    errors = []
+    for path, lv in sorted(lvs.items()):
+        vg_name = lv['vg_prop']['vg_name']
+        if vg_name not in vgs:
+            facts = (lvm.get('vgs') or {}).get(vg_name)
+            if facts is None:
+                errors.append('The VG "{}" of the LV "{}" does not exist'
+                              .format(vg_name, lv['lv_name']))
+                continue
+            vgs[vg_name] = VolumeGroup(vg_name, facts)
+        vg = vgs[vg_name]
+
+        try:
+            extents = vg.plan(lv['lv_name'], lv.get('size'),
+                              existing_extents(lvm, vg, lv['lv_name']))
+        except metalk8s_lvm_size.SizeError as exc:
+            errors.append('{} for the LV "{}" of the VG "{}"'.format(
+                exc, lv['lv_name'], vg_name))
+            continue
+        sizes[path] = extents * vg.extent_size
+
+    for vg_name, vg in sorted(vgs.items()):
+        if vg.available < 0:
+            errors.append(
+                'The LVs of the VG "{vg}" do not fit: {needed} extents of '
+                '{extent_size} bytes are needed ({growths}), only {free} are '
+                'free'.format(
+                    vg=vg_name, needed=vg.planned,
+                    extent_size=vg.extent_size, free=vg.free_count,
+                    growths=', '.join('{}: {}'.format(lv_name, extents)
+                                      for lv_name, extents in vg.growths)))
+    return sizes, vgs, errors
+
+
+class ActionModule(ActionBase):
+    '''Plan the LVM LVs of the host, fail if they do not fit in their VG'''
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+
+        lvs = self._task.args.get('lvs') or {}
+        lvm = self._task.args.get('lvm', task_vars.get('ansible_lvm')) or {}
+
+        sizes, vgs, errors = plan_lvs(lvs, lvm)
+
+        result['vgs'] = dict(
+            (vg_name, {
+                'extent_size_b': vg.extent_size,
+                'free_count': vg.free_count,
+                'planned_count': vg.planned,
+            }) for vg_name, vg in vgs.items())
+        if errors:
+            result['failed'] = True
+            result['errors'] = errors
+            result['msg'] = 'The LVM LVs cannot be created: {}'.format(
+                '; '.join(errors))
+            return result
+
+        planned_lvs = {}
+        for path, lv in lvs.items():
+            planned_lvs[path] = dict(lv, exact_size='{}b'.format(sizes[path]))
+        result['changed'] = False
+        result['lvs'] = planned_lvs
+        return result
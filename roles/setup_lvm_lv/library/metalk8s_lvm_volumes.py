@@ -0,0 +1,528 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Create, format and mount all the LVM LVs of a host at once
+
+`lvs` is the `metalk8s_lvm_all_lvs` fact of the host: the LVs, by path
+(`/dev/mapper/<vg>-<lv>`), with their `lv_name`, `vg_prop` (`vg_name` and
+`host_path`), `size` (or `exact_size`, see the `plan_lvm_lvs` action),
+`fstype`, `fs_opts`, `force` and `mount_opts`.
+
+In a single invocation, for each LV:
+
+- the LV is created, as by the `lvol` module, or extended if it is smaller
+  than its `exact_size` (LVs are never shrunk)
+- a filesystem is created if the LV has none, as by the `filesystem` module:
+  an LV with another filesystem is only formatted again with `force`
+- the UUID of its filesystem is read
+- it is mounted on `<host_path>/<uuid>`, and added to the `fstab`, as by the
+  `mount` module with `state: mounted`
+
+The LVs are formatted concurrently, by at most `workers` threads, and by at
+most `format_per_device` of them on each physical device backing the LVs
+(e.g. 1 for a spinning disk, more for an SSD), so that LVs of different disks
+are formatted at once while the LVs of a disk do not compete for it. With
+`fast_format`, the inode tables and journal of ext4 are initialized lazily,
+once mounted, and the blocks are not discarded by mkfs (ext4, xfs and btrfs),
+unless `fs_opts` sets these options. An LV which fails at a stage is not
+handled by the next ones, the other LVs are.
+
+  .. code::
+
+    - name: 'LVM Setup: Create, format and mount the LVM LVs'
+      metalk8s_lvm_volumes:
+        lvs: '{{ metalk8s_lvm_all_lvs }}'
+      register: metalk8s_lvm_volumes
+
+The filesystems (type and UUID, by `blkid`) and the mountpoints (from
+`/proc/mounts`) of all the devices of the host are read in a single scan,
+before formatting and again once the LVs are formatted, instead of once per
+LV: the result gives them as `filesystems`, by `/dev/mapper` path, for the
+LVs.
+
+The result gives, for each LV, its `status` (`ok`, `changed` or `failed`),
+the actions taken (`created`, `extended`, `formatted`, `mounted`), its
+`uuid`, its backing `devices` and the `duration` of each stage. `lvs` is
+the `lvs` parameter with the `uuid` of each LV.
+'''
+
+import os
+import re
+import shlex
+import tempfile
+import threading
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+
+
+# Flags of mkfs to overwrite an existing filesystem, by fstype
+MKFS_FORCE_FLAGS = {
+    'ext2': '-F',
+    'ext3': '-F',
+    'ext4': '-F',
+    'xfs': '-f',
+    'btrfs': '-f',
+}
+
+# Options of mkfs to skip the slow parts of formatting, by fstype, and the
+# flag in `fs_opts` which overrides them
+FAST_FORMAT_OPTIONS = {
+    'ext4': ('-E', ['-E', 'lazy_itable_init=1,lazy_journal_init=1,nodiscard']),
+    'xfs': ('-K', ['-K']),
+    'btrfs': ('--nodiscard', ['--nodiscard']),
+}
+
+PERCENT_RE = re.compile(r'^\d+%(VG|PVS|FREE)$', re.IGNORECASE)
+
+SYS_CLASS_BLOCK = '/sys/class/block'
+
+
+class VolumeError(Exception):
+    pass
+
+
+class Volume(object):
+    '''An LV to provision, and what was done to it'''
+
+    def __init__(self, path, lv):
+        self.path = path
+        self.lv = lv
+        self.lv_name = lv['lv_name']
+        self.vg_name = lv['vg_prop']['vg_name']
+        self.host_path = lv['vg_prop']['host_path']
+        self.fstype = lv.get('fstype') or 'ext4'
+        self.fs_opts = lv.get('fs_opts') or ''
+        self.force = bool(lv.get('force'))
+        self.mount_opts = lv.get('mount_opts') or 'defaults'
+        self.uuid = None
+        self.actions = []
+        self.durations = {}
+        self.devices = []
+        self.error = None
+
+    @property
+    def exact_size(self):
+        '''Exact size in bytes, None if not planned'''
+        exact_size = self.lv.get('exact_size')
+        if exact_size:
+            return int(str(exact_size).rstrip('bB'))
+        return None
+
+    @property
+    def mountpoint(self):
+        return '{}/{}'.format(self.host_path.rstrip('/'), self.uuid)
+
+    def result(self):
+        if self.error:
+            status = 'failed'
+        elif self.actions:
+            status = 'changed'
+        else:
+            status = 'ok'
+        result = {
+            'status': status,
+            'actions': self.actions,
+            'uuid': self.uuid,
+            'devices': self.devices,
+            'duration': dict(
+                (stage, round(duration, 3))
+                for stage, duration in self.durations.items()),
+        }
+        if self.error:
+            result['msg'] = self.error
+        return result
+
+
+def backing_devices(path):
+    '''The physical devices (disks, not partitions) backing a device
+
+    Device-mapper devices (LVs, but also e.g. multipath or dm-crypt devices)
+    are followed down to their slaves.
+    '''
+    name = os.path.basename(os.path.realpath(path))
+    sysdir = os.path.realpath(os.path.join(SYS_CLASS_BLOCK, name))
+    if not os.path.isdir(sysdir):
+        return []
+    slaves = sorted(os.listdir(os.path.join(sysdir, 'slaves'))) \
+        if os.path.isdir(os.path.join(sysdir, 'slaves')) else []
+    if slaves:
+        devices = set()
+        for slave in slaves:
+            devices.update(backing_devices(os.path.join('/dev', slave)))
+        return sorted(devices)
+    if os.path.exists(os.path.join(sysdir, 'partition')):
+        # The parent directory of a partition is its disk
+        return [os.path.basename(os.path.dirname(sysdir))]
+    return [name]
+
+
+class DeviceSlots(object):
+    '''Hand out volumes to format, at most `limit` at once per device'''
+
+    def __init__(self, volumes, limit):
+        self.pending = list(volumes)
+        self.limit = max(1, limit)
+        self.busy = {}
+        self.condition = threading.Condition()
+
+    def _ready(self):
+        for volume in self.pending:
+            if all(self.busy.get(device, 0) < self.limit
+                   for device in volume.devices):
+                return volume
+        return None
+
+    def acquire(self):
+        '''The next volume whose devices are not busy, None when done'''
+        with self.condition:
+            while self.pending:
+                volume = self._ready()
+                if volume is not None:
+                    self.pending.remove(volume)
+                    for device in volume.devices:
+                        self.busy[device] = self.busy.get(device, 0) + 1
+                    return volume
+                self.condition.wait()
+            return None
+
+    def release(self, volume):
+        with self.condition:
+            for device in volume.devices:
+                self.busy[device] -= 1
+            self.condition.notify_all()
+
+
+class VolumeProvisioner(object):
+    '''Provision the LVs of a host, stage by stage'''
+
+    def __init__(self, module, volumes):
+        self.module = module
+        self.volumes = volumes
+        self.check_mode = module.check_mode
+        self.filesystems = {}
+        self.scans = []
+        self._lock = threading.Lock()
+
+    def _run(self, volume, stage, cmd, changes=True):
+        '''Run a command for a volume, fail the volume if it fails'''
+        if changes and self.check_mode:
+            return ''
+        start = time.time()
+        rc, out, err = self.module.run_command(cmd)
+        with self._lock:
+            volume.durations[stage] = volume.durations.get(stage, 0) + \
+                time.time() - start
+        if rc != 0:
+            raise VolumeError('{} failed: {}'.format(
+                os.path.basename(cmd[0]),
+                err.strip() or out.strip() or 'exited with {}'.format(rc)))
+        return out
+
+    def _bin(self, name):
+        path = self.module.get_bin_path(name)
+        if path is None:
+            raise VolumeError('Cannot find the {} command'.format(name))
+        return path
+
+    def _each(self, stage, volumes):
+        '''Run a stage on the volumes which did not fail yet'''
+        for volume in volumes:
+            if volume.error is None:
+                self._stage(stage, volume)
+
+    @staticmethod
+    def _stage(stage, volume):
+        try:
+            stage(volume)
+        except VolumeError as exc:
+            volume.error = str(exc)
+        except Exception as exc:
+            volume.error = 'Unexpected error: {}'.format(exc)
+
+    def existing_lvs(self):
+        '''The size in bytes of the existing LVs, by (VG, LV)'''
+        lvs = self.module.get_bin_path('lvs', required=True)
+        rc, out, err = self.module.run_command([
+            lvs, '--noheadings', '--nosuffix', '--units', 'b',
+            '--separator', ';', '--options', 'vg_name,lv_name,lv_size'])
+        if rc != 0:
+            self.module.fail_json(msg='lvs failed: {}'.format(err.strip()))
+        existing = {}
+        for line in out.splitlines():
+            fields = line.strip().split(';')
+            if len(fields) == 3:
+                existing[(fields[0], fields[1])] = int(fields[2])
+        return existing
+
+    def create(self, volume, existing):
+        '''Create the LV, or extend it up to its exact size'''
+        size = existing.get((volume.vg_name, volume.lv_name))
+        exact_size = volume.exact_size
+        if size is None:
+            requested = volume.lv.get('exact_size') or volume.lv.get('size')
+            if requested is None:
+                raise VolumeError('No size for the LV')
+            if PERCENT_RE.match(str(requested)):
+                size_args = ['-l', str(requested)]
+            else:
+                size_args = ['-L', str(requested)]
+            self._run(volume, 'create', [
+                self._bin('lvcreate'), '--yes', '-n', volume.lv_name
+            ] + size_args + [volume.vg_name])
+            volume.actions.append('created')
+        elif exact_size is not None and size < exact_size:
+            self._run(volume, 'create', [
+                self._bin('lvextend'), '--resizefs',
+                '-L', '{}b'.format(exact_size),
+                '{}/{}'.format(volume.vg_name, volume.lv_name)])
+            volume.actions.append('extended')
+
+    def current_fstype(self, volume):
+        '''The type of the filesystem of the LV, empty if it has none'''
+        return self.filesystems.get(volume.path, {}).get('fstype', '')
+
+    def format(self, volume):
+        '''Create the filesystem of the LV, unless it already has one'''
+        if self.check_mode and 'created' in volume.actions:
+            current = ''
+        else:
+            current = self.current_fstype(volume)
+        if current == volume.fstype and not volume.force:
+            return
+        if current and not volume.force:
+            raise VolumeError(
+                "{} is already used as {}, use force=True to overwrite"
+                .format(volume.path, current))
+        cmd = [self._bin('mkfs.{}'.format(volume.fstype))]
+        if volume.fstype in MKFS_FORCE_FLAGS:
+            cmd.append(MKFS_FORCE_FLAGS[volume.fstype])
+        fs_opts = shlex.split(volume.fs_opts)
+        cmd.extend(fs_opts)
+        if self.module.params['fast_format'] and \
+                volume.fstype in FAST_FORMAT_OPTIONS:
+            flag, options = FAST_FORMAT_OPTIONS[volume.fstype]
+            if flag not in fs_opts:
+                cmd.extend(options)
+        cmd.append(volume.path)
+        self._run(volume, 'format', cmd)
+        volume.actions.append('formatted')
+
+    def format_all(self, volumes):
+        '''Format the volumes, limiting the concurrency on each device'''
+        volumes = [volume for volume in volumes if volume.error is None]
+        for volume in volumes:
+            volume.devices = backing_devices(volume.path)
+        slots = DeviceSlots(volumes, self.module.params['format_per_device'])
+
+        def worker():
+            while True:
+                volume = slots.acquire()
+                if volume is None:
+                    return
+                try:
+                    self._stage(self.format, volume)
+                finally:
+                    slots.release(volume)
+
+        workers = min(self.module.params['workers'], len(volumes))
+        threads = [threading.Thread(target=worker)
+                   for _ in range(max(1, workers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def scan(self):
+        '''Index the filesystems and mountpoints of the host'''
+        start = time.time()
+        self.filesystems = read_filesystems(self.module)
+        self.scans.append(round(time.time() - start, 3))
+
+    def discover_uuid(self, volume):
+        if self.check_mode and 'formatted' in volume.actions:
+            volume.uuid = volume.lv.get('uuid') or 'UNKNOWN'
+            return
+        volume.uuid = self.filesystems.get(volume.path, {}).get('uuid')
+        if not volume.uuid:
+            raise VolumeError('No filesystem UUID for {}'.format(volume.path))
+
+    def mount(self, volumes, fstab):
+        '''Add the LVs to the fstab at once, then mount them'''
+        volumes = [volume for volume in volumes if volume.error is None]
+        entries = dict(
+            (volume.mountpoint, 'UUID={} {} {} {} 0 0'.format(
+                volume.uuid, volume.mountpoint, volume.fstype,
+                volume.mount_opts))
+            for volume in volumes)
+        updated = update_fstab(self.module, fstab, entries, self.check_mode)
+        for volume in volumes:
+            mounted = self.filesystems.get(
+                volume.path, {}).get('mountpoints', [])
+            start = time.time()
+            try:
+                if not self.check_mode and \
+                        not os.path.isdir(volume.mountpoint):
+                    os.makedirs(volume.mountpoint)
+                if volume.mountpoint not in mounted:
+                    self._run(volume, 'mount',
+                              [self._bin('mount'), volume.mountpoint])
+                    volume.actions.append('mounted')
+                elif volume.mountpoint in updated:
+                    self._run(volume, 'mount',
+                              [self._bin('mount'), '-o', 'remount',
+                               volume.mountpoint])
+                    volume.actions.append('remounted')
+            except (OSError, VolumeError) as exc:
+                volume.error = str(exc)
+            volume.durations['mount'] = time.time() - start
+
+    def run(self):
+        existing = self.existing_lvs()
+        self._each(lambda volume: self.create(volume, existing), self.volumes)
+        self.scan()
+        self.format_all(self.volumes)
+        if not self.check_mode and any(
+                'formatted' in volume.actions for volume in self.volumes):
+            self.scan()
+        self._each(self.discover_uuid, self.volumes)
+        self.mount(self.volumes, self.module.params['fstab'])
+
+
+def mapper_path(device):
+    '''The `/dev/mapper` path of a device-mapper device, e.g. `/dev/dm-3`'''
+    name = os.path.basename(os.path.realpath(device))
+    if name.startswith('dm-'):
+        try:
+            with open(os.path.join(SYS_CLASS_BLOCK, name, 'dm', 'name')) as dm:
+                return '/dev/mapper/{}'.format(dm.read().strip())
+        except IOError:
+            pass
+    return device
+
+
+def read_mounts(path='/proc/mounts'):
+    '''The (device, mountpoint) pairs of the mounted block devices'''
+    mounts = []
+    with open(path) as mounts_file:
+        for line in mounts_file:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].startswith('/dev/'):
+                # Spaces are escaped as \040 in /proc/mounts
+                mounts.append((fields[0], fields[1].replace('\\040', ' ')))
+    return mounts
+
+
+def read_filesystems(module):
+    '''The filesystem of each block device of the host, in a single scan
+
+    All the devices are probed by a single `blkid` (bypassing its cache), and
+    the mountpoints are read from `/proc/mounts`.
+
+    :returns: The `fstype`, `uuid` and `mountpoints` of each device, by path
+        (`/dev/mapper/<name>` for device-mapper devices)
+    '''
+    blkid = module.get_bin_path('blkid', required=True)
+    rc, out, err = module.run_command(
+        [blkid, '-c', '/dev/null', '-o', 'export'])
+    # blkid exits with 2 when no device has a filesystem
+    if rc not in (0, 2):
+        module.fail_json(msg='blkid failed: {}'.format(err.strip()))
+
+    filesystems = {}
+    for block in re.split(r'\n\s*\n', out.strip()):
+        fields = dict(line.split('=', 1)
+                      for line in block.splitlines() if '=' in line)
+        if 'DEVNAME' in fields:
+            filesystems[mapper_path(fields['DEVNAME'])] = {
+                'fstype': fields.get('TYPE', ''),
+                'uuid': fields.get('UUID', ''),
+                'mountpoints': [],
+            }
+    for device, mountpoint in read_mounts():
+        filesystems.setdefault(mapper_path(device), {
+            'fstype': '', 'uuid': '', 'mountpoints': [],
+        })['mountpoints'].append(mountpoint)
+    return filesystems
+
+
+def update_fstab(module, fstab, entries, check_mode=False):
+    '''Set the fstab entries of the mountpoints, in a single write
+
+    :param dict entries: The line of each mountpoint
+    :returns: The mountpoints whose entry was added or changed
+    '''
+    try:
+        with open(fstab) as fstab_file:
+            lines = fstab_file.read().splitlines()
+    except IOError:
+        lines = []
+
+    updated = set()
+    pending = dict(entries)
+    for position, line in enumerate(lines):
+        fields = line.split()
+        if not fields or fields[0].startswith('#') or len(fields) < 2:
+            continue
+        if fields[1] in pending:
+            entry = pending.pop(fields[1])
+            if line.split() != entry.split():
+                lines[position] = entry
+                updated.add(fields[1])
+    for mountpoint, entry in sorted(pending.items()):
+        lines.append(entry)
+        updated.add(mountpoint)
+
+    if updated and not check_mode:
+        fd, path = tempfile.mkstemp(
+            prefix='.fstab.', dir=os.path.dirname(os.path.abspath(fstab)))
+        with os.fdopen(fd, 'w') as fstab_file:
+            fstab_file.write('\n'.join(lines) + '\n')
+        module.atomic_move(path, fstab)
+    return updated
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            lvs=dict(type='dict', required=True),
+            fstab=dict(type='str', default='/etc/fstab'),
+            workers=dict(type='int', default=8),
+            format_per_device=dict(type='int', default=1),
+            fast_format=dict(type='bool', default=True),
+        ),
+        supports_check_mode=True,
+    )
+
+    try:
+        volumes = [Volume(path, lv)
+                   for path, lv in sorted(module.params['lvs'].items())]
+    except (KeyError, TypeError) as exc:
+        module.fail_json(msg='Invalid LV in lvs: {}'.format(exc))
+
+    start = time.time()
+    provisioner = VolumeProvisioner(module, volumes)
+    provisioner.run()
+
+    results = dict((volume.path, volume.result()) for volume in volumes)
+    filesystems = dict((volume.path, provisioner.filesystems[volume.path])
+                       for volume in volumes
+                       if volume.path in provisioner.filesystems)
+    lvs = dict((volume.path, dict(volume.lv, uuid=volume.uuid))
+               for volume in volumes)
+    changed = any(volume.actions for volume in volumes)
+    failed = sorted(volume.path for volume in volumes if volume.error)
+    if failed:
+        module.fail_json(
+            msg='Failed to provision the LVM LVs: {}'.format('; '.join(
+                '{}: {}'.format(path, results[path]['msg'])
+                for path in failed)),
+            changed=changed, volumes=results, lvs=lvs,
+            filesystems=filesystems, scans=provisioner.scans)
+    module.exit_json(changed=changed, volumes=results, lvs=lvs,
+                     filesystems=filesystems, scans=provisioner.scans,
+                     duration=round(time.time() - start, 3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''LVM sizes, shared by the `plan_lvm_lvs` action and the `size_lvm_to_k8s`
+filter
+
+Ansible only makes the `module_utils` of roles importable by modules: the
+plugins, which run on the controller, load this file by its path.
+'''
+
+import fractions
+import re
+
+
+# Units of the `--size` of lvcreate(8), all of them powers of 1024
+UNITS = {
+    'b': 1,
+    's': 512,
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+    't': 1024 ** 4,
+    'p': 1024 ** 5,
+    'e': 1024 ** 6,
+}
+DEFAULT_UNIT = 'm'
+
+SIZE_RE = re.compile(r'^(?P<value>\d+(\.\d+)?)(?P<unit>[bskmgtpe])?$',
+                     re.IGNORECASE)
+PERCENT_RE = re.compile(r'^(?P<value>\d+)%(?P<whole>VG|PVS|FREE)$',
+                        re.IGNORECASE)
+
+
+class SizeError(ValueError):
+    pass
+
+
+def size_in_bytes(size):
+    '''Exact size in bytes of an LVM size, None if relative to a VG
+
+    :raises SizeError: if `size` is not a valid size
+    '''
+    size = str(size).strip()
+    if PERCENT_RE.match(size):
+        return None
+    match = SIZE_RE.match(size)
+    if match is None:
+        raise SizeError('Invalid size {!r}'.format(size))
+    unit = (match.group('unit') or DEFAULT_UNIT).lower()
+    exact = fractions.Fraction(match.group('value')) * UNITS[unit]
+    # Sizes are rounded up, to the byte
+    return -(-exact.numerator // exact.denominator)
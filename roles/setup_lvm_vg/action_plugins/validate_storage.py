@@ -103,80 +103,113 @@ A sample of a device dictionary as seen with ansible setup module:
 '''
 
 # Note: to add mode checks/validations, simply add a top-level function whose
-# name starts with `check_`. The function will receive a `task_vars` dictionary
-# as defined by Ansible.
+# name starts with `check_`. The function will receive the `hostvars` of a
+# host, limited to the variables listed in `STORAGE_FACTS` and
+# `STORAGE_CONFIGURATION` (add the ones it needs there), and the
+# `DeviceIndex` of its devices.
 # Within a `check_*` function, use `assert` to validate values found in
-# `task_vars`, or raise `AssertionError` explicitly. A single check can, of
+# `hostvars`, or raise `AssertionError` explicitly. A single check can, of
 # course, contain multiple assertions.
 # Alternatively, for checks which can result in multiple errors, a check can
 # return a list of (or yield) error messages.
 
 from ansible.plugins.action import ActionBase
 
+from ansible.module_utils.six.moves import queue
+
+import hashlib
 import inspect
+import json
+import os
 import sys
+import tempfile
+import threading
+import time
 
 
-def is_drive_raw_device(device, ansible_devices):
-    '''Check whether a drive is a raw device or partition
-
-    :param str device: The name of the device
-        i.e: 'sdb' or 'sdb1'
-    :param dict ansible_devices: The dictionary of devices gather by the
-        'setup' ansible module
-    :returns: A tuple with True, and the device details from ansible_devices
-        if the device is a raw device. False otherwise
-    :rtype: tuple
-    '''
-
-    if device in ansible_devices:
-        return True, ansible_devices[device]
-
-    return False
-
-
-def get_drive_attributes(device, ansible_devices, unused=False):
-    '''Check whether a drive is a raw device or partition
-
-    :param str device: The name of the device
-        i.e: 'sdb' or 'sdb1'
-    :param dict ansible_devices: The dictionary of devices gather by the
-        'setup' ansible module
-    :returns: True if the device is a raw device. False otherwise
-    :rtype: bool
-    :returns: A tuple with True, and the partition details from ansible_devices
-        if the device is a partition. False otherwise
-    :rtype: tuple
-    '''
-
-    for ansible_device, device_attr in ansible_devices.items():
-        try:
-            return True, device_attr['partitions'][device]
-        except KeyError:
-            continue  # May also pass if device_attr has no 'partitions' key
-
-    return False, {}
+# Variables of a host on which the checks depend
+STORAGE_FACTS = ['ansible_devices', 'ansible_lvm']
+STORAGE_CONFIGURATION = ['metalk8s_lvm_all_vgs']
 
 
-def is_device_present(device, ansible_devices):
-    '''Check that the device passed in parameters exists
+class DeviceIndex(object):
+    '''Index of the devices of a host, built once from its facts
 
-    The device can be either a raw device or a partition but nothing else.
+    Checks look devices up for each configured drive: indexing
+    `ansible_devices` (raw devices and their partitions, by name, by-id link
+    and UUID) and `ansible_lvm` (VG of each PV, and PVs of each VG) makes
+    each lookup a dictionary access, whatever the number of devices.
 
-    :param str device: The name of the device
-        i.e: 'sdb' or 'sdb1'
-    :param dict ansible_devices: The dictionary of devices gather by the
+    :param dict ansible_devices: The dictionary of devices gathered by the
         'setup' ansible module
-    :returns: True if the device is in ansible_devices. False otherwise
-    :rtype: bool
+    :param dict ansible_lvm: The dictionary of LVM PVs and VGs gathered by
+        the 'setup' ansible module
     '''
 
-    # if the device is a raw device, check its presence
-    if get_drive_attributes(device, ansible_devices) \
-       or is_drive_raw_device(device, ansible_devices):
-        return True
-
-    return False
+    def __init__(self, ansible_devices, ansible_lvm=None):
+        # name -> attributes of the raw devices
+        self.raw_devices = {}
+        # name -> attributes of the partitions
+        self.partitions = {}
+        # by-id link or UUID -> name of the device
+        self.ids = {}
+        self.uuids = {}
+        # '/dev/<name>' -> VG of the LVM PVs
+        self.pv_vg = {}
+        # VG -> '/dev/<name>' of its PVs
+        self.vg_pvs = {}
+        self.vgs = set()
+
+        for name, attrs in (ansible_devices or {}).items():
+            self.raw_devices[name] = attrs
+            self._index_links(name, attrs)
+            for part_name, part_attrs in \
+                    (attrs.get('partitions') or {}).items():
+                self.partitions[part_name] = part_attrs
+                self._index_links(part_name, part_attrs)
+
+        ansible_lvm = ansible_lvm or {}
+        for pv, pv_attrs in (ansible_lvm.get('pvs') or {}).items():
+            self.pv_vg[pv] = pv_attrs.get('vg')
+            self.vg_pvs.setdefault(pv_attrs.get('vg'), []).append(pv)
+        self.vgs.update(ansible_lvm.get('vgs') or {})
+
+    @classmethod
+    def from_hostvars(cls, hostvars):
+        return cls(hostvars.get('ansible_devices'),
+                   hostvars.get('ansible_lvm'))
+
+    def _index_links(self, name, attrs):
+        links = attrs.get('links') or {}
+        for link in links.get('ids') or []:
+            self.ids[link] = name
+        for uuid in links.get('uuids') or []:
+            self.uuids[uuid] = name
+        if attrs.get('uuid'):
+            self.uuids[attrs['uuid']] = name
+
+    def resolve(self, device):
+        '''Name of a device given by path
+
+        :param str device: '/dev/<name>', '/dev/disk/by-id/<id>' or
+            '/dev/disk/by-uuid/<uuid>'
+        :returns: The name of the device (e.g. 'sdb' or 'sdb1'), the path
+            stripped of '/dev/' if it does not match any link
+        :rtype: str
+        '''
+        if device.startswith('/dev/disk/by-id/'):
+            return self.ids.get(device[len('/dev/disk/by-id/'):], device)
+        if device.startswith('/dev/disk/by-uuid/'):
+            return self.uuids.get(device[len('/dev/disk/by-uuid/'):], device)
+        return device.replace('/dev/', '')
+
+    def is_present(self, name):
+        '''Whether `name` is a raw device or a partition'''
+        return name in self.raw_devices or name in self.partitions
+
+    def pvs_of_vg(self, lvm_vg):
+        '''Sorted list of the PVs of a LVM Volume Group'''
+        return sorted(self.vg_pvs.get(lvm_vg, []))
 
 
 def verify_if_used_by_filesystem(device, uuid):
@@ -200,7 +233,7 @@ def verify_if_used_by_filesystem(device, uuid):
     )
 
 
-def verify_if_drive_used(device, lvm_vg, hostvars):
+def verify_if_drive_used(device, lvm_vg, devices):
     '''Check if a device is used
 
     there is two scenarii, raw device and partition.
@@ -218,70 +251,57 @@ def verify_if_drive_used(device, lvm_vg, hostvars):
 
     :param str device: Device to check
     :param str lvm_vg: LVM Volume Group
-    :param dict hostvars: Ansible hostvars variable
+    :param DeviceIndex devices: Index of the devices of the host
 
     :raises: AssertionError
     '''
 
-    result, dev_attr = is_drive_raw_device(device, hostvars['ansible_devices'])
-    if result:
-        assert not dev_attr['partitions'], (
+    dev_attr = devices.raw_devices.get(device)
+    if dev_attr is not None:
+        assert not dev_attr.get('partitions'), (
             "The device {dev} already have partitions. "
             "Please remove them.".format(
                 dev=device,
             )
         )
-        try:
-            verify_if_used_by_filesystem(device, dev_attr['links']['uuids'][0])
-        except IndexError:
-            pass
-
-    result, dev_attr = get_drive_attributes(
-        device, hostvars['ansible_devices'])
-    if result:
-        verify_if_used_by_filesystem(device, dev_attr['uuid'])
-
-    try:
-        # If the device is already a LVM Physical Volume
-        # check its VG
-        pv_device = "/dev/" + device
-        if pv_device in hostvars['ansible_lvm']['pvs']:
-            assert lvm_vg == hostvars['ansible_lvm']['pvs'][pv_device]['vg'], (
-                "The device {dev} is already a LVM Physical Volume but is "
-                "part of the LVM Volume Group {vg}. Please either remove "
-                "the device from this VG or modify your configuration.".format(
-                    dev=pv_device,
-                    vg=hostvars['ansible_lvm']['pvs'][pv_device]['vg'],
-                )
+        uuids = (dev_attr.get('links') or {}).get('uuids') or []
+        if uuids:
+            verify_if_used_by_filesystem(device, uuids[0])
+
+    dev_attr = devices.partitions.get(device)
+    if dev_attr is not None:
+        verify_if_used_by_filesystem(device, dev_attr.get('uuid'))
+
+    # If the device is already a LVM Physical Volume
+    # check its VG
+    pv_device = "/dev/" + device
+    if pv_device in devices.pv_vg:
+        assert lvm_vg == devices.pv_vg[pv_device], (
+            "The device {dev} is already a LVM Physical Volume but is "
+            "part of the LVM Volume Group {vg}. Please either remove "
+            "the device from this VG or modify your configuration.".format(
+                dev=pv_device,
+                vg=devices.pv_vg[pv_device],
             )
-    # If not found, do nothing
-    except KeyError:
-        pass
-
+        )
 
-def get_pv_from_vg(ansible_lvm, lvm_vg):
-    '''get the list of devices currently defined for a LVM Volume Group
 
-    This function parse the ansible fact *ansible_lvm* to find the list of LVM
-    Physical Volume being part of the gieven LVM Volume Group *lvm_vg*
+def configured_drives(vg_attr, devices):
+    '''The drives configured for a VG, as '/dev/<name>' paths
 
-    :param dict ansible_lvm: Dictionary from ansible fact *ansible_lvm*
-    :param str lvm_vg: the name of the LVM Volume Group of which
-        we want the devices
-    :return: Sorted list of devices for the given LVM Volume Group
-    :rype: list
+    Drives given by by-id or by-uuid links are resolved, to be compared with
+    the PVs of `ansible_lvm`.
     '''
+    return set('/dev/' + devices.resolve(drive)
+               for drive in vg_attr.get('drives', []))
 
-    devices = [device for device in ansible_lvm['pvs'].keys()
-               if ansible_lvm['pvs'][device]['vg'] == lvm_vg]
-    return sorted(devices)
 
-
-def verify_if_vg_defined_with_right_device(mk8s_vg, hostvars):
+def verify_if_vg_defined_with_right_device(hostvars, devices):
     '''Check that the current existing VG has still the right devices
 
     :param dict hostvars: The dictionary 'hostvars' from 'setup' ansible module
         for a specific host
+    :param DeviceIndex devices: Index of the devices of the host
     :raises: AssertionError
 
     Raise AssertionError if the LVM Volume Group already exists and the devices
@@ -290,26 +310,17 @@ def verify_if_vg_defined_with_right_device(mk8s_vg, hostvars):
 
     # Check if VG is already defined first
     for lvm_vg, vg_attr in hostvars.get('metalk8s_lvm_all_vgs', {}).items():
-        try:
-            # if not defined, skip, it will be created later
-            # Careful because key is 'lvm' here, and not 'ansible_lvm'
-            # as seen when executing "setup" ansible module
-            # TODO(benjamin.allot): be sure that ['ansible_lvm'] always exists
-            if lvm_vg not in hostvars['ansible_lvm']['vgs']:
-                continue
-        # if one of the previous key is missing, we're on a fresh install
-        # so we can skip too
-        except KeyError:
+        # if not defined, skip, it will be created later
+        if lvm_vg not in devices.vgs:
             continue
 
         # the VG is already existing and we check the devices in place
         # versus the one in the configuration
-        current_vg_drives = set(get_pv_from_vg(
-            hostvars['ansible_lvm'], lvm_vg))
-        configuration_vg_drives = set(vg_attr.get('drives', []))
+        current_vg_drives = set(devices.pvs_of_vg(lvm_vg))
+        configuration_vg_drives = configured_drives(vg_attr, devices)
 
         # Get the difference in the error message
-        missing_drives = list(current_vg_drives.difference(
+        missing_drives = sorted(current_vg_drives.difference(
             configuration_vg_drives))
         assert current_vg_drives.issubset(configuration_vg_drives), (
             'The LVM Volume Group {vg} contains devices not present in '
@@ -320,12 +331,12 @@ def verify_if_vg_defined_with_right_device(mk8s_vg, hostvars):
             '{wanted_drives}.'.format(
                 vg=lvm_vg,
                 missing_drives=missing_drives,
-                wanted_drives=list(configuration_vg_drives),
+                wanted_drives=sorted(configuration_vg_drives),
             )
         )
 
 
-def check_devices_presence_and_usage(hostvars):
+def check_devices_presence_and_usage(hostvars, devices):
     '''Check presence and usage of drives defined by metalk8s_lvm_drives_*
 
     Check that the devices specified in metalk8s_lvm_drives_<vg name>
@@ -333,6 +344,7 @@ def check_devices_presence_and_usage(hostvars):
 
     :param dict hostvars: The dictionary 'hostvars' from 'setup' ansible module
         for a specific host
+    :param DeviceIndex devices: Index of the devices of the host
     :raises: AssertionError
 
     Raise AssertionError:
@@ -354,22 +366,13 @@ def check_devices_presence_and_usage(hostvars):
 
         # Set the variable name for the list of drives of this VG
         mk8s_vg_drives_var = 'metalk8s_lvm_drives_' + lvm_vg
-        vg_found = False
-
-        # Check if the VG already exists
-        try:
-            if lvm_vg in hostvars['ansible_lvm']['vgs']:
-                vg_found = True
-        except KeyError:
-            pass
 
         # the VG is already existing and we check the devices in place
         # versus the one in the configuration
-        if vg_attr['drives'] and vg_found:
+        if vg_attr['drives'] and lvm_vg in devices.vgs:
 
-            current_vg_drives = set(get_pv_from_vg(
-                hostvars['ansible_lvm'], lvm_vg))
-            configuration_vg_drives = set(vg_attr.get('drives', []))
+            current_vg_drives = set(devices.pvs_of_vg(lvm_vg))
+            configuration_vg_drives = configured_drives(vg_attr, devices)
 
             # if we have the same drives, continue
             if current_vg_drives == configuration_vg_drives:
@@ -377,7 +380,7 @@ def check_devices_presence_and_usage(hostvars):
 
             # Get the difference and keep the added devices to
             # be checked later on
-            missing_drives = list(configuration_vg_drives.difference(
+            missing_drives = sorted(configuration_vg_drives.difference(
                 current_vg_drives))
             devices_to_check.extend(missing_drives)
 
@@ -392,7 +395,7 @@ def check_devices_presence_and_usage(hostvars):
                     vg=lvm_vg,
                     vg_drives_var=mk8s_vg_drives_var,
                     missing_drives=missing_drives,
-                    wanted_drives=list(configuration_vg_drives),
+                    wanted_drives=sorted(configuration_vg_drives),
                 )
             )
 
@@ -407,11 +410,11 @@ def check_devices_presence_and_usage(hostvars):
 
         for device in devices_to_check:
 
-            # Strip the '/dev/' string to keep only the last part
-            device_name = device.replace('/dev/', '')
+            # Strip the '/dev/' string to keep only the last part, or resolve
+            # the by-id and by-uuid links
+            device_name = devices.resolve(device)
 
-            assert is_device_present(
-                device_name, hostvars['ansible_devices']), \
+            assert devices.is_present(device_name), \
                 "The device {0} is not present".format(device)
 
             assert '/' not in device_name, \
@@ -421,11 +424,133 @@ def check_devices_presence_and_usage(hostvars):
 
             # Check that the device is free for usage
             # (see verify_if_drive_used)
-            verify_if_drive_used(device_name, lvm_vg, hostvars)
+            verify_if_drive_used(device_name, lvm_vg, devices)
+
+
+def resolve_hostvars(hostvars):
+    '''The variables of a host on which the checks depend, as a plain dict'''
+    return dict((key, hostvars.get(key))
+                for key in STORAGE_FACTS + STORAGE_CONFIGURATION)
+
+
+def fingerprint(hostvars, keys):
+    '''Fingerprint of the values of some variables of a host'''
+    values = dict((key, hostvars.get(key)) for key in keys)
+    return hashlib.sha256(json.dumps(
+        values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def checks_fingerprint():
+    '''Fingerprint of the checks, i.e. of this file'''
+    with open(__file__.replace('.pyc', '.py'), 'rb') as source:
+        return hashlib.sha256(source.read()).hexdigest()
+
+
+class ValidationCache(object):
+    '''Fingerprints of the hosts successfully validated, on the controller
+
+    A host whose storage facts and configuration have the fingerprints of
+    its last successful validation, with the same checks, is not validated
+    again.
+
+    :param str path: Path of the JSON cache, None to disable it
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path) if path else None
+        self.checks = checks_fingerprint()
+        self.hosts = {}
+        if not self.path:
+            return
+        try:
+            with open(self.path) as cache_file:
+                content = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return
+        if content.get('checks') == self.checks:
+            self.hosts = content.get('hosts', {})
+
+    def revalidation_reason(self, host, facts, configuration):
+        '''Why the host must be validated, None if it must not'''
+        if not self.path:
+            return 'no validation cache'
+        previous = self.hosts.get(host)
+        if previous is None:
+            return 'not validated yet, or checks changed'
+        reasons = []
+        if previous.get('facts') != facts:
+            reasons.append('storage facts changed')
+        if previous.get('configuration') != configuration:
+            reasons.append('storage configuration changed')
+        return ', '.join(reasons) or None
+
+    def save(self, validated, failed):
+        '''Record the validated hosts, forget the failed ones'''
+        if not self.path:
+            return
+        self.hosts.update(validated)
+        for host in failed:
+            self.hosts.pop(host, None)
+        directory = os.path.dirname(self.path) or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump({'checks': self.checks, 'hosts': self.hosts},
+                      cache_file, indent=2, sort_keys=True)
+        os.rename(path, self.path)
+
+
+def run_checks(checks, hostvars):
+    '''Run the checks on a host
+
+    :param list checks: (name, function) tuples of the checks
+    :returns: The (check name, message) tuples of the errors, in the order
+        of the checks, and the duration of each check
+    :rtype: tuple
+    '''
+    errors = []
+    durations = {}
+
+    start = time.time()
+    devices = DeviceIndex.from_hostvars(hostvars)
+    durations['index'] = time.time() - start
+
+    for (name, check) in checks:
+        start = time.time()
+        try:
+            results = check(hostvars, devices)
+            if not results:
+                # Simple `assert`-check, passed and returned `None`
+                results = []
+
+            for message in results:
+                errors.append((name, message))
+
+        except AssertionError as exc:
+            errors.append((
+                name,
+                exc.args[0] if len(exc.args) >= 1 else 'Unknown failure'))
+        durations[name] = time.time() - start
+
+    return errors, durations
 
 
 class ActionModule(ActionBase):
-    '''Check storage configuration against the current setup for MetalK8s'''
+    '''Check storage configuration against the current setup for MetalK8s
+
+    The hosts are checked concurrently, by at most `workers` threads (task
+    argument, 8 by default). The errors are sorted by check, then by host in
+    the order of the play. The result gives the time taken by each check
+    (summed over the hosts) and by each host.
+
+    With the `cache` task argument (path on the controller), the hosts whose
+    storage facts and configuration did not change since their last
+    successful validation are skipped (see `ValidationCache`). The result
+    gives the reason why each of the other hosts was `revalidated`.
+    '''
+
+    DEFAULT_WORKERS = 8
 
     def run(self, tmp=None, task_vars=None):
         if task_vars is None:
@@ -439,33 +564,100 @@ class ActionModule(ActionBase):
                 if name.startswith('check_') and inspect.isfunction(obj):
                     yield (name, obj)
 
-        errors = []
-        failed = False
-
-        for (name, check) in collect_checks():
-            for host in task_vars.get('ansible_play_hosts', []):
+        checks = list(collect_checks())
+        hosts = list(task_vars.get('ansible_play_hosts', []))
+        workers = max(1, int(
+            self._task.args.get('workers', self.DEFAULT_WORKERS)))
+
+        cache = ValidationCache(self._task.args.get('cache'))
+
+        host_results = {}
+        fingerprints = {}
+        revalidated = {}
+
+        # The templating of `hostvars` is not thread-safe: the variables of
+        # the hosts are resolved beforehand, one host after the other
+        resolved = {}
+        pending = queue.Queue()
+        for host in hosts:
+            start = time.time()
+            try:
+                resolved[host] = resolve_hostvars(task_vars['hostvars'][host])
+            except Exception as exc:
+                host_results[host] = ([
+                    ('run_checks', 'Unexpected error: {}'.format(exc))
+                ], {}, time.time() - start)
+            else:
+                pending.put(host)
+
+        def worker():
+            while True:
                 try:
-                    results = check(task_vars['hostvars'][host])
-                    if not results:
-                        # Simple `assert`-check, passed and returned `None`
-                        results = []
-
-                    for message in results:
-                        failed = True
-                        errors.append('[{}]: {} [{}]'.format(
-                            host, message, name))
-
-                except AssertionError as exc:
-                    failed = True
-                    errors.append(
-                        '[{}]: {} [{}]'.format(
-                            host,
-                            exc.args[0] if len(exc.args) >= 1
-                            else 'Unknown failure',
-                            name)
-                    )
-
-        result['failed'] = failed
+                    host = pending.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.time()
+                try:
+                    hostvars = resolved[host]
+                    fingerprints[host] = {
+                        'facts': fingerprint(hostvars, STORAGE_FACTS),
+                        'configuration': fingerprint(
+                            hostvars, STORAGE_CONFIGURATION),
+                    }
+                    reason = cache.revalidation_reason(
+                        host, **fingerprints[host])
+                    if reason is None:
+                        errors, durations = [], {}
+                    else:
+                        revalidated[host] = reason
+                        errors, durations = run_checks(checks, hostvars)
+                except Exception as exc:
+                    errors, durations = [
+                        ('run_checks', 'Unexpected error: {}'.format(exc))
+                    ], {}
+                host_results[host] = (
+                    errors, durations, time.time() - start)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(workers, len(resolved)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Stable order: by check, then by host in the order of the play
+        check_order = dict(
+            (name, position) for position, (name, _) in enumerate(checks))
+        ordered_errors = sorted(
+            (check_order.get(name, len(checks)), host_position, position,
+             '[{}]: {} [{}]'.format(host, message, name))
+            for host_position, host in enumerate(hosts)
+            for position, (name, message) in enumerate(host_results[host][0])
+        )
+        errors = [error for _, _, _, error in ordered_errors]
+
+        check_timings = {}
+        for host in hosts:
+            for name, duration in host_results[host][1].items():
+                check_timings[name] = check_timings.get(name, 0) + duration
+
+        failed_hosts = set(host for host in hosts if host_results[host][0])
+        cache.save(
+            dict((host, fingerprints[host]) for host in revalidated
+                 if host in fingerprints and host not in failed_hosts),
+            failed_hosts)
+
+        result['failed'] = bool(errors)
         result['errors'] = errors
+        result['revalidated'] = revalidated
+        result['skipped_hosts'] = [
+            host for host in hosts
+            if host not in revalidated and host not in failed_hosts]
+        result['timings'] = {
+            'checks': dict((name, round(duration, 3))
+                           for name, duration in check_timings.items()),
+            'hosts': dict((host, round(host_results[host][2], 3))
+                          for host in hosts),
+        }
 
         return result
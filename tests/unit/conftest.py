@@ -0,0 +1,61 @@
+import glob
+import importlib.util
+import json
+import os.path
+import subprocess
+import sys
+
+import pytest
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# Run a module of a role as Ansible would: the `module_utils` of the roles
+# are importable as `ansible.module_utils.*`, and the arguments are read from
+# the file given as first argument
+MODULE_RUNNER = '''
+import runpy
+import sys
+
+import ansible.module_utils
+
+ansible.module_utils.__path__.extend(sys.argv.pop(1).split(':'))
+runpy.run_path(sys.argv.pop(1), run_name='__main__')
+'''
+
+
+def module_path(role, module):
+    return os.path.join(ROOT, 'roles', role, 'library', module + '.py')
+
+
+def import_module(role, module):
+    '''Import a module of a role, to test its functions'''
+    spec = importlib.util.spec_from_file_location(
+        '{}_{}'.format(role, module), module_path(role, module))
+    loaded = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(loaded)
+    return loaded
+
+
+@pytest.fixture
+def run_module(tmpdir):
+    '''Run a module of a role, return its exit status and result'''
+    def run(role, module, args, env=None):
+        args_file = tmpdir.join('{}.args.json'.format(module))
+        args_file.write(json.dumps({'ANSIBLE_MODULE_ARGS': args}))
+        module_utils = glob.glob(os.path.join(ROOT, 'roles', '*',
+                                              'module_utils'))
+        process = subprocess.Popen(
+            [sys.executable, '-c', MODULE_RUNNER, ':'.join(module_utils),
+             module_path(role, module), str(args_file)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=dict(os.environ, **(env or {})))
+        out, err = process.communicate()
+        try:
+            result = json.loads(out.decode('utf-8'))
+        except ValueError:
+            pytest.fail('{} did not return JSON (rc={}): {} {}'.format(
+                module, process.returncode, out, err))
+        return process.returncode, result
+
+    return run
@@ -0,0 +1,183 @@
+'''Tests of the `helm_releases` module, with a fake `helm` binary
+
+The fake `helm` logs each of its calls, with when it started and ended,
+and the Tiller address it was given. `helm upgrade` takes `FAKE_HELM_DELAY`
+seconds, and fails for the releases listed in `FAKE_HELM_FAIL`.
+'''
+
+import json
+import os
+import sys
+import textwrap
+
+import pytest
+
+
+FAKE_HELM = textwrap.dedent('''\
+    import json
+    import os
+    import sys
+    import time
+
+    args = sys.argv[1:]
+    host = None
+    if '--host' in args:
+        index = args.index('--host')
+        host = args[index + 1]
+        del args[index:index + 2]
+
+    start = time.time()
+    rc = 0
+    if args[0] == 'upgrade':
+        release = args[2]
+        time.sleep(float(os.environ.get('FAKE_HELM_DELAY', '0')))
+        if release in os.environ.get('FAKE_HELM_FAIL', '').split(','):
+            sys.stderr.write('Error: release {} failed\\n'.format(release))
+            rc = 1
+        else:
+            print('Release "{}" has been upgraded.'.format(release))
+            print('LAST DEPLOYED: Mon Jan  7 10:00:00 2019')
+            print('NAMESPACE: default')
+            print('STATUS: DEPLOYED')
+
+    with open(os.environ['FAKE_HELM_LOG'], 'a') as log:
+        log.write(json.dumps({
+            'args': args,
+            'host': host,
+            'env_host': os.environ.get('HELM_HOST'),
+            'start': start,
+            'end': time.time(),
+        }) + '\\n')
+    sys.exit(rc)
+''')
+
+
+@pytest.fixture
+def fake_helm(tmpdir):
+    binary = tmpdir.join('helm')
+    binary.write('#!{}\n{}'.format(sys.executable, FAKE_HELM))
+    binary.chmod(0o755)
+    return binary
+
+
+@pytest.fixture
+def helm_releases(run_module, fake_helm, tmpdir):
+    log = tmpdir.join('helm.log')
+
+    def run(releases, delay=0, fail=(), **params):
+        args = dict(params, binary=str(fake_helm), releases=releases)
+        rc, result = run_module('helm_common', 'helm_releases', args, env={
+            'FAKE_HELM_LOG': str(log),
+            'FAKE_HELM_DELAY': str(delay),
+            'FAKE_HELM_FAIL': ','.join(fail),
+        })
+        calls = [json.loads(line) for line in log.readlines()] \
+            if log.check() else []
+        installs = dict((call['args'][2], call) for call in calls
+                        if call['args'][0] == 'upgrade')
+        return rc, result, calls, installs
+
+    return run
+
+
+def release(name, *depends_on):
+    return {'release': name, 'chart': {'name': 'stable/' + name},
+            'depends_on': list(depends_on)}
+
+
+def max_concurrency(installs):
+    events = []
+    for call in installs.values():
+        events.extend([(call['start'], 1), (call['end'], -1)])
+    running = highest = 0
+    for _, change in sorted(events):
+        running += change
+        highest = max(highest, running)
+    return highest
+
+
+def test_independent_releases_run_concurrently(helm_releases):
+    rc, result, _, installs = helm_releases(
+        [release('heapster'), release('nginx-ingress'),
+         release('metrics-server')],
+        delay=1, workers=3)
+
+    assert rc == 0, result
+    assert result['changed']
+    assert sorted(installs) == ['heapster', 'metrics-server', 'nginx-ingress']
+    assert max_concurrency(installs) == 3
+    for name, entry in result['releases'].items():
+        assert entry['status'] == 'ok'
+        assert entry['result']['changed']
+        assert entry['duration'] >= 1
+
+
+def test_workers_are_bounded(helm_releases):
+    rc, result, _, installs = helm_releases(
+        [release('release-{}'.format(n)) for n in range(5)],
+        delay=0.5, workers=2)
+
+    assert rc == 0, result
+    assert len(installs) == 5
+    assert max_concurrency(installs) == 2
+
+
+def test_dependencies_are_installed_first(helm_releases):
+    rc, result, _, installs = helm_releases(
+        [release('kube-prometheus', 'prometheus-operator'),
+         release('prometheus-operator'),
+         release('heapster')],
+        delay=0.5, workers=4)
+
+    assert rc == 0, result
+    assert installs['kube-prometheus']['start'] >= \
+        installs['prometheus-operator']['end']
+    assert installs['heapster']['start'] < \
+        installs['prometheus-operator']['end']
+
+
+def test_failed_dependency_skips_dependents(helm_releases):
+    rc, result, _, installs = helm_releases(
+        [release('prometheus-operator'),
+         release('kube-prometheus', 'prometheus-operator'),
+         release('heapster')],
+        fail=['prometheus-operator'])
+
+    assert rc != 0
+    assert result['failed']
+    assert 'prometheus-operator' in result['msg']
+    releases = result['releases']
+    assert releases['prometheus-operator']['status'] == 'failed'
+    assert releases['kube-prometheus']['status'] == 'skipped'
+    assert releases['heapster']['status'] == 'ok'
+    assert 'kube-prometheus' not in installs
+
+
+def test_helm_host_is_given_as_argument(helm_releases):
+    rc, result, calls, _ = helm_releases(
+        [release('release-{}'.format(n)) for n in range(4)],
+        workers=4, helm_host='127.0.0.1:44134')
+
+    assert rc == 0, result
+    assert calls
+    for call in calls:
+        assert call['host'] == '127.0.0.1:44134'
+        assert call['env_host'] == os.environ.get('HELM_HOST')
+
+
+def test_dependency_cycle(helm_releases):
+    rc, result, calls, _ = helm_releases(
+        [release('a', 'b'), release('b', 'a')])
+
+    assert rc != 0
+    assert 'cycle' in result['msg']
+    assert not calls
+
+
+def test_invalid_state(helm_releases):
+    rc, result, calls, _ = helm_releases([release('heapster')],
+                                         state='installed')
+
+    assert rc != 0
+    assert 'state' in result['msg']
+    assert not calls
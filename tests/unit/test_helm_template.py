@@ -0,0 +1,257 @@
+'''Tests of the `engine=template` of the `helm_cli` module
+
+The fake `helm template` prints the manifest of `FAKE_HELM_MANIFEST`. The
+fake `kubectl` logs each of its calls, with the objects it was given on its
+standard input, and keeps the ConfigMaps recording the releases in
+`FAKE_KUBECTL_STATE`. `kubectl wait` fails for the objects listed in
+`FAKE_KUBECTL_FAIL`.
+'''
+
+import json
+import sys
+import textwrap
+
+import pytest
+import yaml
+
+
+FAKE_HELM = textwrap.dedent('''\
+    import os
+    import sys
+
+    if sys.argv[1] == 'template':
+        sys.stdin.read()
+        with open(os.environ['FAKE_HELM_MANIFEST']) as manifest:
+            sys.stdout.write(manifest.read())
+''')
+
+FAKE_KUBECTL = textwrap.dedent('''\
+    import json
+    import os
+    import sys
+
+    args = sys.argv[1:]
+    objects = []
+    if '-' in args:
+        document = json.loads(sys.stdin.read())
+        objects = document['items'] if document['kind'] == 'List' \\
+            else [document]
+
+    with open(os.environ['FAKE_KUBECTL_LOG'], 'a') as log:
+        log.write(json.dumps({'args': args, 'objects': objects}) + '\\n')
+
+    path = os.environ['FAKE_KUBECTL_STATE']
+    state = {}
+    if os.path.exists(path):
+        with open(path) as state_file:
+            state = json.load(state_file)
+
+    def name(obj):
+        return '{}/{}'.format(obj['kind'].lower(), obj['metadata']['name'])
+
+    rc = 0
+    if args[0] == 'get':
+        if args[2] in state:
+            print(json.dumps(state[args[2]]))
+    elif args[0] in ('apply', 'create'):
+        for obj in objects:
+            if obj['kind'] == 'ConfigMap':
+                state[obj['metadata']['name']] = obj
+            if '--output' in args:
+                print(name(obj))
+    elif args[0] == 'delete':
+        if args[1] == 'configmap':
+            state.pop(args[2], None)
+    elif args[0] == 'wait':
+        failing = os.environ.get('FAKE_KUBECTL_FAIL', '').split(',')
+        if any(arg in failing for arg in args):
+            sys.stderr.write('error: timed out waiting for the condition')
+            rc = 1
+
+    with open(path, 'w') as state_file:
+        json.dump(state, state_file)
+    sys.exit(rc)
+''')
+
+
+def hook(kind, name, events, weight=None, delete_policy=None):
+    annotations = {'helm.sh/hook': events}
+    if weight is not None:
+        annotations['helm.sh/hook-weight'] = str(weight)
+    if delete_policy is not None:
+        annotations['helm.sh/hook-delete-policy'] = delete_policy
+    return {'apiVersion': 'v1', 'kind': kind,
+            'metadata': {'name': name, 'annotations': annotations}}
+
+
+CRD = dict(
+    hook('CustomResourceDefinition', 'prometheuses.monitoring.coreos.com',
+         'crd-install'),
+    apiVersion='apiextensions.k8s.io/v1beta1')
+DEPLOYMENT = {'apiVersion': 'apps/v1', 'kind': 'Deployment',
+              'metadata': {'name': 'operator'}}
+PROMETHEUS = {'apiVersion': 'monitoring.coreos.com/v1', 'kind': 'Prometheus',
+              'metadata': {'name': 'k8s', 'namespace': 'kube-ops'}}
+TEST_POD = hook('Pod', 'operator-test', 'test-success')
+INSTALL_JOB = hook('Job', 'operator-setup', 'pre-install,pre-upgrade',
+                   delete_policy='hook-succeeded')
+POST_JOBS = [hook('Job', 'operator-late', 'post-install', weight=5),
+             hook('Job', 'operator-early', 'post-install', weight=-5)]
+DELETE_JOB = hook('Job', 'operator-cleanup', 'pre-delete')
+
+
+@pytest.fixture
+def helm_template(run_module, tmpdir):
+    paths = dict((name, tmpdir.join(name))
+                 for name in ['helm', 'kubectl', 'manifest.yaml',
+                              'kubectl.log', 'kubectl.json', 'chart.tgz'])
+    for binary, source in [('helm', FAKE_HELM), ('kubectl', FAKE_KUBECTL)]:
+        paths[binary].write('#!{}\n{}'.format(sys.executable, source))
+        paths[binary].chmod(0o755)
+    paths['chart.tgz'].write('')
+
+    def run(objects, state='latest', values=None, fail=()):
+        paths['manifest.yaml'].write(yaml.safe_dump_all(objects))
+        if paths['kubectl.log'].check():
+            paths['kubectl.log'].remove()
+        rc, result = run_module('helm_common', 'helm_cli', {
+            'engine': 'template',
+            'release': 'prometheus-operator',
+            'namespace': 'monitoring',
+            'chart': {'name': 'prometheus-operator', 'version': '0.1.0',
+                      'path': str(paths['chart.tgz'])},
+            'binary': str(paths['helm']),
+            'kubectl': str(paths['kubectl']),
+            'state': state,
+            'values': values or [],
+        }, env={
+            'FAKE_HELM_MANIFEST': str(paths['manifest.yaml']),
+            'FAKE_KUBECTL_LOG': str(paths['kubectl.log']),
+            'FAKE_KUBECTL_STATE': str(paths['kubectl.json']),
+            'FAKE_KUBECTL_FAIL': ','.join(fail),
+        })
+        calls = [json.loads(line)
+                 for line in paths['kubectl.log'].readlines()] \
+            if paths['kubectl.log'].check() else []
+        return rc, result, calls
+
+    return run
+
+
+def object_names(call):
+    return [obj['metadata']['name'] for obj in call['objects']]
+
+
+def find_call(calls, command, name):
+    for index, call in enumerate(calls):
+        if call['args'][0] != command:
+            continue
+        if name in object_names(call) or \
+                any(arg.endswith('/' + name) for arg in call['args']):
+            return index, call
+    raise AssertionError('No kubectl {} of {}'.format(command, name))
+
+
+def namespace_of(call):
+    return call['args'][call['args'].index('--namespace') + 1]
+
+
+def test_crd_install_hooks_first(helm_template):
+    rc, result, calls = helm_template([PROMETHEUS, CRD, DEPLOYMENT])
+
+    assert rc == 0, result
+    crd_apply, _ = find_call(calls, 'apply', CRD['metadata']['name'])
+    crd_wait, wait = find_call(calls, 'wait', CRD['metadata']['name'])
+    custom_apply, _ = find_call(calls, 'apply', 'k8s')
+    assert crd_apply < crd_wait < custom_apply
+    assert '--for=condition=established' in wait['args']
+    # CRDs are not part of the release
+    assert result['release']['Objects'] == [
+        ['kube-ops', 'prometheus/k8s'],
+        ['monitoring', 'deployment/operator'],
+    ]
+
+
+def test_objects_applied_in_their_namespace(helm_template):
+    rc, result, calls = helm_template([PROMETHEUS, DEPLOYMENT])
+
+    assert rc == 0, result
+    _, custom = find_call(calls, 'apply', 'k8s')
+    _, deployment = find_call(calls, 'apply', 'operator')
+    assert namespace_of(custom) == 'kube-ops'
+    assert object_names(custom) == ['k8s']
+    assert namespace_of(deployment) == 'monitoring'
+    assert object_names(deployment) == ['operator']
+
+
+def test_pruned_in_their_namespace(helm_template):
+    helm_template([PROMETHEUS, DEPLOYMENT])
+    rc, result, calls = helm_template([DEPLOYMENT], values=[{'a': 1}])
+
+    assert rc == 0, result
+    assert result['pruned'] == ['kube-ops/prometheus/k8s']
+    _, delete = find_call(calls, 'delete', 'k8s')
+    assert namespace_of(delete) == 'kube-ops'
+
+
+def test_test_hooks_are_ignored(helm_template):
+    rc, result, calls = helm_template([DEPLOYMENT, TEST_POD])
+
+    assert rc == 0, result
+    with pytest.raises(AssertionError):
+        find_call(calls, 'create', 'operator-test')
+    with pytest.raises(AssertionError):
+        find_call(calls, 'apply', 'operator-test')
+
+
+def test_install_hooks(helm_template):
+    rc, result, calls = helm_template([DEPLOYMENT, INSTALL_JOB] + POST_JOBS)
+
+    assert rc == 0, result
+    pre_create, _ = find_call(calls, 'create', 'operator-setup')
+    pre_wait, wait = find_call(calls, 'wait', 'operator-setup')
+    pre_delete, _ = find_call(calls[pre_wait:], 'delete', 'operator-setup')
+    apply_index, _ = find_call(calls, 'apply', 'operator')
+    early, _ = find_call(calls, 'create', 'operator-early')
+    late, _ = find_call(calls, 'create', 'operator-late')
+    assert pre_create < pre_wait < apply_index < early < late
+    assert '--for=condition=complete' in wait['args']
+    # Without the hook-succeeded policy, the Job is kept
+    for call in calls[late:]:
+        assert call['args'][0] != 'delete'
+    assert result['release']['Objects'] == [
+        ['monitoring', 'deployment/operator']]
+
+
+def test_upgrade_hooks(helm_template):
+    helm_template([DEPLOYMENT, INSTALL_JOB] + POST_JOBS)
+    rc, result, calls = helm_template([DEPLOYMENT, INSTALL_JOB] + POST_JOBS,
+                                      values=[{'replicas': 2}])
+
+    assert rc == 0, result
+    assert result['changed']
+    find_call(calls, 'create', 'operator-setup')
+    for name in ['operator-early', 'operator-late']:
+        with pytest.raises(AssertionError):
+            find_call(calls, 'create', name)
+
+
+def test_failed_hook(helm_template):
+    rc, result, calls = helm_template([DEPLOYMENT, INSTALL_JOB],
+                                      fail=['job/operator-setup'])
+
+    assert rc != 0
+    assert 'operator-setup' in result['msg']
+    with pytest.raises(AssertionError):
+        find_call(calls, 'apply', 'operator')
+
+
+def test_delete_hooks(helm_template):
+    helm_template([DEPLOYMENT, DELETE_JOB])
+    rc, result, calls = helm_template([DEPLOYMENT, DELETE_JOB],
+                                      state='absent')
+
+    assert rc == 0, result
+    hook_create, _ = find_call(calls, 'create', 'operator-cleanup')
+    delete, _ = find_call(calls, 'delete', 'operator')
+    assert hook_create < delete
@@ -0,0 +1,125 @@
+'''Tests of the comparison of objects of the `kube` module'''
+
+import pytest
+import yaml
+
+from conftest import import_module
+
+
+kube = import_module('kubespray_module', 'kube')
+
+
+def container(env, **fields):
+    return dict({'name': 'web', 'image': 'nginx:1.15',
+                 'env': [{'name': name, 'value': value}
+                         for name, value in sorted(env.items())]}, **fields)
+
+
+def deployment(*containers):
+    return {'apiVersion': 'apps/v1', 'kind': 'Deployment',
+            'metadata': {'name': 'web'},
+            'spec': {'template': {'spec': {'containers': list(containers)}}}}
+
+
+def live(obj, **status):
+    '''`obj` as returned by the API server, with defaults and a status'''
+    result = yaml.safe_load(yaml.safe_dump(obj))
+    result['metadata'].update(uid='1234', resourceVersion='42')
+    result['metadata']['annotations'] = {kube.LAST_APPLIED: '{}'}
+    for item in result['spec']['template']['spec']['containers']:
+        item.setdefault('imagePullPolicy', 'IfNotPresent')
+    result['status'] = status
+    return result
+
+
+def test_object_diff_ignores_server_fields():
+    desired = deployment(container({'A': '1'}))
+
+    assert kube.object_diff(desired, live(desired, replicas=1)) == []
+
+
+def test_object_diff_changed_field():
+    desired = deployment(container({'A': '2'}))
+    current = live(deployment(container({'A': '1'})))
+
+    assert kube.object_diff(desired, current) == [
+        'spec.template.spec.containers[0].env[0].value']
+
+
+def test_object_diff_removed_field():
+    previous = deployment(container({'A': '1'}, command=['nginx']))
+    desired = deployment(container({'A': '1'}))
+
+    assert kube.object_diff(desired, live(previous), previous) == [
+        'spec.template.spec.containers[0].command']
+
+
+def test_object_diff_list_length():
+    desired = deployment(container({'A': '1'}))
+    current = live(deployment(container({'A': '1', 'B': '2'})))
+
+    assert kube.object_diff(desired, current) == [
+        'spec.template.spec.containers[0].env']
+
+
+def test_removed_items():
+    previous = deployment(container({'A': '1', 'B': '2'}))
+
+    assert kube.removed_items(previous, previous) == []
+    assert kube.removed_items(
+        previous, deployment(container({'A': '1', 'B': '3'}))) == []
+    assert kube.removed_items(
+        previous, deployment(container({'A': '1'}))) == [
+        'spec.template.spec.containers[0].env']
+    assert kube.removed_items(
+        {'args': ['--v=2', '--debug']}, {'args': ['--v=2']}) == ['args']
+
+
+def test_merge_patch_removes_fields():
+    assert kube.merge_patch(
+        {'data': {'a': '1', 'b': '2'}, 'immutable': True},
+        {'data': {'a': '1'}}) == {'data': {'a': '1', 'b': None},
+                                  'immutable': None}
+
+
+@pytest.mark.parametrize('obj,error', [
+    ('a scalar', 'expected a mapping, got str'),
+    ([{'kind': 'ConfigMap'}], 'expected a mapping, got list'),
+    ({'kind': 'ConfigMap', 'metadata': {'name': 'a'}},
+     'apiVersion is missing or not a string'),
+    ({'apiVersion': 'v1', 'kind': 'ConfigMap'}, 'metadata.name is missing'),
+    ({'apiVersion': 'v1', 'kind': 'ConfigMap', 'metadata': {'name': 'a'}},
+     None),
+])
+def test_object_error(obj, error):
+    assert kube.object_error(obj) == error
+
+
+def test_summarize_apply():
+    assert kube.summarize_apply([
+        'configmap/a created',
+        'deployment.apps "web" configured',
+        'service/web unchanged',
+        'warning: something',
+    ]) == {'created': ['configmap/a'],
+           'configured': ['deployment.apps/web'],
+           'unchanged': ['service/web']}
+
+
+@pytest.mark.parametrize('engine', ['kubectl', 'native'])
+def test_invalid_document(run_module, tmpdir, engine):
+    manifest = tmpdir.join('manifest.yml')
+    manifest.write('apiVersion: v1\nkind: ConfigMap\nmetadata: {name: a}\n'
+                   '---\n- not\n- an object\n')
+
+    rc, result = run_module('kubespray_module', 'kube', {
+        'engine': engine,
+        'kubectl': '/bin/false',
+        'kubeconfig': str(tmpdir.join('missing')),
+        'filename': [str(manifest)],
+        'state': 'latest',
+    })
+
+    assert rc != 0
+    assert result['msg'] == 'invalid document 2 of {}: expected a ' \
+        'mapping, got list'.format(manifest)
@@ -0,0 +1,367 @@
+'''Tests of the `engine=native` of the `kube` module, against a fake API server
+
+The fake API server serves ConfigMaps and Deployments, from memory. Patches
+are applied as the real API server does for a strategic merge patch on
+lists merged by `name`, keys set to `null` being removed. Each request is
+recorded, with the port of the client it came from.
+
+The fake `kubectl`, used for the fallbacks, logs its calls, and prints the
+objects it applies as configured.
+'''
+
+import copy
+import json
+import sys
+import textwrap
+import threading
+
+import pytest
+import yaml
+
+from six.moves import BaseHTTPServer
+
+
+FAKE_KUBECTL = textwrap.dedent('''\
+    import json
+    import os
+    import sys
+
+    import yaml
+
+    args = sys.argv[1:]
+    objects = []
+    for arg in args:
+        if arg.startswith('--filename='):
+            with open(arg.split('=', 1)[1]) as manifest:
+                for document in yaml.safe_load_all(manifest):
+                    objects.extend(document['items']
+                                   if document['kind'] == 'List'
+                                   else [document])
+
+    with open(os.environ['FAKE_KUBECTL_LOG'], 'a') as log:
+        log.write(json.dumps({'args': args, 'objects': objects}) + '\\n')
+
+    if 'get' in args:
+        print(json.dumps({'kind': 'List', 'items': []}))
+    elif 'apply' in args:
+        for obj in objects:
+            print('{}/{} configured'.format(
+                obj['kind'].lower(), obj['metadata']['name']))
+''')
+
+RESOURCES = {
+    'v1': [{'name': 'configmaps', 'singularName': '', 'kind': 'ConfigMap',
+            'namespaced': True, 'shortNames': ['cm']}],
+    'apps/v1': [{'name': 'deployments', 'singularName': '',
+                 'kind': 'Deployment', 'namespaced': True,
+                 'shortNames': ['deploy']}],
+}
+
+
+def strategic_merge(live, patch):
+    '''Merge `patch` into `live`, lists of named items being merged by name'''
+    if isinstance(live, dict) and isinstance(patch, dict):
+        merged = dict(live)
+        for key, value in patch.items():
+            if value is None:
+                merged.pop(key, None)
+            elif key in merged:
+                merged[key] = strategic_merge(merged[key], value)
+            else:
+                merged[key] = value
+        return merged
+    if isinstance(live, list) and isinstance(patch, list) and \
+            all(isinstance(item, dict) and 'name' in item
+                for item in live + patch):
+        merged = list(live)
+        names = [item['name'] for item in merged]
+        for item in patch:
+            if item['name'] in names:
+                index = names.index(item['name'])
+                merged[index] = strategic_merge(merged[index], item)
+            else:
+                merged.append(item)
+        return merged
+    return patch
+
+
+class FakeApiServer(object):
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+        # Fields reset by the server after each write, like an admission
+        # controller would
+        self.overrides = {}
+        self._version = 0
+        self.httpd = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), self.handler())
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length).decode('utf-8'))
+
+            def handle_request(self, method):
+                path = self.path.split('?', 1)[0]
+                server.requests.append({
+                    'method': method,
+                    'path': path,
+                    'content_type': self.headers.get('Content-Type'),
+                    'client_port': self.client_address[1],
+                })
+                body = self.body() if method in ('POST', 'PATCH') else None
+                status, response = server.handle(method, path, body)
+                self.reply(status, response)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_PATCH(self):
+                self.handle_request('PATCH')
+
+            def do_DELETE(self):
+                self.handle_request('DELETE')
+
+        return Handler
+
+    def not_found(self, path):
+        return 404, {'kind': 'Status', 'message': '{} not found'.format(path)}
+
+    def write(self, path, obj):
+        for kind_path, value in self.overrides.items():
+            if obj['kind'] == kind_path[0]:
+                target = obj
+                for key in kind_path[1:-1]:
+                    target = target.setdefault(key, {})
+                target[kind_path[-1]] = value
+        self._version += 1
+        obj['metadata']['resourceVersion'] = str(self._version)
+        self.objects[path] = obj
+        return obj
+
+    def handle(self, method, path, body):
+        if method == 'GET' and path == '/apis':
+            return 200, {'groups': [
+                {'preferredVersion': {'groupVersion': group_version}}
+                for group_version in RESOURCES if group_version != 'v1']}
+        for group_version, resources in RESOURCES.items():
+            prefix = '/api/v1' if group_version == 'v1' else \
+                '/apis/' + group_version
+            if method == 'GET' and path == prefix:
+                return 200, {'resources': resources}
+
+        if method == 'POST':
+            path = '{}/{}'.format(path, body['metadata']['name'])
+            if path in self.objects:
+                return 409, {'kind': 'Status', 'message': 'already exists'}
+            obj = copy.deepcopy(body)
+            obj['metadata']['uid'] = 'uid-{}'.format(len(self.objects))
+            obj['status'] = {}
+            return 201, self.write(path, obj)
+
+        if path not in self.objects:
+            return self.not_found(path)
+        live = self.objects[path]
+        if method == 'GET':
+            return 200, live
+        if method == 'DELETE':
+            del self.objects[path]
+            return 200, {'kind': 'Status', 'status': 'Success'}
+        if method == 'PATCH':
+            patched = strategic_merge(copy.deepcopy(live), body)
+            if patched == live:
+                return 200, live
+            return 200, self.write(path, patched)
+        return 405, {'kind': 'Status', 'message': 'not allowed'}
+
+    def writes(self):
+        return [request for request in self.requests
+                if request['method'] != 'GET']
+
+
+@pytest.fixture
+def api_server():
+    server = FakeApiServer()
+    server.thread.start()
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+
+@pytest.fixture
+def kube(run_module, api_server, tmpdir):
+    kubectl = tmpdir.join('kubectl')
+    kubectl.write('#!{}\n{}'.format(sys.executable, FAKE_KUBECTL))
+    kubectl.chmod(0o755)
+    kubectl_log = tmpdir.join('kubectl.log')
+    kubeconfig = tmpdir.join('kubeconfig')
+    kubeconfig.write(yaml.safe_dump({
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'clusters': [{'name': 'fake', 'cluster': {
+            'server': 'http://127.0.0.1:{}'.format(api_server.port)}}],
+        'users': [{'name': 'admin', 'user': {}}],
+        'contexts': [{'name': 'fake', 'context': {
+            'cluster': 'fake', 'user': 'admin'}}],
+        'current-context': 'fake',
+    }))
+    manifest = tmpdir.join('manifest.yml')
+
+    def run(objects, state='latest', **params):
+        manifest.write(yaml.safe_dump_all(objects))
+        if kubectl_log.check():
+            kubectl_log.remove()
+        del api_server.requests[:]
+        args = dict({
+            'engine': 'native',
+            'kubeconfig': str(kubeconfig),
+            'kubectl': str(kubectl),
+            'filename': [str(manifest)],
+            'namespace': 'kube-ops',
+            'state': state,
+        }, **params)
+        rc, result = run_module('kubespray_module', 'kube', args,
+                                env={'FAKE_KUBECTL_LOG': str(kubectl_log)})
+        calls = [json.loads(line) for line in kubectl_log.readlines()] \
+            if kubectl_log.check() else []
+        return rc, result, calls
+
+    return run
+
+
+def deployment(env, replicas=1):
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': {'name': 'web', 'labels': {'app': 'web'}},
+        'spec': {
+            'replicas': replicas,
+            'template': {'spec': {'containers': [{
+                'name': 'web',
+                'image': 'nginx:1.15',
+                'env': [{'name': name, 'value': value}
+                        for name, value in sorted(env.items())],
+            }]}},
+        },
+    }
+
+
+CONFIGMAP = {'apiVersion': 'v1', 'kind': 'ConfigMap',
+             'metadata': {'name': 'settings'}, 'data': {'level': 'info'}}
+
+
+def test_create_then_unchanged(kube, api_server):
+    rc, result, calls = kube([CONFIGMAP, deployment({'A': '1'})])
+
+    assert rc == 0, result
+    assert result['changed']
+    assert sorted(result['objects']['created']) == [
+        'configmap/settings', 'deployment.apps/web']
+    assert [request['method'] for request in api_server.writes()] == \
+        ['POST', 'POST']
+    assert '/api/v1/namespaces/kube-ops/configmaps/settings' in \
+        api_server.objects
+    assert result['fallbacks'] == []
+    assert not calls
+
+    rc, result, calls = kube([CONFIGMAP, deployment({'A': '1'})])
+
+    assert rc == 0, result
+    assert not result['changed']
+    assert sorted(result['objects']['unchanged']) == [
+        'configmap/settings', 'deployment.apps/web']
+    assert not api_server.writes()
+    assert not calls
+
+
+def test_requests_share_one_connection(kube, api_server):
+    rc, result, _ = kube([CONFIGMAP, deployment({'A': '1'})])
+
+    assert rc == 0, result
+    assert len(api_server.requests) > 2
+    assert len(set(request['client_port']
+                   for request in api_server.requests)) == 1
+
+
+def test_changed_field_is_patched(kube, api_server):
+    kube([deployment({'A': '1'})])
+    rc, result, calls = kube([deployment({'A': '2'})])
+
+    assert rc == 0, result
+    assert result['changed']
+    assert result['objects']['configured'] == ['deployment.apps/web']
+    writes = api_server.writes()
+    assert [request['method'] for request in writes] == ['PATCH']
+    assert writes[0]['content_type'] == \
+        'application/strategic-merge-patch+json'
+    live = api_server.objects[
+        '/apis/apps/v1/namespaces/kube-ops/deployments/web']
+    assert live['spec']['template']['spec']['containers'][0]['env'] == \
+        [{'name': 'A', 'value': '2'}]
+    assert not calls
+
+
+def test_removed_list_item_falls_back_to_kubectl(kube, api_server):
+    kube([deployment({'A': '1', 'B': '2'})])
+    rc, result, calls = kube([deployment({'A': '1'})])
+
+    assert rc == 0, result
+    assert result['changed']
+    assert result['objects']['configured'] == ['deployment.apps/web']
+    assert result['fallbacks'] == [
+        'apply deployment.apps/web: items removed from '
+        'spec.template.spec.containers[0].env']
+    assert not api_server.writes()
+    [call] = calls
+    assert 'apply' in call['args']
+    [applied] = call['objects']
+    assert applied['spec']['template']['spec']['containers'][0]['env'] == \
+        [{'name': 'A', 'value': '1'}]
+
+
+def test_patch_not_converging_falls_back_to_kubectl(kube, api_server):
+    kube([deployment({'A': '1'})])
+    api_server.overrides[('Deployment', 'spec', 'replicas')] = 1
+    rc, result, calls = kube([deployment({'A': '1'}, replicas=3)])
+
+    assert rc == 0, result
+    assert result['changed']
+    assert result['objects']['configured'] == ['deployment.apps/web']
+    assert result['fallbacks'] == [
+        'apply deployment.apps/web: fields not patched: spec.replicas']
+    assert [request['method'] for request in api_server.writes()] == \
+        ['PATCH']
+    [call] = calls
+    assert 'apply' in call['args']
+
+
+def test_init_fallback_is_reported(kube, tmpdir):
+    rc, result, calls = kube([CONFIGMAP],
+                             kubeconfig=str(tmpdir.join('missing')))
+
+    assert rc == 0, result
+    assert result['fallbacks'] == ['init: no kubeconfig found']
+    assert any('apply' in call['args'] for call in calls)
@@ -0,0 +1,96 @@
+'''Tests of the `kube_wait` module, with a fake `kubectl`
+
+The fake `kubectl get` lists the objects of `FAKE_KUBECTL_OBJECTS`, and its
+watch prints the events of `FAKE_KUBECTL_EVENTS` as indented JSON documents,
+as kubectl does, then waits to be stopped.
+'''
+
+import json
+import sys
+import textwrap
+
+import pytest
+
+
+FAKE_KUBECTL = textwrap.dedent('''\
+    import json
+    import os
+    import sys
+    import time
+
+    args = sys.argv[1:]
+    if '--help' in args:
+        print('--output-watch-events=false: Output watch event objects')
+    elif '--watch' in args:
+        with open(os.environ['FAKE_KUBECTL_EVENTS']) as events:
+            for event in json.load(events):
+                print(json.dumps(event, indent=4))
+                sys.stdout.flush()
+                time.sleep(0.1)
+        time.sleep(60)
+    else:
+        with open(os.environ['FAKE_KUBECTL_OBJECTS']) as objects:
+            print(json.dumps({'kind': 'List', 'items': json.load(objects)}))
+''')
+
+
+def deployment(name, available):
+    return {'kind': 'Deployment', 'metadata': {'name': name},
+            'status': {'conditions': [
+                {'type': 'Available',
+                 'status': 'True' if available else 'False'}]}}
+
+
+@pytest.fixture
+def kube_wait(run_module, tmpdir):
+    kubectl = tmpdir.join('kubectl')
+    kubectl.write('#!{}\n{}'.format(sys.executable, FAKE_KUBECTL))
+    kubectl.chmod(0o755)
+
+    def run(objects, events, timeout=10):
+        tmpdir.join('objects.json').write(json.dumps(objects))
+        tmpdir.join('events.json').write(json.dumps(events))
+        return run_module('kubespray_module', 'kube_wait', {
+            'kubectl': str(kubectl),
+            'timeout': timeout,
+            'objects': [{'kind': 'Deployment', 'namespace': 'kube-ops',
+                         'name': 'prometheus-operator',
+                         'condition': 'Available'},
+                        {'kind': 'Deployment', 'namespace': 'kube-ops',
+                         'name': 'old-operator', 'state': 'absent'}],
+        }, env={
+            'FAKE_KUBECTL_OBJECTS': str(tmpdir.join('objects.json')),
+            'FAKE_KUBECTL_EVENTS': str(tmpdir.join('events.json')),
+        })
+
+    return run
+
+
+def test_objects_are_watched(kube_wait):
+    rc, result = kube_wait(
+        [deployment('prometheus-operator', False),
+         deployment('old-operator', True)],
+        [{'type': 'MODIFIED',
+          'object': deployment('prometheus-operator', True)},
+         {'type': 'DELETED', 'object': deployment('old-operator', True)}])
+
+    assert rc == 0, result
+    for name in ['deployment/kube-ops/prometheus-operator',
+                 'deployment/kube-ops/old-operator']:
+        assert result['objects'][name]['ready']
+    # Only the first list was needed, the rest came from the watch
+    assert [timing['args'] for timing in result['timings']] == [
+        'get deployment --output json --namespace kube-ops']
+
+
+def test_timeout(kube_wait):
+    rc, result = kube_wait(
+        [deployment('prometheus-operator', False)],
+        [{'type': 'MODIFIED',
+          'object': deployment('prometheus-operator', False)}],
+        timeout=1)
+
+    assert rc != 0
+    assert 'deployment/kube-ops/prometheus-operator' in result['msg']
+    assert not result['objects'][
+        'deployment/kube-ops/prometheus-operator']['ready']
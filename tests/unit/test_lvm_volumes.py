@@ -0,0 +1,128 @@
+'''Tests of the `metalk8s_lvm_volumes` module, on a VG backed by a loop device
+
+These tests create a loop device, a VG and LVs, format and mount them: they
+are skipped unless run as root, with the LVM tools installed.
+'''
+
+import os
+import shutil
+import subprocess
+
+import pytest
+
+
+TOOLS = ['losetup', 'pvcreate', 'pvremove', 'vgcreate', 'vgremove',
+         'lvcreate', 'lvs', 'blkid', 'mkfs.ext4', 'mount', 'umount']
+
+pytestmark = pytest.mark.skipif(
+    os.geteuid() != 0 or any(shutil.which(tool) is None for tool in TOOLS),
+    reason='requires root and the LVM tools')
+
+
+def run(*cmd):
+    return subprocess.check_output(cmd).decode('utf-8').strip()
+
+
+def mounts_under(path):
+    with open('/proc/mounts') as mounts:
+        return [line.split()[1] for line in mounts
+                if line.split()[1].startswith(path + '/')]
+
+
+@pytest.fixture
+def loop_vg(tmpdir):
+    '''A VG on a loop device, removed with its LVs afterwards'''
+    backing = tmpdir.join('pv.img')
+    with open(str(backing), 'wb') as image:
+        image.truncate(128 * 1024 ** 2)
+    device = run('losetup', '--find', '--show', str(backing))
+    vg_name = 'metalk8stest{}'.format(os.getpid())
+    host_path = tmpdir.join('mnt')
+    try:
+        run('pvcreate', '--yes', device)
+        run('vgcreate', vg_name, device)
+        yield vg_name, str(host_path)
+    finally:
+        for mountpoint in mounts_under(str(host_path)):
+            subprocess.call(['umount', mountpoint])
+        subprocess.call(['vgremove', '--yes', '--force', vg_name])
+        subprocess.call(['pvremove', '--yes', device])
+        subprocess.call(['losetup', '--detach', device])
+
+
+@pytest.fixture
+def lvm_volumes(run_module, loop_vg, tmpdir):
+    vg_name, host_path = loop_vg
+    fstab = tmpdir.join('fstab')
+    fstab.write('# static file system information\n')
+    lvs = dict(
+        ('/dev/mapper/{}-{}'.format(vg_name, lv_name), {
+            'lv_name': lv_name,
+            'vg_prop': {'vg_name': vg_name, 'host_path': host_path},
+            'size': '16m',
+            'fstype': 'ext4',
+        })
+        for lv_name in ['lv01', 'lv02'])
+
+    def run_lvm_volumes(**params):
+        return run_module('setup_lvm_lv', 'metalk8s_lvm_volumes',
+                          dict(params, lvs=lvs, fstab=str(fstab)))
+
+    return run_lvm_volumes, lvs, fstab
+
+
+def test_create_format_mount(lvm_volumes):
+    run_lvm_volumes, lvs, fstab = lvm_volumes
+
+    rc, result = run_lvm_volumes()
+
+    assert rc == 0, result
+    assert result['changed']
+    # Once before formatting, once after
+    assert len(result['scans']) == 2
+    for path, lv in lvs.items():
+        volume = result['volumes'][path]
+        assert volume['status'] == 'changed'
+        assert volume['actions'] == ['created', 'formatted', 'mounted']
+        assert volume['uuid']
+        assert result['filesystems'][path]['fstype'] == 'ext4'
+        assert result['filesystems'][path]['uuid'] == volume['uuid']
+        assert result['lvs'][path]['uuid'] == volume['uuid']
+        mountpoint = '{}/{}'.format(lv['vg_prop']['host_path'],
+                                    volume['uuid'])
+        assert mountpoint in mounts_under(lv['vg_prop']['host_path'])
+        assert 'UUID={} {} ext4 defaults 0 0'.format(
+            volume['uuid'], mountpoint) in fstab.read().splitlines()
+    # The existing lines of the fstab are kept
+    assert fstab.read().startswith('# static file system information\n')
+
+
+def test_idempotence(lvm_volumes):
+    run_lvm_volumes, lvs, fstab = lvm_volumes
+    rc, first = run_lvm_volumes()
+    assert rc == 0, first
+    content = fstab.read()
+
+    rc, result = run_lvm_volumes()
+
+    assert rc == 0, result
+    assert not result['changed']
+    # Nothing was formatted: a single scan
+    assert len(result['scans']) == 1
+    for path in lvs:
+        volume = result['volumes'][path]
+        assert volume['status'] == 'ok'
+        assert volume['actions'] == []
+        assert volume['uuid'] == first['volumes'][path]['uuid']
+    assert fstab.read() == content
+
+
+def test_check_mode_after_provisioning(lvm_volumes):
+    run_lvm_volumes, lvs, _ = lvm_volumes
+    rc, result = run_lvm_volumes()
+    assert rc == 0, result
+
+    rc, result = run_lvm_volumes(_ansible_check_mode=True)
+
+    assert rc == 0, result
+    assert not result['changed']